@@ -0,0 +1,235 @@
+"""
+Headless batch runs of the simulation over Eedi questions.
+
+    python batch_run.py --out runs/overnight --start 0 --limit 200 --rounds 4 \
+        --games 8 --llm-concurrency 16 [--roster roster.json] [--agents 3]
+
+Each question is played as its own Game: setup, --rounds rounds and final
+answers. --games of them run at once, and all of them share the process
+wide LLM budget (--llm-concurrency requests in flight per provider) and the
+rate-limit governor. Output in --out:
+
+    results.jsonl      one line per finished question (also the checkpoint)
+    discussions.jsonl  every finished game's events (export.py jsonl format)
+    summary.json       throughput of the run so far
+    games/<id>/        event log of each game in progress
+
+Rerunning with the same --out skips finished questions and resumes games in
+progress from their last completed round, without redoing earlier LLM calls.
+Tokens, cost and time spent before a restart are logged after each round
+and count towards the result.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import llm_utils
+import telemetry
+from agents import agent_list
+from event_log import EventLog
+from export import export_jsonl
+from main import Game, init_game
+from problem_bank import EEDI_DIR, load_bank
+
+
+def load_questions(bank, start=0, limit=None, question_ids=None):
+    """Questions to simulate (ProblemBank.question dicts): a QuestionId list, or a slice of the bank."""
+    if question_ids:
+        question_ids = [i for i in question_ids if i in bank]
+    else:
+        question_ids = bank.ids()[start:start + limit if limit else None]
+    return [bank.question(question_id) for question_id in question_ids]
+
+
+class BatchRun:
+    def __init__(self, out, bank, roster, rounds, seed=0, keep_logs=False):
+        self.out = out
+        self.bank = bank
+        self.roster = roster
+        self.rounds = rounds
+        self.seed = seed
+        self.keep_logs = keep_logs
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(out, "games"), exist_ok=True)
+        self.results_path = os.path.join(out, "results.jsonl")
+        self.finished = self._finished()
+        self.started = time.time()
+        self.completed = 0
+        self.failed = 0
+        self.tokens = 0
+        self.cost = 0.0
+
+    def _finished(self):
+        if not os.path.exists(self.results_path):
+            return set()
+        finished = set()
+        with open(self.results_path) as f:
+            for line in f:
+                try:
+                    finished.add(json.loads(line)["question_id"])
+                except json.JSONDecodeError:
+                    break  # cut short by a crash; that question runs again
+        return finished
+
+    def _game(self, question, log):
+        """A game resumed from its event log, or a new one attached to it."""
+        state, events = log.load()
+        if state is not None:
+            # Drop a round that was cut short; it is played again from its start. The
+            # summary fold and usage of the last finished round stay
+            ends = [i for i, event in enumerate(events) if event["type"] == "round_end"]
+            end = ends[-1] + 1 if ends else 0
+            game = Game.restore(state, events[:end] + [event for event in events[end:]
+                                                       if event["type"] in ("summary", "usage")])
+            print(f"[batch] question {question['question_id']}: resuming after round "
+                  f"{game.rounds_played}")
+        else:
+            game = init_game(self.roster, math_problem=self.bank.problem_text(question["question_id"]),
+                             seed=self.seed * 1000003 + question["question_id"])
+        game.attach_log(log)  # a fresh snapshot, replacing any partial round
+        return game
+
+    @staticmethod
+    def _usage(session_id, earlier, started):
+        """Tokens, cost and seconds of the game: this process's plus those logged before a restart."""
+        usage = telemetry.registry.session(session_id) or {}
+        return {
+            "tokens": earlier.get("tokens", 0) + sum(usage.get("tokens", {}).values()),
+            "cost_usd": earlier.get("cost_usd", 0.0) + usage.get("cost_usd", 0.0),
+            "seconds": round(earlier.get("seconds", 0.0) + time.time() - started, 2),
+        }
+
+    def play(self, question):
+        question_id = question["question_id"]
+        session_id = f"question-{question_id}"
+        telemetry.bind_session(session_id)
+        started = time.time()
+        directory = os.path.join(self.out, "games", str(question_id))
+        log = EventLog(directory)
+        try:
+            game = self._game(question, log)
+            earlier = dict(game.usage)
+            for current_round in range(game.rounds_played + 1, self.rounds + 1):
+                game.run_round(current_round, self.rounds + 1)
+                game.record_usage(**self._usage(session_id, earlier, started))
+                log.sync()
+            final_answers = game.get_final_answers()
+            game.close()
+        finally:
+            log.close()
+        usage = self._usage(session_id, earlier, started)
+        result = {
+            "question_id": question_id,
+            "construct": question["construct"],
+            "subject": question["subject"],
+            "correct_answer": question["correct_answer"],
+            "seed": game.seed,
+            "rounds": self.rounds,
+            "messages": list(game.public_messages),
+            "final_answers": final_answers,
+            **usage,
+        }
+        self._write(session_id, game, result)
+        if not self.keep_logs:
+            shutil.rmtree(directory, ignore_errors=True)
+        return result
+
+    def _write(self, session_id, game, result):
+        """Append the game's events, then its result line, which marks it finished."""
+        with self._lock:
+            with open(os.path.join(self.out, "discussions.jsonl"), "a") as f:
+                f.writelines(export_jsonl([(session_id, game, game.cached_reflections())]))
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.results_path, "a") as f:
+                f.write(json.dumps(result) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.completed += 1
+            self.tokens += result["tokens"]
+            self.cost += result["cost_usd"]
+
+    def summary(self, remaining):
+        elapsed = time.time() - self.started
+        games_per_hour = self.completed / elapsed * 3600 if elapsed else 0.0
+        return {
+            "completed": self.completed,
+            "failed": self.failed,
+            "remaining": remaining,
+            "elapsed_seconds": round(elapsed, 1),
+            "games_per_hour": round(games_per_hour, 2),
+            "tokens_per_game": round(self.tokens / self.completed) if self.completed else None,
+            "cost_usd": round(self.cost, 4),
+            "eta_hours": round(remaining / games_per_hour, 2) if games_per_hour else None,
+        }
+
+    def run(self, questions, games):
+        pending = [q for q in questions if q["question_id"] not in self.finished]
+        print(f"[batch] {len(questions) - len(pending)} of {len(questions)} questions already "
+              f"done, {len(pending)} to run")
+        with ThreadPoolExecutor(max_workers=games, thread_name_prefix="game") as executor:
+            futures = {executor.submit(self.play, question): question for question in pending}
+            # Workers update the counters as they finish, so progress counts the futures handled here
+            for handled, future in enumerate(as_completed(futures), 1):
+                question_id = futures[future]["question_id"]
+                try:
+                    future.result()
+                    error = None
+                except Exception as e:
+                    error = e
+                with self._lock:
+                    if error is not None:
+                        self.failed += 1
+                        print(f"[batch] question {question_id} failed: {error}")
+                    summary = self.summary(len(pending) - self.completed - self.failed)
+                    print(f"[batch] {handled}/{len(pending)} finished ({summary['failed']} failed), "
+                          f"{summary['games_per_hour']} games/h, {summary['tokens_per_game']} tokens/game")
+                    with open(os.path.join(self.out, "summary.json"), "w") as f:
+                        json.dump(summary, f, indent=2)
+        with self._lock:
+            return self.summary(len(pending) - self.completed - self.failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--out", required=True, help="output and checkpoint directory")
+    parser.add_argument("--questions", default=EEDI_DIR,
+                        help="Eedi data directory (train.csv, misconception_mapping.csv)")
+    parser.add_argument("--start", type=int, default=0, help="first question of the slice")
+    parser.add_argument("--limit", type=int, help="number of questions in the slice")
+    parser.add_argument("--question-ids", help="comma-separated QuestionIds (instead of a slice)")
+    parser.add_argument("--roster", help="JSON list of {name, persona} (default: agents.py)")
+    parser.add_argument("--agents", type=int, help="use only the first N students of the roster")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--games", type=int, default=4, help="games played at once")
+    parser.add_argument("--llm-concurrency", type=int,
+                        help="LLM requests in flight per provider, across all games")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep-logs", action="store_true", help="keep finished games' event logs")
+    args = parser.parse_args()
+
+    if args.llm_concurrency:
+        # Semaphores are created on first use, so this must happen before any call
+        for provider in llm_utils.PROVIDER_CONCURRENCY:
+            llm_utils.PROVIDER_CONCURRENCY[provider] = args.llm_concurrency
+    roster = agent_list
+    if args.roster:
+        with open(args.roster) as f:
+            roster = json.load(f)
+    roster = roster[:args.agents] if args.agents else roster
+    question_ids = [int(i) for i in args.question_ids.split(",")] if args.question_ids else None
+    bank = load_bank(args.questions)
+    questions = load_questions(bank, args.start, args.limit, question_ids)
+
+    summary = BatchRun(args.out, bank, roster, args.rounds, args.seed, args.keep_logs).run(
+        questions, args.games)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+End-to-end throughput benchmark of the simulation engine, without API calls.
+
+The LLM clients are replaced by the in-process fakes in fake_llm.py, so
+everything from Game down to the governor runs as in production while each
+request only sleeps for a simulated latency. Every configuration plays a
+full game: setup (task schema, mistakes, character schemas), N rounds,
+final answers and /download_log, and reports rounds/sec, turn latency
+percentiles and peak traced memory.
+
+    python benchmarks/bench_game.py [--agents 3,6,12] [--rounds 3,6] [--ttft 0.3]
+        [--tokens-per-sec 60] [--responses recorded.jsonl] [--stream] [--json] [--verbose]
+
+Runs without settings.py; a real one is used when present but never called.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# Every game should pay for its own setup rather than hit the schema cache
+os.environ.setdefault("SCHEMA_CACHE_DISABLED", "1")
+
+import fake_llm  # noqa: E402
+
+fake_llm.ensure_offline_settings()
+
+import llm_utils  # noqa: E402
+from main import SESSION_COOKIE, app, init_game, sessions  # noqa: E402
+from agents import agent_list  # noqa: E402
+
+
+def roster(size):
+    """`size` students drawn from the default roster, renamed when repeated."""
+    students = []
+    for i in range(size):
+        agent = agent_list[i % len(agent_list)]
+        suffix = f" {i // len(agent_list) + 1}" if i >= len(agent_list) else ""
+        students.append({"name": agent["name"] + suffix, "persona": agent["persona"]})
+    return students
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def play(agents, rounds, stream=False):
+    """Play one full game; returns its timings and counters."""
+    llm_utils._character_schemas.clear()
+    turn_latencies = []
+    started = {}
+
+    def on_event(event, data):
+        if event == "turn_start":
+            started[data["name"]] = time.perf_counter()
+        elif event == "turn_end":
+            turn_latencies.append(time.perf_counter() - started.pop(data["name"]))
+
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    game = init_game(roster(agents))
+    setup = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for current_round in range(1, rounds + 1):
+        if stream:
+            game.run_round(current_round, rounds + 1, on_event=on_event)
+        else:
+            round_start = time.perf_counter()
+            data = game.run_round(current_round, rounds + 1)
+            # Without streaming only the whole round is observable
+            turn_latencies += [(time.perf_counter() - round_start) / len(data)] * len(data)
+    round_seconds = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    game.get_final_answers()
+    final_answers = time.perf_counter() - t0
+
+    session = sessions.get(None)
+    session.game = game
+    t0 = time.perf_counter()
+    with app.test_client() as client:
+        client.set_cookie(SESSION_COOKIE, session.id)
+        log = client.get("/download_log")
+        assert log.status_code == 200 and log.mimetype == "text/plain", log.get_data(as_text=True)
+    download = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    game.close()
+    return {
+        "setup_s": setup,
+        "rounds_per_s": rounds / round_seconds,
+        "turn_p50_s": percentile(turn_latencies, 50),
+        "turn_p95_s": percentile(turn_latencies, 95),
+        "final_answers_s": final_answers,
+        "download_log_s": download,
+        "peak_mb": peak / 2 ** 20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--agents", default="3,6", help="comma-separated roster sizes")
+    parser.add_argument("--rounds", default="3,6", help="comma-separated round counts")
+    parser.add_argument("--repeat", type=int, default=1, help="games per configuration")
+    parser.add_argument("--ttft", type=float, default=0.3, help="median seconds to first token")
+    parser.add_argument("--sigma", type=float, default=0.5, help="lognormal spread of time to first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=60.0)
+    parser.add_argument("--responses", help="JSONL of recorded {kind, response} outputs")
+    parser.add_argument("--stream", action="store_true", help="stream turns (per-turn latency)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    parser.add_argument("--verbose", action="store_true", help="keep the pipeline's own output")
+    args = parser.parse_args()
+
+    responder = (fake_llm.Responder.from_file(args.responses, args.seed) if args.responses
+                 else fake_llm.Responder(seed=args.seed))
+    backend = fake_llm.FakeBackend(fake_llm.LatencyModel(args.ttft, args.sigma, args.tokens_per_sec,
+                                                         args.seed), responder)
+    fake_llm.install(llm_utils, backend)
+    random.seed(args.seed)
+
+    results = []
+    for agents in [int(n) for n in args.agents.split(",")]:
+        for rounds in [int(n) for n in args.rounds.split(",")]:
+            for _ in range(args.repeat):
+                calls, tokens = backend.calls, backend.prompt_tokens + backend.completion_tokens
+                with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+                    result = play(agents, rounds, args.stream)
+                result.update(agents=agents, rounds=rounds, llm_calls=backend.calls - calls,
+                              tokens=backend.prompt_tokens + backend.completion_tokens - tokens)
+                results.append(result)
+
+    if args.json:
+        for result in results:
+            print(json.dumps({key: round(value, 4) if isinstance(value, float) else value
+                              for key, value in result.items()}))
+        return
+    header = (f"{'agents':>6} {'rounds':>6} {'setup s':>8} {'rounds/s':>9} {'turn p50':>9} "
+              f"{'turn p95':>9} {'final s':>8} {'log s':>7} {'calls':>6} {'peak MB':>8}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['agents']:>6} {r['rounds']:>6} {r['setup_s']:>8.2f} {r['rounds_per_s']:>9.3f} "
+              f"{r['turn_p50_s']:>9.3f} {r['turn_p95_s']:>9.3f} {r['final_answers_s']:>8.2f} "
+              f"{r['download_log_s']:>7.2f} {r['llm_calls']:>6} {r['peak_mb']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
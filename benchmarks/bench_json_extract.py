@@ -0,0 +1,154 @@
+"""
+Micro-benchmark: json_extract.extract_json against the previous parse_json.
+
+The built-in corpus wraps schema-shaped documents in the ways model outputs
+actually arrive (fences, prose, trailing commas, escaped quotes, truncation).
+Recorded responses can be added with --corpus, a JSONL file with one
+{"response": ..., "target_keys": [...]} object per line (target_keys optional).
+
+    python benchmarks/bench_json_extract.py [--corpus responses.jsonl] [--repeat 200]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from json_extract import extract_json
+
+
+def legacy_parse_json(response, target_keys=None):
+    """parse_json as it was before json_extract, kept here for comparison."""
+    json_start = response.find('{')
+    json_end = response.rfind('}') + 1
+    if json_start == -1 or json_end == -1:
+        return {}
+    cleaned_response = response[json_start:json_end].replace('\\"', '"')
+    try:
+        parsed = json.loads(cleaned_response)
+        if target_keys:
+            parsed = {key: parsed.get(key, "") for key in target_keys}
+        return parsed
+    except json.JSONDecodeError:
+        pass
+    parsed = {}
+    try:
+        for match in re.finditer(r'"(\w+)":\s*(?:(\{.*?\})|"(.*?)"|([^,}]+))', cleaned_response, re.DOTALL):
+            key = match.group(1)
+            if target_keys and key not in target_keys:
+                continue
+            if match.group(2):
+                try:
+                    parsed[key] = json.loads(match.group(2))
+                except json.JSONDecodeError:
+                    parsed[key] = {}
+            elif match.group(3):
+                parsed[key] = match.group(3)
+            elif match.group(4):
+                parsed[key] = match.group(4).strip()
+    except Exception:
+        pass
+    return parsed
+
+
+def new_parse_json(response, target_keys=None):
+    value = extract_json(response, target_keys).value
+    if not isinstance(value, dict):
+        return {}
+    if target_keys:
+        value = {key: value.get(key, "") for key in target_keys}
+    return value
+
+
+def _task_schema(n_tasks):
+    return {
+        f"task {i}": {
+            "description": f"Work out part {i} of the problem, e.g. {{x}} = {i} * 3.",
+            "steps": [f"Step {j}: rewrite the expression and simplify" for j in range(1, 5)],
+            "knowledge": {"concept": "fractions", "prerequisites": ["division", "multiplication"]},
+            "correct": i % 2 == 0,
+        }
+        for i in range(1, n_tasks + 1)
+    }
+
+
+def builtin_corpus():
+    """(name, response, target_keys) triples."""
+    reflection = {"schema_updated": True, "learning_progress": "Now sees why the \"common denominator\" matters.",
+                  "errors_made": ["added denominators"], "remaining_gaps": "none"}
+    reflection_keys = list(reflection)
+    cases = []
+    for size in (3, 12, 40):
+        doc = json.dumps(_task_schema(size), indent=2)
+        cases += [
+            (f"plain-{size}", doc, None),
+            (f"fenced-{size}", f"Here is the schema:\n```json\n{doc}\n```\nLet me know if you need changes.", None),
+            (f"prose-{size}", f"Sure. {doc} I hope this {{helps}}.", None),
+            (f"trailing-comma-{size}", doc.replace("]\n", "],\n").replace("}\n}", "},\n}"), None),
+            (f"truncated-{size}", doc[: int(len(doc) * 0.8)], None),
+        ]
+    flat = json.dumps(reflection)
+    cases += [
+        ("reflection", flat, reflection_keys),
+        ("reflection-escaped", flat.replace('"', '\\"'), reflection_keys),
+        ("reflection-python", flat.replace("true", "True"), reflection_keys),
+        ("reflection-truncated", flat[:-25], reflection_keys),
+        ("nested-update", json.dumps({"reflection": reflection, "updated_character_schema": _task_schema(8)}),
+         ["reflection", "updated_character_schema"]),
+    ]
+    return cases
+
+
+def load_corpus(path):
+    cases = []
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if line.strip():
+                record = json.loads(line)
+                cases.append((f"corpus-{i}", record["response"], record.get("target_keys")))
+    return cases
+
+
+def _keys_found(parsed, response, target_keys):
+    if target_keys:
+        return sum(1 for key in target_keys if parsed.get(key, "") != "")
+    return len(parsed)
+
+
+def _time(fn, response, target_keys, repeat):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            parsed = fn(response, target_keys)
+        elapsed = time.perf_counter() - start
+    return elapsed / repeat, parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--corpus", help="JSONL file of recorded model responses")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    cases = builtin_corpus() + (load_corpus(args.corpus) if args.corpus else [])
+    print(f"{'case':<24}{'chars':>8}{'legacy us':>12}{'new us':>10}{'legacy keys':>13}{'new keys':>10}")
+    totals = [0.0, 0.0, 0, 0]
+    for name, response, target_keys in cases:
+        legacy_time, legacy = _time(legacy_parse_json, response, target_keys, args.repeat)
+        new_time, new = _time(new_parse_json, response, target_keys, args.repeat)
+        legacy_keys = _keys_found(legacy, response, target_keys)
+        new_keys = _keys_found(new, response, target_keys)
+        totals = [totals[0] + legacy_time, totals[1] + new_time, totals[2] + legacy_keys, totals[3] + new_keys]
+        print(f"{name:<24}{len(response):>8}{legacy_time * 1e6:>12.1f}{new_time * 1e6:>10.1f}"
+              f"{legacy_keys:>13}{new_keys:>10}")
+    print(f"{'total':<24}{'':>8}{totals[0] * 1e6:>12.1f}{totals[1] * 1e6:>10.1f}{totals[2]:>13}{totals[3]:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+In-process stand-ins for the OpenAI and Anthropic async clients.
+
+install() swaps llm_utils.aoai/aant for fakes, so everything above the
+clients (router, governor, structured outputs, streaming, telemetry) runs
+exactly as in production. Each fake request sleeps for a time-to-first-token
+drawn from a lognormal distribution plus completion tokens at a fixed
+rate, and answers with a canned output of the right shape: recorded
+responses when given, synthetic ones otherwise. Everything is seeded.
+"""
+
+import asyncio
+import json
+import math
+import random
+import re
+import sys
+import types
+from types import SimpleNamespace
+
+TASKS = ["task 1", "task 2", "task 3"]
+
+
+def ensure_offline_settings():
+    """llm_utils reads API keys from settings.py; offline runs need none."""
+    try:
+        import settings  # noqa: F401
+    except ImportError:
+        offline = types.ModuleType("settings")
+        offline.OPENAI_API_KEY = "offline"
+        sys.modules["settings"] = offline
+
+
+def _tokens(text):
+    return max(1, len(text) // 4)
+
+
+class LatencyModel:
+    """Lognormal time to first token (median `ttft` seconds) plus `tokens_per_sec` decoding."""
+
+    def __init__(self, ttft=0.3, sigma=0.5, tokens_per_sec=60.0, seed=0):
+        self.ttft = ttft
+        self.sigma = sigma
+        self.tokens_per_sec = tokens_per_sec
+        self.rng = random.Random(seed)
+
+    def first_token(self):
+        if self.ttft <= 0:
+            return 0.0
+        return self.rng.lognormvariate(math.log(self.ttft), self.sigma)
+
+    def per_token(self):
+        return 1.0 / self.tokens_per_sec if self.tokens_per_sec > 0 else 0.0
+
+
+class Responder:
+    """
+    Canned outputs by kind: a tool name for structured calls, "turn",
+    "summary" or "text" for plain completions. Recorded responses are JSONL
+    lines of {"kind": ..., "response": ...}; kinds without recordings get
+    synthetic outputs.
+    """
+
+    def __init__(self, recorded=None, seed=0):
+        self.recorded = {}
+        self.rng = random.Random(seed)
+        for record in recorded or []:
+            self.recorded.setdefault(record["kind"], []).append(record["response"])
+
+    @classmethod
+    def from_file(cls, path, seed=0):
+        with open(path) as f:
+            return cls([json.loads(line) for line in f if line.strip()], seed)
+
+    def text(self, prompt):
+        kind = "turn" if "Reasoning:" in prompt else "summary" if "running summary" in prompt.lower() else "text"
+        if kind in self.recorded:
+            return self.rng.choice(self.recorded[kind])
+        if kind == "turn":
+            step = self.rng.choice(["factor the numerator", "cancel the common factor",
+                                    "check the restriction", "rewrite the fraction"])
+            return (f"Reasoning: My schema says to {step} next.\n"
+                    f"Message: I think we should {step} - does that work for everyone?")
+        if kind == "summary":
+            return "The group factored the numerator and is checking which factors cancel."
+        return "They worked step by step and corrected one sign error along the way."
+
+    def tool(self, name, prompt):
+        if name in self.recorded:
+            return self.rng.choice(self.recorded[name])
+        task = lambda i: {"description": f"Step {i} of the problem", "steps": ["Do it", "Check it"],
+                          "variables": {"x": str(i)}}
+        character = {t: dict(task(i), student_approach="I'll try it the way I remember.")
+                     for i, t in enumerate(TASKS, 1)}
+        reflection = {"errors_made": ["sign error"], "learning_progress": "Now checks signs.",
+                      "schema_updated": self.rng.random() < 0.5, "update_reason": "Was corrected."}
+        changes = {"modified_task": "task 1", "old_value": "", "new_value": "checks signs",
+                   "update_reason": "Was corrected.", "mistakes_addressed": ["sign error"]}
+        patch = [{"op": "replace", "path": "/task 1/student_approach", "value": "I'll check the signs first."}]
+        if name == "submit_task_schema":
+            return {t: task(i) for i, t in enumerate(TASKS, 1)}
+        if name == "submit_potential_mistakes":
+            return {t: {"common_misunderstandings": ["cancels terms, not factors"],
+                        "variable_or_calculation_mistakes": ["sign error"],
+                        "reasoning_missteps": ["forgets the restriction"]} for t in TASKS}
+        if name == "submit_character_schema":
+            return character
+        if name == "submit_roster_schemas":
+            block = prompt.split("Students:", 1)[-1].split("Task Schema:", 1)[0]
+            students = re.findall(r"^\s*- ([^:\n]+):", block, re.M)
+            return {student: character for student in students}
+        if name == "submit_reflection":
+            return reflection
+        if name in ("submit_full_regeneration", "submit_full_schema_update"):
+            return dict(reflection, schema=character, changes=changes)
+        if name in ("submit_patch_regeneration", "submit_patch_schema_update"):
+            return dict(reflection, patch=patch, changes=changes)
+        return {}
+
+
+class FakeBackend:
+    """Shared latency model, responder and call counters for both fake clients."""
+
+    def __init__(self, latency=None, responder=None):
+        self.latency = latency or LatencyModel()
+        self.responder = responder or Responder()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def answer(self, messages, tools):
+        prompt = "\n".join(str(m.get("content", "")) for m in messages)
+        self.calls += 1
+        self.prompt_tokens += _tokens(prompt)
+        if tools:
+            name = tools[0]["function"]["name"] if "function" in tools[0] else tools[0]["name"]
+            output = self.responder.tool(name, prompt)
+            text = json.dumps(output)
+        else:
+            name, output = None, None
+            text = self.responder.text(prompt)
+        self.completion_tokens += _tokens(text)
+        return name, output, text, _tokens(prompt), _tokens(text)
+
+    async def wait(self, completion_tokens):
+        await asyncio.sleep(self.latency.first_token() + completion_tokens * self.latency.per_token())
+
+    async def deltas(self, text, chunk_chars=12):
+        await asyncio.sleep(self.latency.first_token())
+        for i in range(0, len(text), chunk_chars):
+            await asyncio.sleep(_tokens(text[i:i + chunk_chars]) * self.latency.per_token())
+            yield text[i:i + chunk_chars]
+
+
+class _FakeOpenAICompletions:
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def create(self, model, messages, temperature=1, max_tokens=1000, tools=None,
+                     tool_choice=None, stream=False, stream_options=None):
+        name, _, text, prompt_tokens, completion_tokens = self.backend.answer(messages, tools)
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        if stream:
+            return self._stream(text, usage if stream_options else None)
+        await self.backend.wait(completion_tokens)
+        if name:
+            call = SimpleNamespace(function=SimpleNamespace(name=name, arguments=text))
+            message = SimpleNamespace(content=None, tool_calls=[call])
+        else:
+            message = SimpleNamespace(content=text, tool_calls=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+    async def _stream(self, text, usage):
+        async for delta in self.backend.deltas(text):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))],
+                                  usage=None)
+        if usage is not None:
+            yield SimpleNamespace(choices=[], usage=usage)
+
+
+class _FakeAnthropicMessages:
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def create(self, model, messages, max_tokens=1000, temperature=1, system=None,
+                     tools=None, tool_choice=None, stream=False):
+        if system:
+            messages = [{"role": "system", "content": system}] + list(messages)
+        name, output, text, prompt_tokens, completion_tokens = self.backend.answer(messages, tools)
+        if stream:
+            return self._stream(text, prompt_tokens, completion_tokens)
+        await self.backend.wait(completion_tokens)
+        usage = SimpleNamespace(input_tokens=prompt_tokens, output_tokens=completion_tokens)
+        if name:
+            block = SimpleNamespace(type="tool_use", name=name, input=output)
+        else:
+            block = SimpleNamespace(type="text", text=text)
+        return SimpleNamespace(content=[block], usage=usage)
+
+    async def _stream(self, text, prompt_tokens, completion_tokens):
+        yield SimpleNamespace(type="message_start",
+                              message=SimpleNamespace(usage=SimpleNamespace(input_tokens=prompt_tokens)))
+        async for delta in self.backend.deltas(text):
+            yield SimpleNamespace(type="content_block_delta",
+                                  delta=SimpleNamespace(type="text_delta", text=delta))
+        yield SimpleNamespace(type="message_delta", usage=SimpleNamespace(output_tokens=completion_tokens))
+
+
+def install(llm_utils, backend):
+    """Point llm_utils' async clients at `backend`; returns the previous clients."""
+    previous = (llm_utils.aoai, llm_utils.aant)
+    llm_utils.aoai = SimpleNamespace(chat=SimpleNamespace(completions=_FakeOpenAICompletions(backend)))
+    llm_utils.aant = SimpleNamespace(messages=_FakeAnthropicMessages(backend))
+    return previous
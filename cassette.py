@@ -0,0 +1,165 @@
+"""
+Record and replay of LLM responses.
+
+In record mode every request's response is appended to a JSONL cassette,
+keyed by a hash of the request (provider, model, temperature, messages and
+the forced tool, if any). In replay mode responses are served from the
+cassette instead of the provider, so a recorded session can be re-run
+instantly and without cost.
+
+Match policies for replay:
+    strict   the whole request must match; a miss raises CassetteMiss
+    lenient  provider, model and temperature are ignored, and a miss goes to
+             the live model, whose response is appended to the cassette
+
+A request made several times (e.g. the same prompt at temperature 1) is
+answered with its recorded responses in order, the last one repeating.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import defaultdict
+from contextlib import aclosing
+
+MODES = ("off", "record", "replay")
+POLICIES = ("strict", "lenient")
+MISSING = object()
+
+
+class CassetteMiss(LookupError):
+    """No recorded response for a request in strict replay."""
+
+
+def request_keys(provider, model, temperature, messages, tool=None):
+    """(strict, lenient) hashes of one request."""
+    conversation = [[message["role"], message["content"]] for message in messages]
+    loose = json.dumps({"messages": conversation, "tool": tool}, sort_keys=True)
+    exact = json.dumps({"provider": provider, "model": model, "temperature": temperature,
+                        "messages": conversation, "tool": tool}, sort_keys=True)
+    return (hashlib.sha256(exact.encode()).hexdigest()[:32],
+            hashlib.sha256(loose.encode()).hexdigest()[:32])
+
+
+class Cassette:
+    def __init__(self, path=None, mode="off", policy="strict"):
+        if mode not in MODES:
+            raise ValueError(f"cassette mode must be one of {MODES}, not {mode!r}")
+        if policy not in POLICIES:
+            raise ValueError(f"cassette policy must be one of {POLICIES}, not {policy!r}")
+        if mode != "off" and not path:
+            raise ValueError(f"cassette mode {mode!r} needs a cassette path")
+        self.path = path
+        self.mode = mode
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self._responses = {"strict": defaultdict(list), "lenient": defaultdict(list)}
+        self._served = defaultdict(int)
+        self._lock = threading.Lock()
+        self._file = None
+        if mode == "replay":
+            self._load()
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.getenv("LLM_CASSETTE"), os.getenv("LLM_CASSETTE_MODE", "off"),
+                   os.getenv("LLM_CASSETTE_MATCH", "strict"))
+
+    @property
+    def active(self):
+        return self.mode != "off"
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # a write cut short by a crash; everything before it is intact
+                self._index(entry)
+
+    def _index(self, entry):
+        self._responses["strict"][entry["key"]].append(entry["response"])
+        self._responses["lenient"][entry["loose"]].append(entry["response"])
+
+    def _append(self, keys, provider, model, response):
+        entry = {"key": keys[0], "loose": keys[1], "provider": provider, "model": model,
+                 "response": response}
+        with self._lock:
+            if self._file is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._file = open(self.path, "a")
+            self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            self._file.flush()
+            self._index(entry)
+            self.recorded += 1
+
+    def lookup(self, keys):
+        """The next recorded response for a request, or MISSING."""
+        key = keys[0] if self.policy == "strict" else keys[1]
+        with self._lock:
+            responses = self._responses[self.policy].get(key)
+            if not responses:
+                self.misses += 1
+                return MISSING
+            served = self._served[(self.policy, key)]
+            self._served[(self.policy, key)] = served + 1
+            self.hits += 1
+            return responses[min(served, len(responses) - 1)]
+
+    async def play(self, provider, model, temperature, messages, live, tool=None):
+        """Await live() for the response, unless the cassette has it; records in record mode."""
+        if not self.active:
+            return await live()
+        keys = request_keys(provider, model, temperature, messages, tool)
+        if self.mode == "replay":
+            response = self.lookup(keys)
+            if response is not MISSING:
+                return response
+            if self.policy == "strict":
+                raise CassetteMiss(f"no recorded {provider}/{model} response for request {keys[0]}")
+        response = await live()
+        self._append(keys, provider, model, response)
+        return response
+
+    async def stream(self, provider, model, temperature, messages, live):
+        """Yield live() deltas, or the recorded text as one delta on replay."""
+        if not self.active:
+            async with aclosing(live()) as deltas:
+                async for delta in deltas:
+                    yield delta
+            return
+        keys = request_keys(provider, model, temperature, messages)
+        if self.mode == "replay":
+            response = self.lookup(keys)
+            if response is not MISSING:
+                yield response
+                return
+            if self.policy == "strict":
+                raise CassetteMiss(f"no recorded {provider}/{model} response for request {keys[0]}")
+        text = []
+        async with aclosing(live()) as deltas:
+            async for delta in deltas:
+                text.append(delta)
+                yield delta
+        # Only finished streams are recorded
+        self._append(keys, provider, model, "".join(text))
+
+    def snapshot(self):
+        return {"mode": self.mode, "policy": self.policy, "path": self.path,
+                "hits": self.hits, "misses": self.misses, "recorded": self.recorded}
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,94 @@
+import os
+
+# Per-call prompt budget and the share of it reserved for the rolling summary
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "300"))
+MIN_DISCUSSION_TOKENS = 500
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token for English text)."""
+    return (len(text) + 3) // 4
+
+
+def section_usage(sections):
+    """Estimated tokens used by each named prompt section, plus the total."""
+    usage = {name: estimate_tokens(str(text)) for name, text in sections.items()}
+    usage["total"] = sum(usage.values())
+    return usage
+
+
+class DiscussionContext:
+    """
+    Token-budgeted view of a Transcript.
+
+    The most recent messages are kept verbatim; older ones are folded into a
+    rolling summary by `summarize(previous_summary, lines)`. Folding happens
+    in end_round(), so there is at most one summary call per round no matter
+    how many prompts render the context. With a summarizer, render() keeps
+    every message that is not in the summary yet, so a prompt never leaves
+    out a message the summary lacks; end_round() leaves `reserve` tokens free
+    for the turns of the next round so those prompts still fit the budget.
+    """
+
+    def __init__(self, transcript, summarize=None, budget=PROMPT_TOKEN_BUDGET,
+                 summary_budget=SUMMARY_TOKEN_BUDGET):
+        self.transcript = transcript
+        self.summarize = summarize
+        self.budget = budget
+        self.summary_budget = summary_budget
+        self.summary = ""
+        self.summarized_count = 0
+
+    def _window_start(self, budget):
+        """Index of the oldest unsummarized message that fits in `budget`."""
+        lines = self.transcript.lines
+        start, used = len(lines), 0
+        while start > self.summarized_count:
+            cost = estimate_tokens(lines[start - 1]) + 1
+            if used + cost > budget:
+                break
+            used += cost
+            start -= 1
+        return start
+
+    def end_round(self, budget=None, reserve=0):
+        """
+        Fold messages that no longer fit the verbatim window of `budget` into
+        the summary, keeping `reserve` tokens free for messages still to come.
+        """
+        budget = self.budget if budget is None else budget
+        start = self._window_start(max(0, budget - self.summary_budget - reserve))
+        if start <= self.summarized_count or self.summarize is None:
+            return
+        folded = self.transcript.lines[self.summarized_count:start]
+        try:
+            self.summary = self.summarize(self.summary, folded)
+            self.summarized_count = start
+        except Exception as e:
+            print(f"Error summarizing discussion: {e}")
+
+    def render(self, budget=None):
+        """
+        Header, rolling summary and recent messages. Without a summarizer only
+        as many recent messages as fit in `budget` are kept; with one, every
+        message after the summary is kept, since folding is end_round()'s job.
+        Returns (text, usage) where usage reports tokens per section.
+        """
+        budget = self.budget if budget is None else budget
+        summary = f"Summary of earlier discussion: {self.summary}\n" if self.summary else ""
+        if self.summarize is not None:
+            start = self.summarized_count
+        else:
+            start = self._window_start(budget)
+        omitted = start - self.summarized_count
+        note = f"({omitted} earlier messages omitted)\n" if omitted else ""
+        recent = "\n".join(self.transcript.lines[start:])
+        sections = {
+            "header": self.transcript.header,
+            "summary": summary + note,
+            "recent": recent,
+        }
+        usage = section_usage(sections)
+        usage["recent_messages"] = len(self.transcript.lines) - start
+        return "".join(sections.values()), usage
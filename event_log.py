@@ -0,0 +1,178 @@
+"""
+Append-only event log of a game's state changes, with snapshots.
+
+Each game writes its events (messages, schema revisions, reflections, round
+ends) to JSONL segment files in its own directory. Writes are flushed at
+once but fsynced in batches, every `fsync_every` events or `fsync_interval`
+seconds, and on sync(). Every `snapshot_every` events the caller writes a
+compact snapshot of the whole state. A new segment then starts, and the
+segments the snapshot covers are deleted. Loading reads the snapshot plus
+the events after it, so resuming a long game only costs its recent events.
+
+A log has one writer at a time. Sessions move between processes by handing
+the log over, not by writing it from two places at once.
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+
+EVENT_LOG_DIR = os.getenv("EVENT_LOG_DIR", "")
+EVENT_LOG_FSYNC_EVERY = int(os.getenv("EVENT_LOG_FSYNC_EVERY", "32"))
+EVENT_LOG_FSYNC_INTERVAL = float(os.getenv("EVENT_LOG_FSYNC_INTERVAL", "1.0"))
+EVENT_LOG_SNAPSHOT_EVERY = int(os.getenv("EVENT_LOG_SNAPSHOT_EVERY", "200"))
+
+SNAPSHOT = "snapshot.json"
+
+
+def write_atomic(path, data):
+    """Replace `path` with `data` (JSON) so readers see either the old or the new file."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class EventLog:
+    """The event log in `directory`; picks up after whatever is already there."""
+
+    def __init__(self, directory, fsync_every=EVENT_LOG_FSYNC_EVERY,
+                 fsync_interval=EVENT_LOG_FSYNC_INTERVAL, snapshot_every=EVENT_LOG_SNAPSHOT_EVERY):
+        self.directory = directory
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        snapshot = self._read_snapshot()
+        snapshot_seq = snapshot["seq"] if snapshot else 0
+        tail = self._read_tail(snapshot_seq)
+        self.seq = tail[-1]["seq"] if tail else snapshot_seq
+        self.since_snapshot = len(tail)
+
+    def _segments(self):
+        names = [name for name in os.listdir(self.directory)
+                 if name.startswith("events-") and name.endswith(".jsonl")]
+        return [os.path.join(self.directory, name) for name in sorted(names)]
+
+    def _read_snapshot(self):
+        path = os.path.join(self.directory, SNAPSHOT)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _read_tail(self, after):
+        events = []
+        for path in self._segments():
+            with open(path) as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # a write cut short by a crash; it was never acknowledged
+                    if event["seq"] > after:
+                        events.append(event)
+        return events
+
+    def load(self):
+        """(snapshot state or None, [events after the snapshot])."""
+        with self._lock:
+            snapshot = self._read_snapshot()
+            after = snapshot["seq"] if snapshot else 0
+            return (snapshot["state"] if snapshot else None), self._read_tail(after)
+
+    def append(self, kind, data):
+        with self._lock:
+            self.seq += 1
+            if self._file is None:
+                path = os.path.join(self.directory, f"events-{self.seq:012d}.jsonl")
+                self._file = open(path, "a")
+            self._file.write(json.dumps({"seq": self.seq, "type": kind, "data": data},
+                                        separators=(",", ":")) + "\n")
+            self._file.flush()
+            self._unsynced += 1
+            self.since_snapshot += 1
+            if (self._unsynced >= self.fsync_every
+                    or time.monotonic() - self._last_sync >= self.fsync_interval):
+                self._sync()
+            return self.seq
+
+    def _sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def snapshot_due(self):
+        return self.since_snapshot >= self.snapshot_every
+
+    def write_snapshot(self, state):
+        """Persist `state` as of the last event and drop the segments it replaces."""
+        with self._lock:
+            self._sync()
+            write_atomic(os.path.join(self.directory, SNAPSHOT), {"seq": self.seq, "state": state})
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            for path in self._segments():
+                os.remove(path)
+            self.since_snapshot = 0
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class EventLogStore:
+    """
+    One EventLog directory per session under `root`. open() always reads the
+    log from disk, since another process may have written to it since this
+    one last did; the open writer logs are kept only to be closed.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._logs = {}
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, session_id):
+        return os.path.join(self.root, session_id)
+
+    def open(self, session_id):
+        """A writer for the session's log, replacing any this process had open."""
+        log = EventLog(self.path(session_id))
+        with self._lock:
+            previous = self._logs.pop(session_id, None)
+            self._logs[session_id] = log
+        if previous is not None:
+            previous.close()
+        return log
+
+    def release(self, session_id):
+        with self._lock:
+            log = self._logs.pop(session_id, None)
+        if log is not None:
+            log.close()
+
+    def ids(self):
+        return [name for name in os.listdir(self.root) if os.path.isdir(self.path(name))]
+
+    def delete(self, session_id):
+        self.release(session_id)
+        shutil.rmtree(self.path(session_id), ignore_errors=True)
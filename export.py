@@ -0,0 +1,169 @@
+"""
+Streaming export of finished discussions.
+
+Every exporter is a generator of str chunks, so a response can be sent as
+it is produced rather than built in memory first, and sessions are read
+one at a time. Formats:
+
+    text      the human-readable discussion log
+    jsonl     one JSON event per line: session, participant, message,
+              schema_change, learning_progress, reflection
+    column_groups
+              still JSON lines, not a binary columnar format: the same
+              events in groups of column arrays, with the repetitive
+              columns dictionary-encoded so they are much smaller than
+              jsonl; read_column_groups() turns each group back into
+              {column: [values]} (e.g. for pandas.DataFrame)
+"""
+
+import json
+import os
+
+EXPORT_ROW_GROUP = int(os.getenv("EXPORT_ROW_GROUP", "1000"))
+COLUMNS = ("session_id", "seq", "type", "agent", "text", "data")
+# Few distinct values repeated on every row
+DICTIONARY_COLUMNS = ("session_id", "type", "agent")
+
+FORMATS = {
+    "text": ("text/plain", "txt"),
+    "jsonl": ("application/x-ndjson", "jsonl"),
+    "column_groups": ("application/x-ndjson", "column_groups.jsonl"),
+}
+
+
+def text_log(game, reflections):
+    """The discussion log of one game, in chunks."""
+    rule = "=" * 50 + "\n\n"
+    yield "MATH DISCUSSION LOG\n" + rule
+    yield f"MATH PROBLEM:\n{game.math_problem}\n\n"
+    yield f"SEED: {game.seed}\n\n"
+
+    yield "PARTICIPANTS:\n"
+    for agent in game.agents:
+        yield (f"{agent.name}:\n"
+               f"  Persona: {agent.persona}\n"
+               f"  Initial Character Schema: {json.dumps(agent.character_schema, indent=2)}\n\n")
+
+    yield "DISCUSSION AND MESSAGES:\n" + rule
+    for i, message in enumerate(game.public_messages):
+        yield f"[{i + 1}] {message}\n"
+
+    yield "\nSCHEMA UPDATES AND REFLECTIONS:\n" + rule
+    for agent in game.agents:
+        chunk = f"Agent: {agent.name}\n"
+        changes = getattr(agent, 'schema_changes', None)
+        if changes:
+            chunk += ("  Schema Changes:\n"
+                      f"    Reason: {changes.get('update_reason', 'No reason provided')}\n"
+                      f"    Mistakes Addressed: {', '.join(changes.get('mistakes_addressed', []))}\n"
+                      "    Changes:\n"
+                      + json.dumps(changes, indent=2) + "\n")
+        else:
+            chunk += "  No schema changes recorded.\n"
+        if getattr(agent, 'learning_progress', None):
+            chunk += f"  Learning Progress:\n    {agent.learning_progress}\n"
+        yield chunk + "\n"
+
+    yield "FINAL REFLECTIONS:\n" + rule
+    for agent in game.agents:
+        if agent.name in reflections:
+            yield f"Reflection for {agent.name}:\n{reflections[agent.name]}\n\n"
+
+
+def events(game, reflections, session_id=None):
+    """One game as a sequence of event dicts."""
+    def event(kind, agent=None, text=None, **data):
+        return {"session_id": session_id, "type": kind, "agent": agent, "text": text,
+                "data": data or None}
+
+    yield event("session", text=game.math_problem, seed=game.seed, agents=len(game.agents),
+                messages=len(game.public_messages))
+    for agent in game.agents:
+        yield event("participant", agent.name, agent.persona, schema=agent.character_schema)
+    for i, message in enumerate(game.public_messages):
+        # Transcript lines are "<speaker>: <message>"
+        speaker = game.transcript.speaker(i)
+        yield event("message", speaker, message[len(speaker) + 2:], index=i)
+    for agent in game.agents:
+        for revision in agent.schema_history[1:]:
+            yield event("schema_change", agent.name, revision["changes"].get("update_reason", ""),
+                        version=revision["version"], source=revision["source"],
+                        changes=revision["changes"])
+        if getattr(agent, 'learning_progress', None):
+            yield event("learning_progress", agent.name, agent.learning_progress)
+    for agent in game.agents:
+        if agent.name in reflections:
+            yield event("reflection", agent.name, reflections[agent.name])
+
+
+def _numbered(games):
+    for session_id, game, reflections in games:
+        for seq, item in enumerate(events(game, reflections, session_id)):
+            item["seq"] = seq
+            yield item
+
+
+def export_text(games):
+    """`games` is an iterable of (session_id, game, reflections)."""
+    for i, (session_id, game, reflections) in enumerate(games):
+        if i:
+            yield "\n\n"
+        if session_id is not None:
+            yield f"SESSION: {session_id}\n"
+        yield from text_log(game, reflections)
+
+
+def export_jsonl(games):
+    for item in _numbered(games):
+        yield json.dumps({column: item[column] for column in COLUMNS}) + "\n"
+
+
+def _encode_group(rows):
+    columns = {}
+    for column in COLUMNS:
+        values = [row[column] for row in rows]
+        if column in DICTIONARY_COLUMNS:
+            dictionary = list(dict.fromkeys(values))
+            codes = {value: code for code, value in enumerate(dictionary)}
+            columns[column] = {"dictionary": dictionary, "codes": [codes[v] for v in values]}
+        else:
+            columns[column] = values
+    return json.dumps({"rows": len(rows), "columns": columns}, separators=(",", ":")) + "\n"
+
+
+def export_column_groups(games, row_group=EXPORT_ROW_GROUP):
+    """A header line, then one line per group of up to `row_group` events."""
+    yield json.dumps({"format": "simteach-column-groups", "version": 1, "columns": COLUMNS}) + "\n"
+    rows = []
+    for item in _numbered(games):
+        rows.append(item)
+        if len(rows) >= row_group:
+            yield _encode_group(rows)
+            rows = []
+    if rows:
+        yield _encode_group(rows)
+
+
+def read_column_groups(lines):
+    """Decode export_column_groups output into {column: [values]} per group."""
+    lines = iter(lines)
+    header = json.loads(next(lines))
+    for line in lines:
+        group = json.loads(line)
+        columns = {}
+        for column in header["columns"]:
+            values = group["columns"][column]
+            if isinstance(values, dict):
+                values = [values["dictionary"][code] for code in values["codes"]]
+            columns[column] = values
+        yield columns
+
+
+EXPORTERS = {"text": export_text, "jsonl": export_jsonl, "column_groups": export_column_groups}
+
+
+def export(games, fmt="text"):
+    """Chunks of `games` exported as `fmt` (a key of FORMATS)."""
+    if fmt not in EXPORTERS:
+        raise ValueError(f"unknown export format {fmt!r}; expected one of {sorted(EXPORTERS)}")
+    return EXPORTERS[fmt](games)
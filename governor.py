@@ -0,0 +1,175 @@
+"""
+Rate-limit governor for LLM requests.
+
+Requests and tokens sent in the last minute are tracked per (provider,
+model) bucket. A request waits in its bucket's FIFO queue until it fits
+under the configured requests/min and tokens/min, and transient failures
+are retried with jittered exponential backoff that honours Retry-After.
+A rate-limit response pauses the whole bucket, not only the request that
+hit it.
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from context_window import estimate_tokens
+
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1"))
+LLM_BACKOFF_CAP = float(os.getenv("LLM_BACKOFF_CAP", "30"))
+# Longer waits are left to the caller (e.g. the router falling back to another provider)
+LLM_MAX_RETRY_WAIT = float(os.getenv("LLM_MAX_RETRY_WAIT", "30"))
+WINDOW = 60.0
+
+
+def request_tokens(messages, max_tokens):
+    """Tokens a request counts against TPM: the prompt plus the completion allowance."""
+    return sum(estimate_tokens(str(message.get("content", ""))) for message in messages) + max_tokens
+
+
+class Bucket:
+    """Sliding one-minute window of requests for one (provider, model)."""
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.sent = deque()  # (time, tokens)
+        self.tokens = 0
+        self.paused_until = 0.0
+        self.waiting = 0
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.throttled = 0.0
+        self._queue = None
+        self._lock = threading.Lock()  # snapshots are read from other threads
+
+    def _prune(self, now):
+        while self.sent and self.sent[0][0] <= now - WINDOW:
+            self.tokens -= self.sent.popleft()[1]
+
+    def _wait_time(self, tokens, now):
+        """Seconds until a request of `tokens` fits, 0 if it fits now."""
+        with self._lock:
+            self._prune(now)
+            waits = [self.paused_until - now]
+            if self.rpm and len(self.sent) >= self.rpm:
+                waits.append(self.sent[len(self.sent) - self.rpm][0] + WINDOW - now)
+            if self.tpm and self.sent and self.tokens + tokens > self.tpm:
+                # Wait for enough of the oldest requests to leave the window
+                freed = self.tokens + tokens - self.tpm
+                for sent_at, sent_tokens in self.sent:
+                    freed -= sent_tokens
+                    if freed <= 0:
+                        waits.append(sent_at + WINDOW - now)
+                        break
+        return max(waits)
+
+    async def acquire(self, tokens):
+        if self._queue is None:
+            self._queue = asyncio.Lock()
+        self.waiting += 1
+        try:
+            async with self._queue:
+                start = time.monotonic()
+                while True:
+                    wait = self._wait_time(tokens, time.monotonic())
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+                self.throttled += time.monotonic() - start
+                with self._lock:
+                    self.sent.append((time.monotonic(), tokens))
+                    self.tokens += tokens
+                    self.requests += 1
+        finally:
+            self.waiting -= 1
+
+    def snapshot(self):
+        with self._lock:
+            self._prune(time.monotonic())
+            sent, tokens = len(self.sent), self.tokens
+        return {
+            "rpm_limit": self.rpm,
+            "tpm_limit": self.tpm,
+            "requests_last_minute": sent,
+            "tokens_last_minute": tokens,
+            "queue_depth": self.waiting,
+            "throttled_seconds": round(self.throttled, 3),
+            "requests": self.requests,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+        }
+
+
+class Governor:
+    """
+    Gatekeeper for every LLM request.
+
+    `limits` maps "provider" or "provider/model" to {"rpm": ..., "tpm": ...};
+    buckets without a limit are only tracked. `classify(error)` returns
+    (retryable, retry_after_seconds or None, is_rate_limit).
+    """
+
+    def __init__(self, limits=None, classify=None, max_retries=LLM_MAX_RETRIES,
+                 backoff_base=LLM_BACKOFF_BASE, backoff_cap=LLM_BACKOFF_CAP,
+                 max_retry_wait=LLM_MAX_RETRY_WAIT):
+        self.limits = limits or {}
+        self.classify = classify or (lambda error: (False, None, False))
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.max_retry_wait = max_retry_wait
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, provider, model):
+        key = f"{provider}/{model}"
+        with self._lock:
+            if key not in self._buckets:
+                limit = self.limits.get(key) or self.limits.get(provider) or {}
+                self._buckets[key] = Bucket(limit.get("rpm"), limit.get("tpm"))
+            return self._buckets[key]
+
+    def backoff(self, attempt):
+        """Full-jitter exponential backoff."""
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    async def call(self, provider, model, tokens, request):
+        """
+        Await request() once the bucket has room, retrying transient errors.
+        Non-retryable errors, and retries that would wait longer than
+        `max_retry_wait`, are raised to the caller.
+        """
+        bucket = self.bucket(provider, model)
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire(tokens)
+            try:
+                return await request()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                retryable, retry_after, rate_limited = self.classify(e)
+                if rate_limited:
+                    bucket.rate_limited += 1
+                if not retryable or attempt == self.max_retries:
+                    raise
+                delay = retry_after if retry_after is not None else self.backoff(attempt)
+                if delay > self.max_retry_wait:
+                    raise
+                if rate_limited:
+                    bucket.paused_until = max(bucket.paused_until, time.monotonic() + delay)
+                    bucket.throttled += delay
+                bucket.retries += 1
+                print(f"[governor] {provider}/{model}: {e}; retry {attempt + 1}/{self.max_retries} "
+                      f"in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def snapshot(self):
+        with self._lock:
+            buckets = list(self._buckets.items())
+        return {key: bucket.snapshot() for key, bucket in buckets}
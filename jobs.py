@@ -0,0 +1,110 @@
+import contextvars
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+JOB_HISTORY = int(os.getenv("JOB_HISTORY", "500"))
+
+
+class RoundJob:
+    """
+    One round running in the background.
+
+    The round reports progress through publish(); finished agent messages
+    ("turn_end" events) are collected in `results` as soon as each lands.
+    """
+
+    def __init__(self, session_id=None, current_round=None):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.current_round = current_round
+        self.status = "queued"
+        self.results = []
+        self.events = []
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self._cond = threading.Condition()
+
+    @property
+    def done(self):
+        return self.status in ("done", "failed")
+
+    def publish(self, event, data):
+        with self._cond:
+            self.events.append((event, data))
+            if event == "turn_end":
+                self.results.append(data)
+            self._cond.notify_all()
+
+    def _finish(self, status, error=None):
+        with self._cond:
+            self.status = status
+            self.error = error
+            self.finished = time.time()
+            self._cond.notify_all()
+
+    def wait_for_result(self, index, timeout=None):
+        """The index-th agent message, or None if it is not ready in time."""
+        with self._cond:
+            self._cond.wait_for(lambda: len(self.results) > index or self.done, timeout)
+            return self.results[index] if len(self.results) > index else None
+
+    def wait_for_events(self, after, timeout=None):
+        """Events published after the first `after` ones, waiting for at least one."""
+        with self._cond:
+            self._cond.wait_for(lambda: len(self.events) > after or self.done, timeout)
+            return self.events[after:], self.done
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "job_id": self.id,
+                "status": self.status,
+                "current_round": self.current_round,
+                "completed": len(self.results),
+                "results": list(self.results),
+                "error": self.error,
+                "elapsed": (self.finished or time.time()) - self.created,
+            }
+
+
+class JobQueue:
+    """In-process worker pool for round jobs, keeping the most recent jobs for status lookups."""
+
+    def __init__(self, max_workers=JOB_WORKERS, history=JOB_HISTORY):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="round-job")
+        self.history = history
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, session_id=None, current_round=None):
+        """Run fn(job) in the background and return the job."""
+        job = RoundJob(session_id, current_round)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.history:
+                oldest_id, oldest = next(iter(self._jobs.items()))
+                if not oldest.done:
+                    break
+                del self._jobs[oldest_id]
+        # Carry the caller's context (e.g. the telemetry session) into the worker
+        self.executor.submit(contextvars.copy_context().run, self._run, job, fn)
+        return job
+
+    def _run(self, job, fn):
+        job.status = "running"
+        try:
+            fn(job)
+            job._finish("done")
+        except Exception as e:
+            print(f"Round job {job.id} failed: {e}")
+            job._finish("failed", str(e))
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
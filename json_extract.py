@@ -0,0 +1,335 @@
+"""
+Tolerant extraction of JSON objects from LLM responses.
+
+The fast path is a single json raw_decode from the first "{". Only when that
+fails does a linear, non-backtracking parser take over, which accepts the
+things models actually produce: code fences and surrounding prose, trailing
+or doubled commas, mismatched closing brackets, Python literals, raw
+newlines in strings, double-escaped quotes, and documents cut off mid-way
+(truncated output or a stream that is still arriving). Nested values are
+still handed to raw_decode first, since most of them are well formed, but
+the text its failed attempts re-read is capped at the length of the input,
+so however deep the damage is the text is scanned at most twice.
+"""
+
+import json
+import re
+from json.decoder import scanstring
+
+_WS = re.compile(r"\s*")
+_NUMBER = re.compile(r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?")
+_BARE_WORD = re.compile(r"[A-Za-z_][\w ]*?(?=\s*:)")
+_BARE_VALUE = re.compile(r"[^,}\]\n]+")
+_LITERALS = {"true": True, "false": False, "null": None,
+             "True": True, "False": False, "None": None}
+_decoder = json.JSONDecoder(strict=False)
+_TRAILING_COMMA = re.compile(r",(?=\s*[}\]])")
+_ESCAPED_QUOTE = re.compile(r'(\\+)"')
+
+
+class ExtractResult:
+    """What extract_json recovered from a response."""
+
+    __slots__ = ("value", "complete", "recovered_keys", "missing_keys")
+
+    def __init__(self, value, complete, target_keys=None):
+        self.value = value
+        self.complete = complete
+        keys = list(value) if isinstance(value, dict) else []
+        if target_keys:
+            self.recovered_keys = [key for key in target_keys if key in keys]
+            self.missing_keys = [key for key in target_keys if key not in keys]
+        else:
+            self.recovered_keys = keys
+            self.missing_keys = []
+
+    def __repr__(self):
+        return (f"ExtractResult(complete={self.complete}, recovered={self.recovered_keys}, "
+                f"missing={self.missing_keys})")
+
+
+class _Truncated(Exception):
+    """Raised inside the tolerant parser when the input ends mid-value."""
+
+    def __init__(self, partial=None):
+        self.partial = partial
+
+
+class _TolerantParser:
+    def __init__(self, text):
+        self.text = text
+        self.n = len(text)
+        self.truncated = False
+        self.depth = 0
+        # Characters that failed raw_decode attempts may still re-read
+        self.retry_budget = self.n
+
+    def ws(self, i):
+        return _WS.match(self.text, i).end()
+
+    def value(self, i):
+        i = self.ws(i)
+        if i >= self.n:
+            raise _Truncated()
+        ch = self.text[i]
+        if ch in "{[":
+            # The document itself (depth 0) was already tried by the caller
+            if self.depth and self.retry_budget > 0:
+                try:
+                    return _decoder.raw_decode(self.text, i)
+                except ValueError as e:
+                    self.retry_budget -= max(getattr(e, "pos", self.n) - i, 1)
+            self.depth += 1
+            try:
+                return self.obj(i + 1) if ch == "{" else self.array(i + 1)
+            finally:
+                self.depth -= 1
+        if ch == '"':
+            return self.string(i + 1)
+        match = _NUMBER.match(self.text, i)
+        if match:
+            number = match.group()
+            return (float(number) if any(c in number for c in ".eE") else int(number)), match.end()
+        for literal, parsed in _LITERALS.items():
+            if self.text.startswith(literal, i):
+                return parsed, i + len(literal)
+        if _literal_prefix(self.text[i:]):
+            raise _Truncated()
+        # Unquoted text: keep it as a string up to the next delimiter
+        match = _BARE_VALUE.match(self.text, i)
+        if match and ch not in ":\"":
+            return match.group().strip(), match.end()
+        raise ValueError(f"unexpected character {ch!r} at {i}")
+
+    def string(self, i):
+        try:
+            return scanstring(self.text, i, False)
+        except ValueError:
+            # Unterminated: keep what has arrived, minus a dangling escape
+            raw = self.text[i:]
+            raw = re.sub(r"\\(u[0-9a-fA-F]{0,3})?$", "", raw)
+            try:
+                partial, _ = scanstring(raw + '"', 0, False)
+            except ValueError:
+                partial = raw
+            raise _Truncated(partial)
+
+    def key(self, i):
+        if self.text[i] == '"':
+            return self.string(i + 1)
+        match = _BARE_WORD.match(self.text, i)
+        if match:
+            return match.group().strip(), match.end()
+        raise ValueError(f"expected a key at {i}")
+
+    def obj(self, i):
+        result = {}
+        while True:
+            i = self.ws(i)
+            if i >= self.n:
+                self.truncated = True
+                return result, i
+            ch = self.text[i]
+            if ch == "}":
+                return result, i + 1
+            if ch == "]":
+                # Mismatched closer: end this object and let it close the enclosing array
+                return result, i
+            if ch == ",":
+                i += 1
+                continue
+            try:
+                key, i = self.key(i)
+            except _Truncated:
+                self.truncated = True
+                return result, self.n
+            i = self.ws(i)
+            if i >= self.n:
+                self.truncated = True
+                return result, i
+            if self.text[i] != ":":
+                raise ValueError(f"expected ':' at {i}")
+            try:
+                result[key], i = self.value(i + 1)
+            except _Truncated as e:
+                self.truncated = True
+                if e.partial is not None:
+                    result[key] = e.partial
+                return result, self.n
+            if self.truncated:
+                return result, i
+
+    def array(self, i):
+        result = []
+        while True:
+            i = self.ws(i)
+            if i >= self.n:
+                self.truncated = True
+                return result, i
+            ch = self.text[i]
+            if ch == "]":
+                return result, i + 1
+            if ch == "}":
+                # Mismatched closer: end this array and let it close the enclosing object
+                return result, i
+            if ch == ",":
+                i += 1
+                continue
+            try:
+                item, i = self.value(i)
+            except _Truncated as e:
+                self.truncated = True
+                if e.partial is not None:
+                    result.append(e.partial)
+                return result, self.n
+            result.append(item)
+            if self.truncated:
+                return result, i
+
+
+def _literal_prefix(text):
+    """True if text is a cut-off prefix of a JSON/Python literal."""
+    return bool(text) and any(literal.startswith(text) for literal in _LITERALS)
+
+
+def _candidates(response):
+    """Texts that may hold the JSON document: fenced blocks first, then the raw response."""
+    start = response.find("```")
+    while start != -1:
+        body = response.find("\n", start)
+        if body == -1:
+            break
+        end = response.find("```", body)
+        block = response[body + 1:] if end == -1 else response[body + 1:end]
+        if "{" in block:
+            yield block
+        if end == -1:
+            break
+        start = response.find("```", end + 3)
+    yield response
+
+
+def _strip_trailing_commas(text):
+    """`text` without the commas right before a closing bracket outside strings; None if none."""
+    pieces, kept, position, quotes = [], 0, 0, 0
+    for match in _TRAILING_COMMA.finditer(text):
+        comma = match.start()
+        # Quotes since the last comma, minus those escaped by an odd run of backslashes
+        quotes += text.count('"', position, comma) - sum(
+            len(escape.group(1)) % 2 for escape in _ESCAPED_QUOTE.finditer(text, position, comma))
+        position = comma
+        if quotes % 2 == 0:
+            pieces.append(text[kept:comma])
+            kept = comma + 1
+    if not pieces:
+        return None
+    pieces.append(text[kept:])
+    return "".join(pieces)
+
+
+def _parse_from(text, start):
+    """Parse the object at text[start]; returns (value, complete) or raises ValueError."""
+    try:
+        value, _ = _decoder.raw_decode(text, start)
+        return value, True
+    except ValueError:
+        pass
+    if text.startswith('{\\"', start):
+        # A JSON document serialised inside a string: undo one level of escaping
+        return _parse_from(text[start:].replace('\\"', '"'), 0)
+    # Trailing commas are the most common defect; drop them all in one pass
+    stripped = _strip_trailing_commas(text[start:])
+    if stripped is not None:
+        try:
+            value, _ = _decoder.raw_decode(stripped)
+            return value, True
+        except ValueError:
+            pass
+    parser = _TolerantParser(text)
+    value, _ = parser.value(start)
+    return value, not parser.truncated
+
+
+def extract_json(response, target_keys=None):
+    """
+    Extract the first JSON object from a model response.
+
+    Returns an ExtractResult whose `value` is the parsed object (None if no
+    object could be recovered), `complete` tells whether the whole document
+    was present, and `recovered_keys`/`missing_keys` report which of
+    `target_keys` (or of the top-level keys) were found.
+    """
+    if not response:
+        return ExtractResult(None, False, target_keys)
+    start = response.find("{")
+    if start == -1:
+        return ExtractResult(None, False, target_keys)
+    try:
+        # Well-formed JSON, wherever it sits in the response
+        value, _ = _decoder.raw_decode(response, start)
+        return ExtractResult(value, True, target_keys)
+    except (ValueError, RecursionError):
+        pass
+    for text in _candidates(response):
+        start = text.find("{")
+        if start == -1:
+            continue
+        try:
+            value, complete = _parse_from(text, start)
+        except (ValueError, _Truncated, RecursionError):
+            continue
+        return ExtractResult(value, complete, target_keys)
+    return ExtractResult(None, False, target_keys)
+
+
+class JSONStreamExtractor:
+    """
+    Incremental extractor for a JSON object that arrives in chunks.
+
+    feed() tracks nesting in linear time overall and reports when the first
+    top-level object has closed; partial() parses whatever has arrived so far.
+    """
+
+    def __init__(self, target_keys=None):
+        self.target_keys = target_keys
+        self.buffer = []
+        self._length = 0
+        self._depth = 0
+        self._started = False
+        self._in_string = False
+        self._escape = False
+        self.done = False
+
+    def feed(self, chunk):
+        """Add a chunk; returns True once a complete top-level object has been seen."""
+        self.buffer.append(chunk)
+        self._length += len(chunk)
+        if self.done:
+            return True
+        for ch in chunk:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = self._started
+            elif ch in "{[":
+                self._started = self._started or ch == "{"
+                if self._started:
+                    self._depth += 1
+            elif ch in "}]" and self._started:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.done = True
+                    break
+        return self.done
+
+    def text(self):
+        return "".join(self.buffer)
+
+    def partial(self):
+        """ExtractResult for everything received so far."""
+        return extract_json(self.text(), self.target_keys)
@@ -4,6 +4,12 @@
 # last updated: october 2024
 
 import os
+import asyncio
+import threading
+import contextvars
+import hashlib
+from collections import OrderedDict
+from types import SimpleNamespace
 from dotenv import load_dotenv
 import numpy as np
 import pickle
@@ -12,8 +18,20 @@ import json
 import re
 from typing import Dict, List, Tuple
 
-from openai import OpenAI
-from anthropic import Anthropic 
+import httpx
+import openai
+import anthropic
+from openai import OpenAI, AsyncOpenAI
+from anthropic import Anthropic, AsyncAnthropic
+
+from llm_cache import ResponseCache, cache_key
+from json_extract import extract_json
+from router import ModelRouter
+from governor import Governor, request_tokens
+from cassette import Cassette
+import telemetry
+from schemas import (TaskSchema, PotentialMistakes, CharacterSchema, RosterSchemas,
+                     tool_spec, validate_output, dump)
 
 # load_dotenv()
 # oai = OpenAI(api_key = os.getenv('OPENAI_API_KEY'))
@@ -23,45 +41,449 @@ oai = OpenAI(api_key = OPENAI_API_KEY)
 ant = Anthropic()
 ant.api_key = os.getenv('ANTHROPIC_API_KEY')
 
-def gen_oai(messages, model='gpt-4o', temperature=1):
+# Async clients: every completion goes through these, over a small pool of
+# keep-alive connections per provider, driven by one background event loop.
+LLM_MAX_CONNECTIONS = int(os.getenv('LLM_MAX_CONNECTIONS', '20'))
+LLM_MAX_KEEPALIVE = int(os.getenv('LLM_MAX_KEEPALIVE', '10'))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv('LLM_KEEPALIVE_EXPIRY', '30'))
+PROVIDER_CONCURRENCY = {
+  'openai': int(os.getenv('OAI_CONCURRENCY', '8')),
+  'anthropic': int(os.getenv('ANT_CONCURRENCY', '8')),
+}
+
+def _pooled_http_client():
+  return httpx.AsyncClient(
+    limits=httpx.Limits(
+      max_connections=LLM_MAX_CONNECTIONS,
+      max_keepalive_connections=LLM_MAX_KEEPALIVE,
+      keepalive_expiry=LLM_KEEPALIVE_EXPIRY),
+    timeout=httpx.Timeout(120.0, connect=10.0))
+
+# Retries are done by the governor, which also sees the rate limits
+aoai = AsyncOpenAI(api_key = OPENAI_API_KEY, http_client = _pooled_http_client(),
+                   max_retries = 0)
+aant = AsyncAnthropic(api_key = os.getenv('ANTHROPIC_API_KEY'),
+                      http_client = _pooled_http_client(), max_retries = 0)
+
+# Limits per "provider" or "provider/model", e.g. {"openai/gpt-4": {"rpm": 500, "tpm": 10000}}
+LLM_RATE_LIMITS = json.loads(os.getenv('LLM_RATE_LIMITS', '{}'))
+
+def _retry_after_header(error):
+  try:
+    return float(error.response.headers.get('retry-after'))
+  except (AttributeError, TypeError, ValueError):
+    return None
+
+def _classify_error(error):
+  """(retryable, retry_after, rate_limited) for the governor."""
+  status = getattr(error, 'status_code', None)
+  rate_limited = status in (429, 529)
+  retryable = (rate_limited or status in (408, 409) or (status is not None and status >= 500)
+               or isinstance(error, (openai.APIConnectionError, anthropic.APIConnectionError)))
+  return retryable, _retry_after_header(error), rate_limited
+
+governor = Governor(LLM_RATE_LIMITS, classify=_classify_error)
+
+# Record/replay of responses (LLM_CASSETTE, LLM_CASSETTE_MODE, LLM_CASSETTE_MATCH); see cassette.py
+cassette = Cassette.from_env()
+
+_loop = None
+_loop_lock = threading.Lock()
+_semaphores = {}
+
+def _llm_loop():
+  global _loop
+  with _loop_lock:
+    if _loop is None:
+      loop = asyncio.new_event_loop()
+      threading.Thread(target=loop.run_forever, name='llm-event-loop',
+                       daemon=True).start()
+      _loop = loop
+  return _loop
+
+def _provider_semaphore(provider):
+  # Only ever touched from the LLM loop, so no lock is needed.
+  if provider not in _semaphores:
+    _semaphores[provider] = asyncio.Semaphore(PROVIDER_CONCURRENCY[provider])
+  return _semaphores[provider]
+
+def run_sync(coro):
+  """Run a coroutine on the shared LLM event loop and block for its result."""
+  loop = _llm_loop()
+  try:
+    running = asyncio.get_running_loop()
+  except RuntimeError:
+    running = None
+  if running is loop:
+    coro.close()
+    raise RuntimeError("run_sync called from the LLM event loop; await instead")
+  return asyncio.run_coroutine_threadsafe(_in_context(coro), loop).result()
+
+def _in_context(coro):
+  """Wrap coro to run on the loop in the calling thread's context (session, current span)."""
+  context = contextvars.copy_context()
+  async def run():
+    return await asyncio.get_running_loop().create_task(coro, context=context)
+  return run()
+
+def _usage(response):
+  """(prompt, completion) tokens from an OpenAI or Anthropic response."""
+  usage = getattr(response, 'usage', None)
+  if usage is None:
+    return 0, 0
+  return (getattr(usage, 'prompt_tokens', None) or getattr(usage, 'input_tokens', 0) or 0,
+          getattr(usage, 'completion_tokens', None) or getattr(usage, 'output_tokens', 0) or 0)
+
+async def _governed(provider, model, messages, max_tokens, create):
+  """Await create() once the governor lets it through; a provider slot is held only while it runs."""
+  async def request():
+    async with _provider_semaphore(provider):
+      return await create()
+  with telemetry.span("llm_call", provider=provider, model=model):
+    response = await governor.call(provider, model, request_tokens(messages, max_tokens), request)
+    telemetry.record_usage(provider, model, *_usage(response))
+  return response
+
+async def _governed_stream(provider, model, messages, max_tokens, create):
+  """
+  Open a stream once the governor lets it through. Returns (stream, release):
+  the provider slot is taken only when the request is sent, and held until release().
+  """
+  semaphore = _provider_semaphore(provider)
+  async def request():
+    await semaphore.acquire()
+    try:
+      return await create()
+    except BaseException:
+      semaphore.release()
+      raise
+  stream = await governor.call(provider, model, request_tokens(messages, max_tokens), request)
+  return stream, semaphore.release
+
+async def agen_oai(messages, model='gpt-4o', temperature=1, max_tokens=1000):
   if model == None:
     model = 'gpt-4o'
+  async def live():
+    response = await _governed('openai', model, messages, max_tokens,
+                               lambda: aoai.chat.completions.create(
+                                 model=model,
+                                 temperature=temperature,
+                                 messages=messages,
+                                 max_tokens=max_tokens))
+    return response.choices[0].message.content
   try:
-    response = oai.chat.completions.create(
-      model=model,
-      temperature=temperature,
-      messages=messages,
-      max_tokens=1000)
-    content = response.choices[0].message.content
-    return content
+    return await cassette.play('openai', model, temperature, messages, live)
   except Exception as e:
     print(f"Error generating completion: {e}")
     raise e
 
-def simple_gen_oai(prompt, model='gpt-4o', temperature=1):
+def gen_oai(messages, model='gpt-4o', temperature=1, max_tokens=1000):
+  return run_sync(agen_oai(messages, model, temperature, max_tokens))
+
+async def asimple_gen_oai(prompt, model='gpt-4o', temperature=1):
   messages = [{"role": "user", "content": prompt}]
-  return gen_oai(messages, model)
+  return await agen_oai(messages, model)
 
-def gen_ant(messages, model='claude-3-5-sonnet-20240620', temperature=1, 
-            max_tokens=1000):
+def simple_gen_oai(prompt, model='gpt-4o', temperature=1):
+  return run_sync(asimple_gen_oai(prompt, model, temperature))
+
+def _split_system(messages):
+  """Anthropic takes system prompts separately and needs at least one user turn."""
+  system = "\n\n".join(m["content"] for m in messages if m["role"] == "system")
+  rest = [m for m in messages if m["role"] != "system"]
+  if not rest:
+    return "", [{"role": "user", "content": system}]
+  return system, rest
+
+async def agen_ant(messages, model='claude-3-5-sonnet-20240620', temperature=1,
+                   max_tokens=1000):
   if model == None:
     model = 'claude-3-5-sonnet-20240620'
+  system, turns = _split_system(messages)
+  extra = {"system": system} if system else {}
+  async def live():
+    response = await _governed('anthropic', model, turns, max_tokens,
+                               lambda: aant.messages.create(
+                                 model=model,
+                                 max_tokens=max_tokens,
+                                 temperature=temperature,
+                                 messages=turns,
+                                 **extra))
+    return response.content[0].text
   try:
-    response = ant.messages.create(
-      model=model,
-      max_tokens=max_tokens,
-      temperature=temperature,
-      messages=messages
-    )
-    content = response.content[0].text
-    return content
+    return await cassette.play('anthropic', model, temperature, messages, live)
   except Exception as e:
     print(f"Error generating completion: {e}")
     raise e
 
-def simple_gen_ant(prompt, model='claude-3-5-sonnet-20240620'):
+def gen_ant(messages, model='claude-3-5-sonnet-20240620', temperature=1, 
+            max_tokens=1000):
+  return run_sync(agen_ant(messages, model, temperature, max_tokens))
+
+async def asimple_gen_ant(prompt, model='claude-3-5-sonnet-20240620'):
   messages = [{"role": "user", "content": prompt}]
-  return gen_ant(messages, model)
+  return await agen_ant(messages, model)
+
+def simple_gen_ant(prompt, model='claude-3-5-sonnet-20240620'):
+  return run_sync(asimple_gen_ant(prompt, model))
+
+# Structured outputs: the model is forced to call a tool whose parameters are
+# the JSON schema of a pydantic model (schemas.py), so nothing is parsed from
+# prose. Function calling rather than JSON mode, as gpt-4 has no JSON mode.
+STRUCTURED_RETRIES = int(os.getenv('STRUCTURED_RETRIES', '2'))
+
+class StructuredOutputError(ValueError):
+  """A structured response that was still invalid after all retries."""
+  def __init__(self, message, partial=None):
+    super().__init__(message)
+    self.partial = partial
+
+async def _acall_tool_oai(messages, tool, model, temperature, max_tokens):
+  return await cassette.play('openai', model, temperature, messages, tool=tool, live=lambda:
+                             _alive_tool_oai(messages, tool, model, temperature, max_tokens))
+
+async def _alive_tool_oai(messages, tool, model, temperature, max_tokens):
+  name, description, parameters = tool
+  response = await _governed('openai', model, messages, max_tokens,
+                             lambda: aoai.chat.completions.create(
+                               model=model,
+                               temperature=temperature,
+                               messages=messages,
+                               max_tokens=max_tokens,
+                               tools=[{"type": "function",
+                                       "function": {"name": name, "description": description,
+                                                    "parameters": parameters}}],
+                               tool_choice={"type": "function", "function": {"name": name}}))
+  calls = response.choices[0].message.tool_calls or []
+  if not calls:
+    return None
+  arguments = calls[0].function.arguments
+  try:
+    return json.loads(arguments)
+  except json.JSONDecodeError:
+    # Cut off at max_tokens: keep what arrived, the rest is asked for again
+    return extract_json(arguments).value
+
+async def _acall_tool_ant(messages, tool, model, temperature, max_tokens):
+  return await cassette.play('anthropic', model, temperature, messages, tool=tool, live=lambda:
+                             _alive_tool_ant(messages, tool, model, temperature, max_tokens))
+
+async def _alive_tool_ant(messages, tool, model, temperature, max_tokens):
+  name, description, parameters = tool
+  system, messages = _split_system(messages)
+  extra = {"system": system} if system else {}
+  response = await _governed('anthropic', model, messages, max_tokens,
+                             lambda: aant.messages.create(
+                               model=model,
+                               max_tokens=max_tokens,
+                               temperature=temperature,
+                               messages=messages,
+                               tools=[{"name": name, "description": description,
+                                       "input_schema": parameters}],
+                               tool_choice={"type": "tool", "name": name},
+                               **extra))
+  for block in response.content:
+    if block.type == "tool_use":
+      return block.input
+  return None
+
+_TOOL_CALLERS = {
+  'openai': (_acall_tool_oai, 'gpt-4o'),
+  'anthropic': (_acall_tool_ant, 'claude-3-5-sonnet-20240620'),
+}
+
+def _repair_prompt(data, invalid):
+  problems = "\n".join(f"- {key}: {'; '.join(errors)}" for key, errors in invalid.items())
+  return (f"Parts of your previous answer were missing or invalid:\n{problems}\n\n"
+          f"Previous answer: {json.dumps(data)}\n\n"
+          f"Call the tool again with corrected values for only these keys: "
+          f"{', '.join(str(key) for key in invalid)}.")
+
+async def agen_structured(messages, output_model, model=None, temperature=1, max_tokens=1000,
+                          provider='openai', required_keys=None, retries=STRUCTURED_RETRIES,
+                          site=None, with_route=False):
+  """
+  Validated `output_model` instance from a forced tool call.
+  When validation fails only the invalid top-level entries are requested
+  again, up to `retries` times; raises StructuredOutputError after that.
+  With `site`, the router picks the provider and model instead.
+  With `with_route`, returns (output, (provider, model) that produced it).
+  """
+  if site is not None:
+    return await router.run(site, lambda provider, model: agen_structured(
+      messages, output_model, model, temperature, max_tokens, provider, required_keys, retries),
+      with_route=with_route)
+  call, default_model = _TOOL_CALLERS[provider]
+  model = model or default_model
+  if with_route:
+    return (await agen_structured(messages, output_model, model, temperature, max_tokens,
+                                  provider, required_keys, retries), (provider, model))
+  data = await call(messages, tool_spec(output_model), model, temperature, max_tokens)
+  for attempt in range(retries + 1):
+    output, invalid = validate_output(output_model, data, required_keys)
+    if output is not None:
+      return output
+    if attempt == retries:
+      break
+    print(f"Invalid {output_model.__name__} for {list(invalid)}, retrying ({attempt + 1}/{retries})")
+    if None in invalid or set(data) <= set(invalid):
+      # Nothing worth keeping
+      data = await call(messages, tool_spec(output_model), model, temperature, max_tokens)
+      continue
+    repair = messages + [{"role": "user", "content": _repair_prompt(data, invalid)}]
+    fixed = await call(repair, tool_spec(output_model, list(invalid)), model, temperature, max_tokens)
+    if isinstance(fixed, dict):
+      data = {**data, **{key: value for key, value in fixed.items() if key in invalid}}
+  raise StructuredOutputError(f"invalid {output_model.__name__} for {list(invalid)}", partial=data)
+
+def gen_structured(messages, output_model, model=None, temperature=1, max_tokens=1000,
+                   provider='openai', required_keys=None, retries=STRUCTURED_RETRIES, site=None,
+                   with_route=False):
+  return run_sync(agen_structured(messages, output_model, model, temperature, max_tokens,
+                                  provider, required_keys, retries, site, with_route))
+
+async def astream_oai(messages, model='gpt-4o', temperature=1, max_tokens=1000):
+  """Yield completion text deltas as the model emits them."""
+  if model == None:
+    model = 'gpt-4o'
+  async for delta in cassette.stream('openai', model, temperature, messages, lambda:
+                                     _alive_stream_oai(messages, model, temperature, max_tokens)):
+    yield delta
+
+async def _alive_stream_oai(messages, model, temperature, max_tokens):
+  try:
+    with telemetry.span("llm_stream", activate=False, provider='openai', model=model) as span:
+      # Only opening the stream is retried; nothing has been yielded yet
+      stream, release = await _governed_stream('openai', model, messages, max_tokens,
+                                               lambda: aoai.chat.completions.create(
+                                                 model=model,
+                                                 temperature=temperature,
+                                                 messages=messages,
+                                                 max_tokens=max_tokens,
+                                                 stream=True,
+                                                 stream_options={"include_usage": True}))
+      try:
+        async for chunk in stream:
+          if chunk.usage:
+            span.attributes["prompt_tokens"], span.attributes["completion_tokens"] = _usage(chunk)
+          if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+      finally:
+        release()
+  except Exception as e:
+    print(f"Error streaming completion: {e}")
+    raise e
+
+async def astream_ant(messages, model='claude-3-5-sonnet-20240620', temperature=1,
+                      max_tokens=1000):
+  """Yield completion text deltas as the model emits them."""
+  if model == None:
+    model = 'claude-3-5-sonnet-20240620'
+  async for delta in cassette.stream('anthropic', model, temperature, messages, lambda:
+                                     _alive_stream_ant(messages, model, temperature, max_tokens)):
+    yield delta
+
+async def _alive_stream_ant(messages, model, temperature, max_tokens):
+  system, messages = _split_system(messages)
+  extra = {"system": system} if system else {}
+  try:
+    with telemetry.span("llm_stream", activate=False, provider='anthropic', model=model) as span:
+      stream, release = await _governed_stream('anthropic', model, messages, max_tokens,
+                                               lambda: aant.messages.create(
+                                                 model=model,
+                                                 max_tokens=max_tokens,
+                                                 temperature=temperature,
+                                                 messages=messages,
+                                                 stream=True,
+                                                 **extra))
+      try:
+        async for event in stream:
+          if event.type == 'message_start':
+            span.attributes["prompt_tokens"] = event.message.usage.input_tokens
+          elif event.type == 'message_delta':
+            span.attributes["completion_tokens"] = event.usage.output_tokens
+          elif event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+            yield event.delta.text
+      finally:
+        release()
+  except Exception as e:
+    print(f"Error streaming completion: {e}")
+    raise e
+
+def iter_sync(agen):
+  """Drive an async generator on the shared LLM loop from synchronous code."""
+  loop = _llm_loop()
+  try:
+    while True:
+      try:
+        yield asyncio.run_coroutine_threadsafe(_in_context(agen.__anext__()), loop).result()
+      except StopAsyncIteration:
+        return
+  finally:
+    asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+def stream_oai(messages, model='gpt-4o', temperature=1, max_tokens=1000):
+  return iter_sync(astream_oai(messages, model, temperature, max_tokens))
+
+def stream_ant(messages, model='claude-3-5-sonnet-20240620', temperature=1,
+               max_tokens=1000):
+  return iter_sync(astream_ant(messages, model, temperature, max_tokens))
+
+# Model routing: each call site names a tier, and each tier lists
+# (provider, model) routes in order of preference. See router.py.
+MODEL_TIERS = {
+  'quality': [('openai', 'gpt-4'), ('anthropic', 'claude-3-5-sonnet-20240620')],
+  'standard': [('openai', 'gpt-4o'), ('anthropic', 'claude-3-5-sonnet-20240620')],
+  'fast': [('openai', 'gpt-4o-mini'), ('anthropic', 'claude-3-haiku-20240307')],
+}
+MODEL_TIERS.update(json.loads(os.getenv('MODEL_TIERS', '{}')))
+CALL_SITE_TIERS = {
+  'task_schema': 'standard',
+  'mistakes': 'standard',
+  'character_schema': 'quality',
+  'turn': 'quality',
+  'reflection': 'standard',
+  'summary': 'standard',
+}
+CALL_SITE_TIERS.update(json.loads(os.getenv('CALL_SITE_TIERS', '{}')))
+ROUTER_PROVIDERS = os.getenv(
+  'ROUTER_PROVIDERS', 'openai,anthropic' if os.getenv('ANTHROPIC_API_KEY') else 'openai').split(',')
+
+def _should_fallback(error):
+  return isinstance(error, (openai.APIError, anthropic.APIError, StructuredOutputError,
+                            asyncio.TimeoutError))
+
+def _retry_after(error):
+  """Seconds a rate-limited or overloaded provider asked us to wait (0 if unspecified)."""
+  if getattr(error, 'status_code', None) not in (429, 529):
+    return None
+  return _retry_after_header(error) or 0
+
+router = ModelRouter(MODEL_TIERS, CALL_SITE_TIERS, providers=ROUTER_PROVIDERS,
+                     should_fallback=_should_fallback, retry_after=_retry_after)
+
+async def _acomplete(provider, model, messages, temperature, max_tokens):
+  generate = agen_ant if provider == 'anthropic' else agen_oai
+  return await generate(messages, model, temperature, max_tokens)
+
+async def agen_routed(site, messages, temperature=1, max_tokens=1000):
+  """Completion for a call site, on whichever route the router picks."""
+  return await router.run(site, lambda provider, model: _acomplete(
+    provider, model, messages, temperature, max_tokens))
+
+def gen_routed(site, messages, temperature=1, max_tokens=1000):
+  return run_sync(agen_routed(site, messages, temperature, max_tokens))
+
+async def astream_routed(site, messages, temperature=1, max_tokens=1000):
+  """Streamed completion for a call site; the route is fixed once the first delta arrives."""
+  def open_stream(provider, model):
+    stream = astream_ant if provider == 'anthropic' else astream_oai
+    return stream(messages, model, temperature, max_tokens)
+  async for delta in router.stream(site, open_stream):
+    yield delta
+
+def stream_routed(site, messages, temperature=1, max_tokens=1000):
+  return iter_sync(astream_routed(site, messages, temperature, max_tokens))
 
 # Prompt utils
 
@@ -144,67 +566,43 @@ def modular_instructions(modules):
     
 def parse_json(response, target_keys=None):
     """
-    Parses a JSON string response and handles failures with regex fallback.
+    Parses the JSON object in a model response (see json_extract.extract_json).
     Args:
         response (str): The response string containing JSON.
         target_keys (list): List of keys to extract from the JSON if provided.
     Returns:
-        dict: Parsed JSON or a fallback dictionary if parsing fails.
+        dict: Parsed JSON, possibly partial if the response was cut off, or {} if none was found.
     """
-    # Locate JSON boundaries
-    json_start = response.find('{')
-    json_end = response.rfind('}') + 1
-    if json_start == -1 or json_end == -1:
-        print("No JSON structure found in response.")
+    result = extract_json(response, target_keys)
+    if not isinstance(result.value, dict):
+        print(f"No JSON object found in response ({len(response or '')} chars).")
         return {}
-
-    # Extract and clean the potential JSON substring
-    cleaned_response = response[json_start:json_end].replace('\\"', '"')
-
-    # Attempt to parse JSON directly
-    try:
-        parsed = json.loads(cleaned_response)
-        if target_keys:
-            parsed = {key: parsed.get(key, "") for key in target_keys}
-        return parsed
-    except json.JSONDecodeError:
-        print("Failed to parse JSON. Attempting regex fallback.")
-        print(f"Original Response: {response}")
-        print(f"Extracted JSON-like Segment: {cleaned_response}")
-
-    # Regex fallback for JSON-like structures
-    parsed = {}
-    try:
-        for match in re.finditer(r'"(\w+)":\s*(?:(\{.*?\})|"(.*?)"|([^,}]+))', cleaned_response, re.DOTALL):
-            key = match.group(1)
-            if target_keys and key not in target_keys:
-                continue
-
-            # Determine the value type
-            if match.group(2):  # Nested JSON object
-                try:
-                    parsed[key] = json.loads(match.group(2))
-                except json.JSONDecodeError:
-                    print(f"Failed to parse nested JSON for key: {key}")
-                    parsed[key] = {}
-            elif match.group(3):  # String value
-                parsed[key] = match.group(3)
-            elif match.group(4):  # Other types (e.g., numbers)
-                parsed[key] = match.group(4).strip()
-
-    except Exception as e:
-        print(f"Regex fallback failed with error: {e}")
-    
+    if not result.complete:
+        print(f"Response JSON was incomplete; recovered keys: {result.recovered_keys}, "
+              f"missing: {result.missing_keys}")
+    parsed = result.value
+    if target_keys:
+        parsed = {key: parsed.get(key, "") for key in target_keys}
     return parsed
 
 
 
+# Problem-level outputs (task schema, potential mistakes) are reused across
+# sessions. Set SCHEMA_CACHE_REFRESH=1 to regenerate every entry on demand.
+schema_cache = ResponseCache(
+  os.getenv('SCHEMA_CACHE_PATH',
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'schemas.sqlite3')),
+  ttl=float(os.getenv('SCHEMA_CACHE_TTL', 7 * 24 * 3600)),
+  max_entries=int(os.getenv('SCHEMA_CACHE_MAX_ENTRIES', '1000')),
+  enabled=os.getenv('SCHEMA_CACHE_DISABLED', '') != '1')
+SCHEMA_CACHE_REFRESH = os.getenv('SCHEMA_CACHE_REFRESH', '') == '1'
+
 # end-to-end generation and parsing
-def mod_gen(modules: List[Dict], placeholders: Dict, target_keys = None) -> Dict:
+async def amod_gen(modules: List[Dict], placeholders: Dict, target_keys = None) -> Dict:
   prompt = modular_instructions(modules)
   filled = fill_prompt(prompt, placeholders)
   # print(filled)
-  response = simple_gen_oai(filled)
+  response = await asimple_gen_oai(filled)
   if len(response) == 0:
     print("Error: response was empty")
     return {}
@@ -213,9 +611,14 @@ def mod_gen(modules: List[Dict], placeholders: Dict, target_keys = None) -> Dict
   parsed = parse_json(response, target_keys)
   return parsed
 
-def generate_task_schema(math_problem):
+def mod_gen(modules: List[Dict], placeholders: Dict, target_keys = None) -> Dict:
+  return run_sync(amod_gen(modules, placeholders, target_keys))
+
+@telemetry.traced()
+def generate_task_schema(math_problem, force_refresh=False):
     """
     Generate a detailed task schema for the given math problem using examples for guidance.
+    Results are served from `schema_cache` unless `force_refresh` is set.
     """
     # Example math problem and corresponding schema
     example_problem = """
@@ -287,21 +690,38 @@ def generate_task_schema(math_problem):
 
     Return the JSON object only.
     """
+    model, temperature = router.primary_model('task_schema'), 1
+    key = cache_key(system_prompt, model, temperature, math_problem)
+    if not (force_refresh or SCHEMA_CACHE_REFRESH):
+        cached = schema_cache.get(key)
+        telemetry.record_cache(bool(cached))
+        if cached:
+            return cached
+
     # Generate task schema using the LLM
-    response = gen_oai([{"role": "system", "content": system_prompt}])
-    task_schema = parse_json(response)
-    
-    # Handle cases where the response is invalid
+    try:
+        output, (_, answered_by) = gen_structured([{"role": "system", "content": system_prompt}],
+                                                  TaskSchema, temperature=temperature,
+                                                  site='task_schema', with_route=True)
+        task_schema = dump(output)
+    except StructuredOutputError as e:
+        print(f"Failed to generate a valid task schema ({e}). Returning an empty schema.")
+        return {}
     if not task_schema:
         print("Failed to generate a valid task schema. Returning an empty schema.")
         return {}
     
+    # The key names the primary model; a fallback model's answer is not cached under it
+    if answered_by == model:
+        schema_cache.set(key, task_schema)
     return task_schema
 
 
-def identify_potential_mistakes(task_schema):
+@telemetry.traced()
+def identify_potential_mistakes(task_schema, force_refresh=False):
     """
     Analyze the task schema to identify common mistakes students may make.
+    Results are served from `schema_cache` unless `force_refresh` is set.
     """
     system_prompt = f"""
     You are a math teacher. Analyze the following task schema and identify potential mistakes students may make.
@@ -315,16 +735,50 @@ def identify_potential_mistakes(task_schema):
 
     Provide the result as a structured JSON object.
     """
-    response = gen_oai([{"role": "system", "content": system_prompt}])
-    potential_mistakes = parse_json(response)
+    model, temperature = router.primary_model('mistakes'), 1
+    key = cache_key(system_prompt, model, temperature)
+    if not (force_refresh or SCHEMA_CACHE_REFRESH):
+        cached = schema_cache.get(key)
+        telemetry.record_cache(bool(cached))
+        if cached:
+            return cached
+
+    try:
+        output, (_, answered_by) = gen_structured([{"role": "system", "content": system_prompt}],
+                                                  PotentialMistakes, temperature=temperature,
+                                                  required_keys=list(task_schema), site='mistakes',
+                                                  with_route=True)
+        potential_mistakes = dump(output)
+    except StructuredOutputError as e:
+        print(f"Failed to identify potential mistakes ({e}).")
+        return {}
     if not potential_mistakes:
         print("Failed to identify potential mistakes.")
         return {}
+    if answered_by == model:
+        schema_cache.set(key, potential_mistakes)
     return potential_mistakes
 
 
-def create_character_schema(agent, task_schema, potential_mistakes):
-    system_prompt = f"""Provide a personalized character schema JSON for student {agent.name} based on the current Task Schema.
+@telemetry.traced()
+def summarize_discussion(previous_summary, new_messages, max_words=150):
+    """Fold new discussion messages into a running summary."""
+    messages = "\n".join(new_messages)
+    system_prompt = f"""
+    You are keeping notes on a middle-school math discussion.
+    Update the running summary with the new messages below.
+    Keep who proposed which steps and answers, which mistakes were made, and which were corrected.
+    Use at most {max_words} words and return only the summary text.
+
+    Running summary: {previous_summary or "None yet."}
+
+    New messages:
+    {messages}
+    """
+    return gen_routed('summary', [{"role": "system", "content": system_prompt}]).strip()
+
+def _character_schema_prompt(agent, task_schema, potential_mistakes):
+    return f"""Provide a personalized character schema JSON for student {agent.name} based on the current Task Schema.
     You are a math teacher creating a personalized task schema for a middle school student named {agent.name}.
     {agent.name}'s persona: {agent.persona}
     Based on the {potential_mistakes} identified, modify the task schema to reflect how {agent.name} might approach this problem. 
@@ -343,24 +797,172 @@ def create_character_schema(agent, task_schema, potential_mistakes):
 
     Return ONLY valid JSON with the exact same structure as the input schema, adding student_approach to each task."""
 
+def _roster_schema_prompt(agents, task_schema, potential_mistakes):
+    students = "\n".join(f"    - {agent.name}: {agent.persona}" for agent in agents)
+    return f"""Provide a personalized character schema JSON for each student below based on the current Task Schema.
+    You are a math teacher creating personalized task schemas for middle school students.
+    For each student, modify the task schema to reflect how they might approach this problem given their persona and the Known Mistakes.
+    Consider their understanding, common misconceptions, and step-by-step thinking process.
+    Maintain the overall structure of the given task schema, but customize the details to match each student's character.
+    Different students should not all make the same mistakes.
+
+    Students:
+{students}
+
+    Task Schema: {json.dumps(task_schema, indent=2)}
+    Known Mistakes: {json.dumps(potential_mistakes, indent=2)}
+
+    Required fields for each task:
+    - description
+    - steps
+    - variables 
+    - student_approach (natural thought process)
+
+    Return ONLY valid JSON mapping each student's name to their character schema, where each character schema
+    has the exact same structure as the input schema, adding student_approach to each task:
+    {{"<student name>": {{<character schema>}}, ...}}"""
+
+def valid_character_schema(schema, task_schema):
+    """A character schema must be a non-empty dict of tasks covering the task schema."""
+    if not isinstance(schema, dict) or not schema:
+        return False
+    if not all(isinstance(task, dict) for task in schema.values()):
+        return False
+    return set(task_schema) <= set(schema) if isinstance(task_schema, dict) else True
+
+@telemetry.traced("create_character_schema")
+async def acreate_character_schema(agent, task_schema, potential_mistakes):
+    system_prompt = _character_schema_prompt(agent, task_schema, potential_mistakes)
+
     try:
-        response = gen_oai([{
+        character_schema = await agen_structured([{
             "role": "system", 
             "content": system_prompt
-        }], model="gpt-4")
-        
-        character_schema = parse_json(response)
-        
-        if not character_schema or not isinstance(character_schema, dict):
-            print(f"Invalid schema generated for {agent.name}. Response: {response}")
-            return task_schema
-            
-        return character_schema
-        
+        }], CharacterSchema, required_keys=list(task_schema), site='character_schema')
+        return dump(character_schema)
+
+    except StructuredOutputError as e:
+        print(f"Invalid schema generated for {agent.name} ({e}). Using the task schema.")
+        return task_schema
     except Exception as e:
         print(f"Error generating schema: {e}")
         return task_schema
 
+def create_character_schema(agent, task_schema, potential_mistakes):
+    return run_sync(acreate_character_schema(agent, task_schema, potential_mistakes))
+
+ROSTER_BATCH_SIZE = int(os.getenv('ROSTER_BATCH_SIZE', '3'))
+
+async def _acreate_roster_batch(agents, task_schema, potential_mistakes):
+    system_prompt = _roster_schema_prompt(agents, task_schema, potential_mistakes)
+    try:
+        schemas = dump(await agen_structured([{"role": "system", "content": system_prompt}],
+                                             RosterSchemas, max_tokens=1200 * len(agents),
+                                             required_keys=[agent.name for agent in agents],
+                                             site='character_schema'))
+    except StructuredOutputError as e:
+        # Keep the students that did validate; the rest go per agent
+        print(f"Roster schemas incomplete: {e}")
+        partial = e.partial if isinstance(e.partial, dict) else {}
+        schemas = {}
+        for name, schema in partial.items():
+            output, _ = validate_output(CharacterSchema, schema, list(task_schema))
+            if output is not None:
+                schemas[name] = dump(output)
+    except Exception as e:
+        print(f"Error generating roster schemas: {e}")
+        schemas = {}
+    return [schemas.get(agent.name) if isinstance(schemas, dict) else None for agent in agents]
+
+@telemetry.traced("create_character_schemas")
+async def acreate_character_schemas(agents, task_schema, potential_mistakes,
+                                    batch_size=ROSTER_BATCH_SIZE):
+    """
+    Character schemas for a whole roster, aligned with `agents`.
+    The shared task context is sent once per batch of `batch_size` agents;
+    entries that fail validation are regenerated one agent at a time.
+    """
+    agents = list(agents)
+    # Names key the response, so duplicated names can only be done per agent
+    names = [agent.name for agent in agents]
+    batchable = [agent for agent in agents if names.count(agent.name) == 1]
+    batches = [batchable[i:i + batch_size] for i in range(0, len(batchable), batch_size)]
+    results = await asyncio.gather(*[
+        _acreate_roster_batch(batch, task_schema, potential_mistakes) for batch in batches])
+
+    schemas = {}
+    for batch, batch_schemas in zip(batches, results):
+        for agent, schema in zip(batch, batch_schemas):
+            if valid_character_schema(schema, task_schema):
+                schemas[id(agent)] = schema
+
+    failed = [agent for agent in agents if id(agent) not in schemas]
+    if failed:
+        print(f"Falling back to per-agent schemas for: {[agent.name for agent in failed]}")
+        fallbacks = await asyncio.gather(*[
+            acreate_character_schema(agent, task_schema, potential_mistakes) for agent in failed])
+        for agent, schema in zip(failed, fallbacks):
+            schemas[id(agent)] = schema
+    return [schemas[id(agent)] for agent in agents]
+
+def create_character_schemas(agents, task_schema, potential_mistakes,
+                             batch_size=ROSTER_BATCH_SIZE):
+    return run_sync(acreate_character_schemas(agents, task_schema, potential_mistakes, batch_size))
+
+def schema_fingerprint(obj):
+    """Stable hash of a JSON-serialisable schema."""
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+CHARACTER_SCHEMA_MEMO_SIZE = 256
+_character_schemas = OrderedDict()
+_character_schemas_lock = threading.Lock()
+
+def _memo_key(agent, task_schema, potential_mistakes):
+    return (agent.name, agent.persona,
+            schema_fingerprint(task_schema), schema_fingerprint(potential_mistakes))
+
+def _memo_get(key):
+    with _character_schemas_lock:
+        if key in _character_schemas:
+            _character_schemas.move_to_end(key)
+            return json.loads(_character_schemas[key])
+    return None
+
+def _memo_put(key, schema):
+    with _character_schemas_lock:
+        _character_schemas[key] = json.dumps(schema)
+        _character_schemas.move_to_end(key)
+        while len(_character_schemas) > CHARACTER_SCHEMA_MEMO_SIZE:
+            _character_schemas.popitem(last=False)
+
+def memoized_character_schema(agent, task_schema, potential_mistakes):
+    """
+    create_character_schema, memoized per (name, persona, task schema, mistakes).
+    Failed generations fall back to the task schema and are not memoized.
+    """
+    return memoized_character_schemas([agent], task_schema, potential_mistakes)[0]
+
+@telemetry.traced()
+def memoized_character_schemas(agents, task_schema, potential_mistakes):
+    """Roster-level memoized_character_schema: only memo misses hit the LLM, batched."""
+    keys = [_memo_key(agent, task_schema, potential_mistakes) for agent in agents]
+    schemas = [_memo_get(key) for key in keys]
+    missing = [i for i, schema in enumerate(schemas) if schema is None]
+    telemetry.record_cache(not missing)
+    if not missing:
+        return schemas
+
+    people = [SimpleNamespace(name=agents[i].name, persona=agents[i].persona) for i in missing]
+    if len(people) == 1:
+        generated = [create_character_schema(people[0], task_schema, potential_mistakes)]
+    else:
+        generated = create_character_schemas(people, task_schema, potential_mistakes)
+    for i, schema in zip(missing, generated):
+        schemas[i] = schema
+        if schema is not task_schema:
+            _memo_put(keys[i], schema)
+    return schemas
+
 EXAMPLE_CHARACTER_SCHEMA = {
     "task 1": {
         "description": "Factorize the numerator m^2 + 2m - 3.",
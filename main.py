@@ -1,21 +1,114 @@
 import os
 import random
-import io
-from flask import Flask, render_template, jsonify, request, send_file
+import copy
+import hmac
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import (Flask, render_template, jsonify, request, Response, g,
+                   stream_with_context)
 from agents import agent_list
 from llm_utils import *
 from math_problems import PROBLEM_MAP
+import problem_bank
+from streaming import SectionStreamParser, sse_event
+from schema_patch import apply_patch, PatchError
+from schemas import (Reflection, FullRegeneration, PatchRegeneration, FullSchemaUpdate,
+                     PatchSchemaUpdate, dump)
+from transcript import Transcript
+from sessions import SessionStore, default_backend
+from jobs import JobQueue
+from export import FORMATS, export
+import telemetry
+from context_window import (DiscussionContext, PROMPT_TOKEN_BUDGET, MIN_DISCUSSION_TOKENS,
+                            estimate_tokens)
+
+# Rough size of the fixed turn instructions, used to size the discussion window
+TURN_INSTRUCTION_TOKENS = 200
+
+# Upper bound on LLM calls a single round may have in flight at once.
+ROUND_CONCURRENCY = int(os.getenv("ROUND_CONCURRENCY", "4"))
+# "fused" reflects and regenerates a schema in one call; "two_call" uses separate calls
+SCHEMA_UPDATE_MODE = os.getenv("SCHEMA_UPDATE_MODE", "fused")
+# "patch" asks for JSON-Patch edits to the schema; "full" re-emits the whole schema
+SCHEMA_UPDATE_FORMAT = os.getenv("SCHEMA_UPDATE_FORMAT", "patch")
+# Start the next round's schema reflection as soon as a round finishes
+PREFETCH_ROUNDS = os.getenv("PREFETCH_ROUNDS", "1") == "1"
+# Seed for turn order and acts; unset, each game draws its own (kept as game.seed)
+GAME_SEED = os.getenv("GAME_SEED")
+
+# How schema updates are requested from the model, per SCHEMA_UPDATE_FORMAT,
+# and the output models they are validated against
+SCHEMA_UPDATE_PROMPTS = {
+    "full": {
+        "regeneration": FullRegeneration,
+        "update": FullSchemaUpdate,
+        "field": "schema",
+        "request": "the new character schema",
+        "format": '"schema": {<updated character schema>}',
+    },
+    "patch": {
+        "regeneration": PatchRegeneration,
+        "update": PatchSchemaUpdate,
+        "field": "patch",
+        "request": "JSON Patch (RFC 6902) operations that turn the Current Schema into the updated one",
+        "format": ('"patch": [{"op": "replace", "path": "/<task name>/<field>", "value": <new value>}]'
+                   ' (only the operations needed; paths are "/" separated keys of the Current Schema)'),
+    },
+}
 
 class Agent:
-    def __init__(self, name, persona, task_schema=None):
+    def __init__(self, name, persona, task_schema=None, potential_mistakes=None):
         self.name = name 
         self.persona = persona
         self.task_schema = task_schema if task_schema is not None else {}
-        self.character_schema = create_character_schema(self, self.task_schema, {})
+        self.potential_mistakes = potential_mistakes if potential_mistakes is not None else {}
+        self._character_schema = None  # generated lazily, see materialize()
         self.messages = []
         self.schema_iterations = 0
+        self.schema_history = []  # every revision of the character schema, oldest first
+        self.on_event = None  # set by the game to log state changes
+
+    def _emit(self, kind, **data):
+        on_event = getattr(self, 'on_event', None)
+        if on_event is not None:
+            on_event(kind, agent=self.name, **data)
+
+    @property
+    def character_schema(self):
+        if self._character_schema is None:
+            self.materialize()
+        return self._character_schema
+
+    @character_schema.setter
+    def character_schema(self, schema):
+        self.set_character_schema(schema, source="set")
+
+    @property
+    def schema_version(self):
+        return len(self.schema_history) - 1
+
+    def set_character_schema(self, schema, source, changes=None):
+        """Replace the character schema, recording it as a new revision."""
+        self._character_schema = schema
+        self.schema_history.append({
+            "version": len(self.schema_history),
+            "source": source,
+            "changes": changes or {},
+            "schema": copy.deepcopy(schema),
+        })
+        self._emit("schema_revision", revision=self.schema_history[-1])
+
+    def materialize(self):
+        """Generate the character schema now rather than on first access."""
+        if self._character_schema is None:
+            self.set_character_schema(
+                memoized_character_schema(self, self.task_schema, self.potential_mistakes),
+                source="initial")
+        return self._character_schema
         
-    def reflect_on_schema(self, conversation_history, potential_mistakes):
+    @telemetry.traced()
+    def plan_reflection(self, conversation_history, potential_mistakes):
+        """Ask the LLM whether the schema needs updating, without changing the agent."""
         reflection_prompt = f"""
         Analyze {self.name}'s math discussion behavior:
         Character: {self.name}
@@ -35,23 +128,40 @@ class Agent:
             "update_reason": "why schema needs updating"
         }}
         """
+        return dump(gen_structured([{"role": "system", "content": reflection_prompt}], Reflection,
+                                   site="reflection"))
+
+    def apply_reflection(self, reflection):
+        """Record a planned reflection; returns whether the schema should be updated."""
+        if reflection.get('schema_updated'):
+            self.schema_iterations += 1
+            self.learning_progress = reflection.get('learning_progress', '')
+            self._emit("reflection", schema_iterations=self.schema_iterations,
+                       learning_progress=self.learning_progress)
+        return reflection.get('schema_updated', False)
+
+    @telemetry.traced()
+    def reflect_on_schema(self, conversation_history, potential_mistakes):
         try:
-            response = gen_oai([{"role": "system", "content": reflection_prompt}])
-            reflection = parse_json(response)
-            if reflection.get('schema_updated'):
-                self.schema_iterations += 1
-                self.learning_progress = reflection.get('learning_progress', '')
-            return reflection.get('schema_updated', False)
+            return self.apply_reflection(self.plan_reflection(conversation_history, potential_mistakes))
         except Exception as e:
             print(f"Schema reflection error: {e}")
             return False
-            
-    def regenerate_schema(self, conversation_history, task_schema, potential_mistakes):
+
+    @telemetry.traced()
+    def plan_schema_regeneration(self, conversation_history, task_schema, potential_mistakes,
+                                 update_format="full"):
+        """
+        Generate an updated schema and its changes, without changing the agent.
+        With update_format="patch" the model only returns edits to the current
+        schema; they are applied here, falling back to a full regeneration.
+        """
         old_schema = self.character_schema.copy()
+        update = SCHEMA_UPDATE_PROMPTS[update_format]
         regeneration_prompt = f"""
         Create an updated character schema for {self.name} based on conversation.
         Return a JSON with:
-        1. New character schema
+        1. {update["request"][:1].upper()}{update["request"][1:]}
         2. Specific changes made:
             - Which task/variable was modified
             - Old and new values
@@ -65,7 +175,7 @@ class Agent:
         
         Return JSON format:
         {{
-            "schema": {{<updated character schema>}},
+            {update["format"]},
             "changes": {{
                 "modified_task": "task name",
                 "old_value": "previous value",
@@ -76,74 +186,378 @@ class Agent:
         }}
         """
         
+        result = dump(gen_structured([{"role": "system", "content": regeneration_prompt}],
+                                     update["regeneration"], site="reflection"))
+        result = self._resolve_patch(result, conversation_history, task_schema, potential_mistakes)
+        if not valid_character_schema(result.get("schema"), task_schema):
+            raise StructuredOutputError("regenerated schema does not cover the task schema")
+        return result
+
+    def _resolve_patch(self, result, conversation_history, task_schema, potential_mistakes):
+        """Turn a {"patch": [...]} update into a full schema, regenerating if it does not apply."""
+        if not result or "patch" not in result:
+            return result
         try:
-            response = gen_oai([{"role": "system", "content": regeneration_prompt}])
-            result = parse_json(response)
-            
-            if result and "schema" in result:
-                self.character_schema = result["schema"]
-                self.schema_changes = result.get("changes", {})
-                print(f"[{self.name}] Schema updated: {self.schema_changes}")
-            else:
-                print(f"[{self.name}] Schema regeneration failed")
-                
+            schema = apply_patch(self.character_schema, result["patch"])
+            if not valid_character_schema(schema, task_schema):
+                raise PatchError("patched schema does not cover the task schema")
+            return {"schema": schema, "changes": result.get("changes", {}), "source": "patch"}
+        except PatchError as e:
+            print(f"[{self.name}] Schema patch rejected ({e}), regenerating the full schema")
+        return self.plan_schema_regeneration(conversation_history, task_schema, potential_mistakes)
+
+    @telemetry.traced()
+    def plan_schema_update(self, conversation_history, task_schema, potential_mistakes,
+                           update_format="full"):
+        """
+        Reflection and, if needed, the updated schema in a single LLM call.
+        Returns (reflection, regeneration) like the two-call path.
+        """
+        update = SCHEMA_UPDATE_PROMPTS[update_format]
+        update_prompt = f"""
+        Analyze {self.name}'s math discussion behavior and update their character schema if needed.
+        Character: {self.name}
+        Original Persona: {self.persona}
+        Conversation: {conversation_history}
+        Current Schema: {json.dumps(self.character_schema, indent=2)}
+        Task Schema: {json.dumps(task_schema, indent=2)}
+        Potential Mistakes: {json.dumps(potential_mistakes, indent=2)}
+
+        Identify:
+        1. Understanding changes
+        2. Schema updates needed
+        3. Learning progress
+
+        If the schema needs updating, also return {update["request"]} and the specific changes made:
+            - Which task/variable was modified
+            - Old and new values
+            - Reason for update based on conversation
+        If it does not, leave out "{update["field"]}" and "changes".
+
+        Return JSON:
+        {{
+            "errors_made": ["error_type"],
+            "learning_progress": "description of understanding changes",
+            "schema_updated": bool,
+            "update_reason": "why schema needs updating",
+            {update["format"]},
+            "changes": {{
+                "modified_task": "task name",
+                "old_value": "previous value",
+                "new_value": "updated value",
+                "update_reason": "explanation from conversation",
+                "mistakes_addressed": ["specific mistakes being corrected"]
+            }}
+        }}
+        """
+        result = dump(gen_structured([{"role": "system", "content": update_prompt}],
+                                     update["update"], max_tokens=2000, site="reflection"))
+        reflection = {key: result.get(key) for key in
+                      ("errors_made", "learning_progress", "schema_updated", "update_reason")
+                      if key in result}
+        regeneration = None
+        if reflection.get('schema_updated'):
+            try:
+                if isinstance(result.get("patch"), list):
+                    regeneration = self._resolve_patch(
+                        {"patch": result["patch"], "changes": result.get("changes", {})},
+                        conversation_history, task_schema, potential_mistakes)
+                elif valid_character_schema(result.get("schema"), task_schema):
+                    regeneration = {"schema": result["schema"], "changes": result.get("changes", {})}
+                else:
+                    # The model decided on an update but did not include a usable schema
+                    regeneration = self.plan_schema_regeneration(
+                        conversation_history, task_schema, potential_mistakes)
+            except StructuredOutputError as e:
+                # Keep the reflection; only the schema stays as it was
+                print(f"[{self.name}] Schema regeneration error: {e}")
+        return reflection, regeneration
+
+    def apply_schema_regeneration(self, result):
+        if result and "schema" in result:
+            self.schema_changes = result.get("changes", {})
+            self._emit("schema_changes", changes=self.schema_changes)
+            self.set_character_schema(result["schema"], source=result.get("source", "full"),
+                                      changes=self.schema_changes)
+            print(f"[{self.name}] Schema updated: {self.schema_changes}")
+        else:
+            print(f"[{self.name}] Schema regeneration failed")
+
+    @telemetry.traced()
+    def regenerate_schema(self, conversation_history, task_schema, potential_mistakes):
+        try:
+            self.apply_schema_regeneration(
+                self.plan_schema_regeneration(conversation_history, task_schema, potential_mistakes))
         except Exception as e:
             print(f"Error: {e}")
 
 
 class Game:
-    def __init__(self, agents, math_problem):
+    def __init__(self, agents, math_problem, max_workers=ROUND_CONCURRENCY, force_refresh=False,
+                 prefetch=PREFETCH_ROUNDS, schema_update_mode=SCHEMA_UPDATE_MODE,
+                 schema_update_format=SCHEMA_UPDATE_FORMAT, seed=GAME_SEED):
         self.math_problem = math_problem
+        # Turn order and acts come from this RNG, so a game replays exactly from its seed
+        self.seed = int(seed) if seed is not None else random.randrange(2 ** 32)
+        self.rng = random.Random(self.seed)
+        self.max_workers = max(1, max_workers)
+        self.schema_update_mode = schema_update_mode
+        self.schema_update_format = schema_update_format
+        self.prefetch = prefetch
+        self._prefetch = None
+        self._summary = None  # future of the summary fold started at the end of a round
+        self.events = None  # EventLog recording state changes, see attach_log()
         print(f"Generating task schema for problem: {math_problem}")
         
         # 1. Generate task schema first
-        self.task_schema = self._generate_task_schema(math_problem)
+        self.task_schema = self._generate_task_schema(math_problem, force_refresh)
         
         # 2. Identify potential mistakes based on task schema
         print("Identifying potential mistakes...")
-        self.potential_mistakes = self._identify_potential_mistakes()
+        self.potential_mistakes = self._identify_potential_mistakes(force_refresh)
         
         # 3. Create agents with personalized character schemas
-        self.agents = []
-        for agent_data in agents:
-            agent = Agent(name=agent_data.name, persona=agent_data.persona)
-            agent.character_schema = create_character_schema(
-                agent,
-                self.task_schema,
-                self.potential_mistakes
-            )
-            self.agents.append(agent)
-
-        self.public_messages = []
-        self.gamestate = f"MATH PROBLEM: {self.math_problem}\n\nDISCUSSION SO FAR:\n"
+        self.agents = [
+            Agent(name=agent_data.name, persona=agent_data.persona,
+                  task_schema=self.task_schema, potential_mistakes=self.potential_mistakes)
+            for agent_data in agents
+        ]
+        self.materialize_agents()
+
+        self.transcript = Transcript(f"MATH PROBLEM: {self.math_problem}\n\nDISCUSSION SO FAR:\n")
+        self.context = DiscussionContext(self.transcript, summarize=summarize_discussion)
+        self.prompt_usage = {}  # agent name -> token usage of their last prompt
         self.final_answers_sent = False
+        self.rounds_played = 0
+        self.usage = {}  # see record_usage()
+        self._reflections = {"messages": None, "reflections": {}}
+        self._reflections_lock = threading.Lock()
 
-    def _generate_task_schema(self, math_problem):
+    def attach_log(self, log, snapshot=True):
+        """Record every later state change in `log`, starting with a snapshot of now."""
+        self.events = log
+        for agent in self.agents:
+            agent.on_event = self._record
+        if snapshot:
+            log.write_snapshot(self.snapshot())
+
+    def _record(self, kind, **data):
+        if self.events is not None:
+            self.events.append(kind, data)
+
+    def record_usage(self, **usage):
+        """
+        Keep the caller's cumulative resource use (e.g. batch_run's tokens and
+        cost) with the game, in its event log, so it survives a restart.
+        """
+        self.usage = usage
+        self._record("usage", **usage)
+
+    def _snapshot_if_due(self):
+        if self.events is not None and self.events.snapshot_due():
+            self.events.write_snapshot(self.snapshot())
+
+    def snapshot(self):
+        """Everything needed to resume the game, as JSON-compatible data."""
+        lines = self.transcript.lines
+        speakers = [self.transcript.speaker(i) for i in range(len(lines))]
+        return {
+            "math_problem": self.math_problem,
+            "seed": self.seed,
+            "rng": self.rng.getstate(),
+            "settings": {"max_workers": self.max_workers, "prefetch": self.prefetch,
+                         "schema_update_mode": self.schema_update_mode,
+                         "schema_update_format": self.schema_update_format},
+            "task_schema": self.task_schema,
+            "potential_mistakes": self.potential_mistakes,
+            "agents": [{
+                "name": agent.name,
+                "persona": agent.persona,
+                "schema_history": agent.schema_history,
+                "schema_iterations": agent.schema_iterations,
+                "learning_progress": getattr(agent, 'learning_progress', None),
+                "schema_changes": getattr(agent, 'schema_changes', None),
+            } for agent in self.agents],
+            # Transcript lines are "<speaker>: <message>"
+            "messages": [[speaker, line[len(speaker) + 2:]] for speaker, line in zip(speakers, lines)],
+            "summary": self.context.summary,
+            "summarized_count": self.context.summarized_count,
+            "final_answers_sent": self.final_answers_sent,
+            "rounds_played": self.rounds_played,
+            "usage": self.usage,
+        }
+
+    @classmethod
+    def restore(cls, state, events=()):
+        """A game from snapshot() output plus the events logged after it; makes no LLM calls."""
+        game = cls.__new__(cls)
+        game.math_problem = state["math_problem"]
+        game.seed = state["seed"]
+        game.rng = random.Random()
+        game._set_rng_state(state["rng"])
+        settings = state["settings"]
+        game.max_workers = settings["max_workers"]
+        game.prefetch = settings["prefetch"]
+        game.schema_update_mode = settings["schema_update_mode"]
+        game.schema_update_format = settings["schema_update_format"]
+        game._prefetch = None
+        game._summary = None
+        game.events = None
+        game.task_schema = state["task_schema"]
+        game.potential_mistakes = state["potential_mistakes"]
+        game.agents = []
+        for data in state["agents"]:
+            agent = Agent(data["name"], data["persona"], game.task_schema, game.potential_mistakes)
+            agent.schema_history = data["schema_history"]
+            agent._character_schema = copy.deepcopy(data["schema_history"][-1]["schema"])
+            agent.schema_iterations = data["schema_iterations"]
+            for field in ("learning_progress", "schema_changes"):
+                if data[field] is not None:
+                    setattr(agent, field, data[field])
+            game.agents.append(agent)
+        game.transcript = Transcript(f"MATH PROBLEM: {game.math_problem}\n\nDISCUSSION SO FAR:\n")
+        for speaker, message in state["messages"]:
+            game.transcript.append(speaker, message)
+        game.context = DiscussionContext(game.transcript, summarize=summarize_discussion)
+        game.context.summary = state["summary"]
+        game.context.summarized_count = state["summarized_count"]
+        game.prompt_usage = {}
+        game.final_answers_sent = state["final_answers_sent"]
+        game.rounds_played = state.get("rounds_played", 0)
+        game.usage = state.get("usage", {})
+        game._reflections = {"messages": None, "reflections": {}}
+        game._reflections_lock = threading.Lock()
+        for event in events:
+            game.apply_event(event["type"], event["data"])
+        return game
+
+    def _set_rng_state(self, state):
+        version, internal, gauss = state
+        self.rng.setstate((version, tuple(internal), gauss))
+
+    def apply_event(self, kind, data):
+        """Redo one logged state change."""
+        agent = next((a for a in self.agents if a.name == data.get("agent")), None)
+        if kind == "message":
+            self.transcript.append(data["agent"], data["message"])
+        elif kind == "schema_revision":
+            agent.schema_history.append(data["revision"])
+            agent._character_schema = copy.deepcopy(data["revision"]["schema"])
+        elif kind == "schema_changes":
+            agent.schema_changes = data["changes"]
+        elif kind == "reflection":
+            agent.schema_iterations = data["schema_iterations"]
+            agent.learning_progress = data["learning_progress"]
+        elif kind == "round_end":
+            self.context.summary = data["summary"]
+            self.context.summarized_count = data["summarized_count"]
+            self._set_rng_state(data["rng"])
+            self.rounds_played = data["round"]
+        elif kind == "summary":
+            self.context.summary = data["summary"]
+            self.context.summarized_count = data["summarized_count"]
+        elif kind == "usage":
+            self.usage = data
+        elif kind == "final_answers_sent":
+            self.final_answers_sent = True
+        else:
+            raise ValueError(f"unknown game event {kind!r}")
+
+    def _generate_task_schema(self, math_problem, force_refresh=False):
         print(f"Generating task schema for problem: {math_problem}")
-        task_schema = generate_task_schema(math_problem)
+        task_schema = generate_task_schema(math_problem, force_refresh=force_refresh)
         if not task_schema:
             print("Failed to generate task schema. Using an empty schema as fallback.")
             return {}
         print(f"Generated task schema: {task_schema}")
         return task_schema
 
-    def _identify_potential_mistakes(self):
+    def _identify_potential_mistakes(self, force_refresh=False):
         print("Identifying potential mistakes...")
-        potential_mistakes = identify_potential_mistakes(self.task_schema)
+        potential_mistakes = identify_potential_mistakes(self.task_schema, force_refresh=force_refresh)
         if not potential_mistakes:
             print("Failed to identify potential mistakes. Using an empty dictionary as fallback.")
             return {}
         print(f"Identified potential mistakes: {potential_mistakes}")
         return potential_mistakes
 
+    @telemetry.traced()
+    def materialize_agents(self):
+        """Generate every pending agent's character schema in one roster-level request."""
+        pending = [agent for agent in self.agents if agent._character_schema is None]
+        if not pending:
+            return
+        schemas = memoized_character_schemas(pending, self.task_schema, self.potential_mistakes)
+        for agent, schema in zip(pending, schemas):
+            agent.character_schema = schema
+
+    @property
+    def public_messages(self):
+        """Formatted "name: message" lines, oldest first."""
+        return self.transcript.lines
+
+    @property
+    def gamestate(self):
+        return self.transcript.render()
+
+    def _discussion_budget(self, agent):
+        """Discussion tokens in `agent`'s turn prompt: whatever the budget leaves after the schema."""
+        fixed = estimate_tokens(str(agent.character_schema)) + TURN_INSTRUCTION_TOKENS
+        return max(MIN_DISCUSSION_TOKENS, PROMPT_TOKEN_BUDGET - fixed)
+
+    def discussion(self, budget=None):
+        """The rendered discussion context, once any pending summary fold has landed."""
+        summary = self._summary
+        if summary is not None:
+            summary.result()
+        return self.context.render(budget)
+
+    def _summarize(self, budget, reserve):
+        folded = self.context.summarized_count
+        self.context.end_round(budget, reserve)
+        if self.context.summarized_count != folded:
+            self._record("summary", summary=self.context.summary,
+                         summarized_count=self.context.summarized_count)
+
+    def start_summary(self):
+        """
+        Fold the turns that left the verbatim window into the rolling summary
+        in the background, so the summary call overlaps the gap between
+        rounds; discussion() waits for it. Folds against the smallest turn
+        budget, leaving room for a round as long as the one just played, so
+        the next round's prompts still fit once its turns are added.
+        """
+        budget = min(self._discussion_budget(agent) for agent in self.agents)
+        reserve = sum(estimate_tokens(line) + 1
+                      for line in self.transcript.lines[-len(self.agents):])
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+        self._summary = telemetry.submit(executor, self._summarize, budget, reserve)
+        executor.shutdown(wait=False)
+
     def update_gamestate(self, agent_name, message, act):
-        # Ensure the message format includes the agent's name
-        formatted_message = f"{agent_name}: {message}"
-        self.public_messages.append(formatted_message)  # Append to the discussion log
-        self.gamestate = f"MATH PROBLEM: {self.math_problem}\n\nDISCUSSION SO FAR:\n" + "\n".join(self.public_messages)
+        # The transcript formats the message with the agent's name
+        self.transcript.append(agent_name, message)
+        self._record("message", agent=agent_name, message=message, act=act)
+
+    def _stream_turn(self, messages, on_token):
+        """Stream a turn, passing each parsed Reasoning/Message delta to on_token."""
+        parser = SectionStreamParser()
+        chunks = []
+        for delta in stream_routed("turn", messages):
+            chunks.append(delta)
+            for section, text in parser.feed(delta):
+                on_token(section, text)
+        for section, text in parser.close():
+            on_token(section, text)
+        return "".join(chunks)
 
-    def instruct_agent(self, agent, act):
+    @telemetry.traced()
+    def instruct_agent(self, agent, act, on_token=None):
         is_first_message = len(self.public_messages) < len(self.agents)
+
+        discussion, discussion_usage = "", {}
+        if not is_first_message:
+            discussion, discussion_usage = self.discussion(self._discussion_budget(agent))
         
         prompt_content = {
             "first_message": f"""
@@ -164,7 +578,7 @@ class Game:
             Must: Engage with previous comments naturally
             Keep: Middle-school Student-like tone, one sentence only
             Character Schema: {agent.character_schema}
-            Discussion: {self.gamestate}
+            Discussion: {discussion}
             
             Format your response exactly like this:
             Reasoning: [Your reasoning here]
@@ -172,11 +586,26 @@ class Game:
             """
         }
 
+        prompt = prompt_content["first_message"] if is_first_message else prompt_content["regular"]
+        schema_tokens = 0 if is_first_message else estimate_tokens(str(agent.character_schema))
+        total_tokens = estimate_tokens(prompt)
+        self.prompt_usage[agent.name] = {
+            "total": total_tokens,
+            "character_schema": schema_tokens,
+            "discussion": discussion_usage.get("total", 0),
+            "instructions": total_tokens - schema_tokens - discussion_usage.get("total", 0),
+            "discussion_sections": discussion_usage,
+        }
+
         try:
-            response = gen_oai([{
+            messages = [{
                 "role": "system", 
-                "content": prompt_content["first_message"] if is_first_message else prompt_content["regular"]
-            }], model="gpt-4")
+                "content": prompt
+            }]
+            if on_token is None:
+                response = gen_routed("turn", messages)
+            else:
+                response = self._stream_turn(messages, on_token)
             
             reasoning = re.search(r'Reasoning:?\s*(.+?)(?=Message:|$)', response, re.DOTALL)
             message = re.search(r'Message:?\s*(.+?)(?=$)', response, re.DOTALL)
@@ -224,7 +653,7 @@ class Game:
         task_descriptions = "\n".join([f"Task {i+1}: {task['description']}" 
                                      for i, task in enumerate(self.task_schema.values())])
         
-        conversation_history = "\n".join(self.public_messages[-3:]) if self.public_messages else "No messages yet."
+        conversation_history = self.transcript.last(3) if self.public_messages else "No messages yet."
         
         return f"""
         As {agent.name}, a {agent.persona}, respond to this math discussion.
@@ -264,172 +693,440 @@ class Game:
             cleaned = re.sub(pattern, replacement, cleaned)
         return cleaned.strip()
 
+    @telemetry.traced()
     def generate_reflection(self, agent):
         """Generate a reflection based on the conversation history"""
+        try:
+            return self._reflect(agent)
+        except Exception as e:
+            print(f"Error generating reflection: {e}")
+            return "Unable to generate reflection."
+
+    def _reflect(self, agent):
+        discussion, _ = self.discussion()
         reflection_prompt = f"""
         Based on {agent.name}'s contributions to the math discussion so far, 
         summarize their thought process and approach in 2-3 sentences.
         Consider their understanding, strategy, and interaction with others.
         
         Previous messages:
-        {self.gamestate}
+        {discussion}
         """
-        
+        return gen_routed("reflection", [{"role": "system", "content": reflection_prompt}])
+
+    @telemetry.traced()
+    def final_reflections(self):
+        """
+        Every agent's reflection on the discussion, by name. Computed in
+        parallel and kept until the discussion grows; failed reflections are
+        not kept, so the next call retries them.
+        """
+        with self._reflections_lock:
+            version = len(self.transcript)
+            if self._reflections["messages"] != version:
+                self._reflections = {"messages": version, "reflections": {}}
+            cached = self._reflections["reflections"]
+            missing = [agent for agent in self.agents if agent.name not in cached]
+            telemetry.record_cache(not missing)
+            if missing:
+                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    futures = [telemetry.submit(executor, self._reflect, agent) for agent in missing]
+                for agent, future in zip(missing, futures):
+                    try:
+                        cached[agent.name] = future.result()
+                    except Exception as e:
+                        print(f"Error generating reflection for {agent.name}: {e}")
+            return {agent.name: cached.get(agent.name, "Unable to generate reflection.")
+                    for agent in self.agents}
+
+    def cached_reflections(self):
+        """Reflections already computed for the current discussion; never calls the model."""
+        with self._reflections_lock:
+            if self._reflections["messages"] != len(self.transcript):
+                return {}
+            return dict(self._reflections["reflections"])
+
+    def _plan_schema_update(self, agent, recent_messages):
+        """Reflection, plus regeneration if needed, for one agent. Nothing is applied."""
+        if self.schema_update_mode == "fused":
+            return agent.plan_schema_update(recent_messages, self.task_schema, self.potential_mistakes,
+                                            update_format=self.schema_update_format)
+        reflection = agent.plan_reflection(recent_messages, self.potential_mistakes)
+        regeneration = None
+        if reflection.get('schema_updated'):
+            try:
+                regeneration = agent.plan_schema_regeneration(
+                    recent_messages, self.task_schema, self.potential_mistakes,
+                    update_format=self.schema_update_format)
+            except StructuredOutputError as e:
+                print(f"[{agent.name}] Schema regeneration error: {e}")
+        return reflection, regeneration
+
+    def _apply_schema_update(self, agent, plan):
+        """Apply a planned update (a future from _plan_schema_update) to its agent."""
         try:
-            reflection = gen_oai([{"role": "system", "content": reflection_prompt}])
-            return reflection
+            reflection, regeneration = plan.result()
+            if agent.apply_reflection(reflection):
+                agent.apply_schema_regeneration(regeneration)
+                # Store schema update info, but don't append to round_data yet
+                agent.schema_update_info = {
+                    "schema_updated": True,
+                    "learning_progress": getattr(agent, 'learning_progress', 'Learned from recent discussion'),
+                    "schema_changes": getattr(agent, 'schema_changes', 'Schema modifications detected')
+                }
         except Exception as e:
-            print(f"Error generating reflection: {e}")
-            return "Unable to generate reflection."
-        
-    def run_round(self, current_round, total_rounds):
-        round_data = []
-        agents = self.agents[:]
-        random.shuffle(agents)
+            print(f"Schema reflection error for {agent.name}: {e}")
 
-        # Schema reflection for subsequent rounds
-        if current_round > 1:
-            recent_messages = "\n".join(self.public_messages[-10:])
-            for agent in agents:
-                try:
-                    reflection_result = agent.reflect_on_schema(recent_messages, self.potential_mistakes)
-                    if reflection_result:
-                        agent.regenerate_schema(recent_messages, self.task_schema, self.potential_mistakes)
-                        # Store schema update info, but don't append to round_data yet
-                        agent.schema_update_info = {
-                            "schema_updated": True,
-                            "learning_progress": getattr(agent, 'learning_progress', 'Learned from recent discussion'),
-                            "schema_changes": getattr(agent, 'schema_changes', 'Schema modifications detected')
-                        }
-                except Exception as e:
-                    print(f"Schema reflection error for {agent.name}: {e}")
-
-        # Ensure one message per agent per round
+    def prefetch_reflections(self, next_round):
+        """
+        Start `next_round`'s reflection step in the background. It only reads
+        messages that already exist, so it can overlap the UI replaying the
+        current round; run_round discards it if the discussion moved on.
+        """
+        self.cancel_prefetch()
+        if next_round <= 1:
+            return
+        recent_messages = self.transcript.last(10)
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="prefetch")
+        futures = {id(agent): telemetry.submit(executor, self._plan_schema_update, agent, recent_messages)
+                   for agent in self.agents}
+        executor.shutdown(wait=False)
+        self._prefetch = {"round": next_round, "messages": len(self.transcript), "futures": futures}
+
+    def cancel_prefetch(self):
+        prefetch, self._prefetch = self._prefetch, None
+        if prefetch:
+            for future in prefetch["futures"].values():
+                future.cancel()
+
+    def _take_prefetch(self, current_round):
+        """Prefetched plans for this round, if they were made from the current discussion."""
+        prefetch = self._prefetch
+        if (prefetch and prefetch["round"] == current_round
+                and prefetch["messages"] == len(self.transcript)
+                and set(prefetch["futures"]) == {id(agent) for agent in self.agents}):
+            self._prefetch = None
+            return prefetch["futures"]
+        self.cancel_prefetch()
+        return None
+
+    def close(self):
+        """Drop any background work and the event log; called when the game is reset or evicted."""
+        self.cancel_prefetch()
+        if self.events is not None:
+            self.events.close()
+            self.events = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_prefetch"] = None
+        state["_summary"] = None
+        state["events"] = None  # the log stays with this process
+        del state["_reflections_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault("events", None)
+        self.__dict__.setdefault("_summary", None)
+        self.__dict__.setdefault("rounds_played", 0)
+        self.__dict__.setdefault("usage", {})
+        self._reflections_lock = threading.Lock()
+        self.__dict__.setdefault("_reflections", {"messages": None, "reflections": {}})
+        if "rng" not in state:  # saved before games were seeded
+            self.seed = random.randrange(2 ** 32)
+            self.rng = random.Random(self.seed)
+
+    def _plan_acts(self, agents, current_round, total_rounds):
+        """Pick each agent's action up front so turns never wait on it."""
+        acts = []
+        previous_messages = len(self.public_messages)
         for i, agent in enumerate(agents):
             if current_round == 1 and i == 0:
                 act = "Begin solving the problem"
             elif current_round == total_rounds - 1:
                 act = "Provide final answer with explanation"
+            elif previous_messages + i < 2:
+                act = "Start approaching the problem"
+            elif i == 0:
+                act = "Build on previous work"
             else:
-                previous_messages = len(self.public_messages)
-                if previous_messages < 2:
-                    act = "Start approaching the problem"
-                elif i == 0:
-                    act = "Build on previous work"
+                acts_pool = ["Ask for clarification", "Point out important details",
+                    "Suggest next steps", "Check for mistakes", "Add to the discussion"]
+                act = self.rng.choice(acts_pool)
+            acts.append(act)
+        return acts
+
+    @telemetry.traced()
+    def run_round(self, current_round, total_rounds, on_event=None):
+        """
+        Play one round. If on_event is given, turns are streamed and it is
+        called as on_event(event, data) for "turn_start", "token" and "turn_end".
+        """
+        round_data = []
+        agents = self.agents[:]
+        self.rng.shuffle(agents)
+        acts = self._plan_acts(agents, current_round, total_rounds)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # Schema reflection for subsequent rounds, fanned out across agents
+            # (or already prefetched). Each agent only depends on messages
+            # from earlier rounds.
+            plans = [None] * len(agents)
+            if current_round > 1:
+                prefetched = self._take_prefetch(current_round)
+                if prefetched:
+                    plans = [prefetched[id(agent)] for agent in agents]
                 else:
-                    acts = ["Ask for clarification", "Point out important details", 
-                        "Suggest next steps", "Check for mistakes", "Add to the discussion"]
-                    act = random.choice(acts)
-            
-            response = self.instruct_agent(agent, act)
-            self.update_gamestate(agent.name, response["message"], act)
-            
-            # Combine schema update info (if any) with the agent's response
-            agent_data = {
-                "name": agent.name,
-                "message": response["message"],
-                "reasoning": response["reasoning"],
-                "act": act,
-                "schema_updated": False,
-                "learning_progress": "",
-                "schema_changes": ""
-            }
-            
-            if hasattr(agent, 'schema_update_info'):
-                agent_data.update(agent.schema_update_info)
-                delattr(agent, 'schema_update_info')  # Clear the temporary attribute
-            
-            round_data.append(agent_data)
+                    recent_messages = self.transcript.last(10)
+                    plans = [telemetry.submit(executor, self._plan_schema_update, agent,
+                                              recent_messages)
+                             for agent in agents]
+
+            # Turns stay ordered: each agent's turn starts as soon as its own
+            # reflection is done and the previous agent's message has landed.
+            for agent, act, plan in zip(agents, acts, plans):
+                if plan is not None:
+                    self._apply_schema_update(agent, plan)
+
+                on_token = None
+                if on_event is not None:
+                    on_event("turn_start", {"name": agent.name, "act": act})
+                    on_token = lambda section, text, name=agent.name: on_event(
+                        "token", {"name": name, "section": section, "text": text})
+
+                response = self.instruct_agent(agent, act, on_token=on_token)
+                self.update_gamestate(agent.name, response["message"], act)
+
+                # Combine schema update info (if any) with the agent's response
+                agent_data = {
+                    "name": agent.name,
+                    "message": response["message"],
+                    "reasoning": response["reasoning"],
+                    "act": act,
+                    "schema_updated": False,
+                    "learning_progress": "",
+                    "schema_changes": ""
+                }
+
+                if hasattr(agent, 'schema_update_info'):
+                    agent_data.update(agent.schema_update_info)
+                    delattr(agent, 'schema_update_info')  # Clear the temporary attribute
 
+                round_data.append(agent_data)
+                if on_event is not None:
+                    on_event("turn_end", agent_data)
+
+        self.rounds_played = current_round
+        self._record("round_end", round=current_round, summary=self.context.summary,
+                     summarized_count=self.context.summarized_count, rng=self.rng.getstate())
+        self._snapshot_if_due()
+        # Once per round, off the turn path
+        self.start_summary()
+        if self.prefetch and current_round + 1 < total_rounds:
+            self.prefetch_reflections(current_round + 1)
         return round_data
     
+    @telemetry.traced()
     def get_final_answers(self):
         if self.final_answers_sent:  # Check if final answers have already been sent
             print("Final answers already sent. Skipping generation.")
             return []  # Return an empty list if already sent
 
         print("Fetching final answers...")
+        # Final answers don't see each other, so they are all asked for at once
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            responses = [telemetry.submit(executor, self.instruct_agent, agent, "final answer")
+                         for agent in self.agents]
         final_answers = []
-        for agent in self.agents:
-            response = self.instruct_agent(agent, "final answer")
-            message = response["message"]
+        for agent, response in zip(self.agents, responses):
+            message = response.result()["message"]
             message = re.sub(r'.*?(My answer:|Provide final answer with explanation:)', '', message).strip()
             message = re.sub(f'^{agent.name}:\\s*', '', message).strip()
             final_answers.append({"name": agent.name, "answer": message})
         print(f"Final answers: {final_answers}")
         self.final_answers_sent = True  # Mark final answers as sent
+        self._record("final_answers_sent")
         return final_answers
 
 
 
-def init_game(agents=[], math_problem="Simplify the following, if possible: (m^2 + 2m - 3) / (m - 3)"):
+def init_game(agents=[], math_problem="Simplify the following, if possible: (m^2 + 2m - 3) / (m - 3)",
+              force_refresh=False, seed=GAME_SEED):
     # Convert dict agents to Agent instances
     initialized_agents = [
         Agent(agent["name"], agent["persona"], agent.get("task_schema")) 
         for agent in agents
     ]
-    return Game(initialized_agents, math_problem=math_problem)
+    return Game(initialized_agents, math_problem=math_problem, force_refresh=force_refresh,
+                seed=seed)
 
 app = Flask(__name__)
-game = None
-current_agent_index = 0
-game_data = []
+sessions = SessionStore(roster=agent_list, backend=default_backend(Game.restore))
+jobs = JobQueue()
+# How long /next_agent waits for the requested agent before answering "pending"
+NEXT_AGENT_WAIT = float(os.getenv("NEXT_AGENT_WAIT", "20"))
+# Bulk /export of other sessions' transcripts is disabled unless this is set
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN", "")
+SESSION_COOKIE = 'simteach_session'
+
+def current_session():
+    """
+    The caller's session, from the session cookie only: an id in the URL or
+    body would let a third party pin a victim to a session it knows.
+    """
+    session = sessions.get(request.cookies.get(SESSION_COOKIE))
+    g.session_id = session.id
+    telemetry.bind_session(session.id)
+    return session
+
+@app.after_request
+def set_session_cookie(response):
+    session_id = getattr(g, 'session_id', None)
+    if session_id and request.cookies.get(SESSION_COOKIE) != session_id:
+        response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite='Lax')
+    return response
 
 @app.route('/')
 def index():
+    current_session()
     return render_template('index.html')
 
 @app.route('/start_simulation', methods=['POST'])
 def start_simulation():
-    global game, current_agent_index, game_data
-    game_data = []  # Reset data on new simulation
-    current_agent_index = 0
-    try:
-        data = request.json
-        
-        problem_type = data.get('problem_type')
-        if not problem_type:
-            return jsonify({"error": "Problem type not provided"}), 400
-        
-        if problem_type not in PROBLEM_MAP:
-            return jsonify({"error": "Invalid problem type"}), 400
-        
-        math_problem = PROBLEM_MAP[problem_type]['problem']
-        
-        # Initialize game with selected problem
-        game = init_game(agents=agent_list, math_problem=math_problem)
-        current_agent_index = 0
-        game_data = []
-
-        # Debugging: Ensure the game is initialized
-        if game:
-            print(f"Game initialized with math problem: {math_problem}")
-        else:
-            print("Failed to initialize game.")
-        
-        return jsonify({"status": "success"})
-    except Exception as e:
-        print(f"Error in start_simulation: {e}")
-        return jsonify({"error": str(e)}), 500
+    session = current_session()
+    with session.lock:
+        session.reset()  # Reset data on new simulation
+        try:
+            data = request.json
+            
+            # Either an Eedi question by QuestionId or one of the built-in problem types
+            question_id = data.get('question_id')
+            problem_type = data.get('problem_type')
+            if question_id is not None:
+                try:
+                    math_problem = problem_bank.bank().problem_text(int(question_id))
+                except (KeyError, ValueError):
+                    return jsonify({"error": "Unknown question id"}), 404
+            else:
+                if not problem_type:
+                    return jsonify({"error": "Problem type not provided"}), 400
+
+                if problem_type not in PROBLEM_MAP:
+                    return jsonify({"error": "Invalid problem type"}), 400
 
+                math_problem = PROBLEM_MAP[problem_type]['problem']
+            
+            # Initialize game with selected problem; force_refresh bypasses the schema cache
+            session.game = init_game(agents=session.roster, math_problem=math_problem,
+                                     force_refresh=bool(data.get('force_refresh', False)),
+                                     seed=data.get('seed', GAME_SEED))
+            sessions.save(session)
+
+            # Debugging: Ensure the game is initialized
+            if session.game:
+                print(f"Game initialized with math problem: {math_problem}")
+            else:
+                print("Failed to initialize game.")
+            
+            return jsonify({"status": "success", "session_id": session.id,
+                            "seed": session.game.seed})
+        except Exception as e:
+            print(f"Error in start_simulation: {e}")
+            return jsonify({"error": str(e)}), 500
+
+
+@app.route('/questions', methods=['GET'])
+def list_questions():
+    """Eedi QuestionIds, optionally only those of ?construct_id=, ?subject_id= or ?misconception_id=."""
+    questions = problem_bank.bank()
+    filters = {'construct_id': questions.by_construct, 'subject_id': questions.by_subject,
+               'misconception_id': questions.by_misconception}
+    ids = None
+    for name, lookup in filters.items():
+        value = request.args.get(name, type=int)
+        if value is not None:
+            matches = lookup(value)
+            if ids is None:
+                ids = matches
+            else:
+                matches = set(matches)
+                ids = [i for i in ids if i in matches]
+    return jsonify({"question_ids": questions.ids() if ids is None else ids})
+
+@app.route('/questions/<int:question_id>', methods=['GET'])
+def get_question(question_id):
+    """One Eedi question with its options and their misconceptions."""
+    try:
+        return jsonify(problem_bank.bank().question(question_id))
+    except KeyError:
+        return jsonify({"error": "Unknown question id"}), 404
 
 @app.route('/add_agent', methods=['POST'])
 def add_agent():
-    global game
+    session = current_session()
     data = request.json
-    new_agent = Agent(name=data['name'], persona=data['persona'])
     math_problem = data.get('math_problem', "Simplify the following, if possible: (m^2 + 2m - 3) / (m - 3)")
-    task_schema = generate_task_schema(math_problem)
-    potential_mistakes = identify_potential_mistakes(task_schema)
-    new_agent.character_schema = create_character_schema(new_agent, task_schema, potential_mistakes)
-    agent_list.append({"name": new_agent.name, "persona": new_agent.persona, "character_schema": new_agent.character_schema})
-    if game is None:
-        game = init_game(agent_list, math_problem=math_problem)
+    with session.lock:
+        # The character schema is built when the agent joins a Game
+        session.roster.append({"name": data['name'], "persona": data['persona']})
+        if session.game is None:
+            session.game = init_game(session.roster, math_problem=math_problem)
+        sessions.save(session)
     return jsonify({"status": "success"})
 
+def _play_round(session, current_round, total_rounds, job):
+    """Job body: run one round, publishing each agent's message as it lands."""
+    try:
+        with session.lock:
+            round_data = session.game.run_round(current_round, total_rounds, on_event=job.publish)
+            session.game_data = round_data
+            sessions.save(session)
+    except Exception as e:
+        job.publish("round_error", {"error": str(e)})
+        raise
+    job.publish("round_end", {"current_round": current_round, "next_round": current_round + 1})
+
+def ensure_round_job(session, current_round, total_rounds):
+    """The session's job for `current_round`, submitting it if it has not started yet."""
+    with session.job_lock:
+        job = jobs.get(session.round_job_id) if session.round_job_id else None
+        if job is None or session.round_job_round != current_round:
+            job = jobs.submit(lambda job: _play_round(session, current_round, total_rounds, job),
+                              session_id=session.id, current_round=current_round)
+            session.round_job_id = job.id
+            session.round_job_round = current_round
+            session.current_agent_index = 0
+        return job
+
+@app.route('/rounds', methods=['POST'])
+def submit_round():
+    """Start computing a round in the background; poll /rounds/<job_id> for progress."""
+    session = current_session()
+    data = request.json
+    current_round = data.get('current_round')
+    total_rounds = data.get('total_rounds')
+
+    if current_round is None or total_rounds is None:
+        return jsonify({"error": "Missing round information"}), 400
+    if not session.game:
+        return jsonify({"error": "Game not initialized"}), 500
+    if current_round >= total_rounds:
+        return jsonify({"error": "No rounds left"}), 400
+
+    job = ensure_round_job(session, current_round, total_rounds)
+    return jsonify({"job_id": job.id, "status": job.status}), 202
+
+@app.route('/rounds/<job_id>', methods=['GET'])
+def round_status(job_id):
+    job = jobs.get(job_id)
+    if job is None or job.session_id != current_session().id:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.snapshot())
+
 @app.route('/next_agent', methods=['POST'])
 def next_agent():
-    global current_agent_index, game_data, game
+    session = current_session()
     data = request.json
     current_round = data.get('current_round')
     total_rounds = data.get('total_rounds')
@@ -437,19 +1134,40 @@ def next_agent():
     if current_round is None or total_rounds is None:
         return jsonify({"error": "Missing round information"}), 400
 
+    game = session.game
     if not game:
         return jsonify({"error": "Game not initialized"}), 500
 
     if current_round < total_rounds:
         try:
-            if current_agent_index == 0:
-                round_data = game.run_round(current_round, total_rounds)
-                game_data = round_data
-
-            if not game_data or current_agent_index >= len(game_data):
+            if session.current_agent_index == 0:
+                job = ensure_round_job(session, current_round, total_rounds)
+            else:
+                job = jobs.get(session.round_job_id)
+            if job is None:
                 return jsonify({"error": "Invalid game data state"}), 500
 
-            agent_data = game_data[current_agent_index]
+            # Only wait for this agent's message, not for the whole round
+            current_agent_index = session.current_agent_index
+            agent_data = job.wait_for_result(current_agent_index, timeout=NEXT_AGENT_WAIT)
+            if agent_data is None:
+                if job.status == "failed":
+                    return jsonify({"error": job.error}), 500
+                if job.done:
+                    # The round ended without this agent's message; waiting longer will not help
+                    return jsonify({
+                        "error": f"Round {job.current_round} finished without a message for agent "
+                                 f"{current_agent_index + 1}",
+                        "job_id": job.id,
+                        "completed": len(job.results),
+                    }), 409
+                return jsonify({
+                    "pending": True,
+                    "job_id": job.id,
+                    "completed": len(job.results),
+                    "total": len(game.agents)
+                }), 202
+
             response_data = {
                 "agent_data": {
                     "name": agent_data.get("name", "Unknown"),
@@ -465,90 +1183,153 @@ def next_agent():
                 "next_round": current_round + 1 if current_agent_index >= len(game.agents) - 1 else current_round
             }
 
-            current_agent_index = (current_agent_index + 1) % len(game.agents)
-            
+            session.current_agent_index = (current_agent_index + 1) % len(game.agents)
+            if job.done:
+                # A running round holds session.lock until it ends and saves the
+                # session itself, so saving here would wait for the whole round
+                sessions.save(session)
+
             return jsonify(response_data)
 
         except Exception as e:
             print(f"Error in next_agent: {e}")
             return jsonify({"error": str(e)}), 500
     else:
-        final_answers = game.get_final_answers()
+        with session.lock:
+            final_answers = game.get_final_answers()
+            sessions.save(session)
         return jsonify({
             "finished": True,
             "final_answers": final_answers
         })
 
+@app.route('/stream_round', methods=['GET'])
+def stream_round():
+    """Server-sent events for a whole round, streamed token by token."""
+    session = current_session()
+    current_round = request.args.get('current_round', type=int)
+    total_rounds = request.args.get('total_rounds', type=int)
+
+    if current_round is None or total_rounds is None:
+        return jsonify({"error": "Missing round information"}), 400
+
+    if not session.game:
+        return jsonify({"error": "Game not initialized"}), 500
+
+    if current_round >= total_rounds:
+        def finished():
+            with session.lock:
+                final_answers = session.game.get_final_answers()
+                sessions.save(session)
+            yield sse_event("finished", {"final_answers": final_answers})
+        return Response(finished(), mimetype='text/event-stream')
+
+    job = ensure_round_job(session, current_round, total_rounds)
+
+    def generate():
+        seen = 0
+        while True:
+            events, done = job.wait_for_events(seen, timeout=15)
+            for event in events:
+                yield sse_event(*event)
+            seen += len(events)
+            if done and seen == len(job.events):
+                return
+            if not events:
+                yield ": keep-alive\n\n"
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def _export_response(games, fmt, name):
+    """Stream `games` ((session_id, game, reflections) tuples) as an attachment."""
+    mimetype, extension = FORMATS[fmt]
+    return Response(stream_with_context(chunk.encode() for chunk in export(games, fmt)),
+                    mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={name}.{extension}"})
+
 @app.route('/download_log', methods=['GET'])
 def download_log():
+    """The caller's discussion, as ?format=text (default), jsonl or column_groups."""
+    fmt = request.args.get('format', 'text')
+    if fmt not in FORMATS:
+        return jsonify({"error": f"Unknown format; expected one of {sorted(FORMATS)}"}), 400
+    session = current_session()
+    game = session.game
     if game and game.public_messages:  # Check if game and messages exist
-        log_content = "MATH DISCUSSION LOG\n"
-        log_content += "=" * 50 + "\n\n"
-        
-        # Add problem statement
-        log_content += f"MATH PROBLEM:\n{game.math_problem}\n\n"
-        
-        # Add participants info
-        log_content += "PARTICIPANTS:\n"
-        for agent in game.agents:
-            log_content += f"{agent.name}:\n"
-            log_content += f"  Persona: {agent.persona}\n"
-            log_content += f"  Initial Character Schema: {json.dumps(agent.character_schema, indent=2)}\n\n"
-        
-        # Add discussion messages
-        log_content += "DISCUSSION AND MESSAGES:\n"
-        log_content += "=" * 50 + "\n\n"
-        for i, message in enumerate(game.public_messages):
-            log_content += f"[{i + 1}] {message}\n"
-        
-        # Add schema update details
-        log_content += "\nSCHEMA UPDATES AND REFLECTIONS:\n"
-        log_content += "=" * 50 + "\n\n"
-        for agent in game.agents:
-            log_content += f"Agent: {agent.name}\n"
-            if hasattr(agent, 'schema_changes') and agent.schema_changes:
-                log_content += "  Schema Changes:\n"
-                log_content += f"    Reason: {agent.schema_changes.get('update_reason', 'No reason provided')}\n"
-                log_content += f"    Mistakes Addressed: {', '.join(agent.schema_changes.get('mistakes_addressed', []))}\n"
-                log_content += f"    Changes:\n"
-                log_content += json.dumps(agent.schema_changes, indent=2) + "\n"
-            else:
-                log_content += "  No schema changes recorded.\n"
-            
-            if hasattr(agent, 'learning_progress') and agent.learning_progress:
-                log_content += f"  Learning Progress:\n    {agent.learning_progress}\n"
-            log_content += "\n"
-
-        # Add final reflections (optional)
-        log_content += "FINAL REFLECTIONS:\n"
-        log_content += "=" * 50 + "\n\n"
-        for agent in game.agents:
-            reflection = game.generate_reflection(agent)
-            log_content += f"Reflection for {agent.name}:\n"
-            log_content += f"{reflection}\n\n"
-
-        # Create in-memory file
-        mem_file = io.BytesIO()
-        mem_file.write(log_content.encode())
-        mem_file.seek(0)
-        
-        return send_file(
-            mem_file,
-            mimetype='text/plain',
-            as_attachment=True,
-            download_name='math_discussion.txt'
-        )
+        # Cached on the game until the discussion grows, so repeat downloads cost no LLM calls
+        reflections = game.final_reflections()
+        return _export_response([(None, game, reflections)], fmt, 'math_discussion')
     return jsonify({"error": "No discussion to download"})
 
+@app.route('/export', methods=['GET'])
+def export_sessions():
+    """
+    The caller's session as ?format= (default jsonl). With the EXPORT_TOKEN
+    in an X-Export-Token header, several sessions in one streamed download
+    instead: ?session_ids=a,b, by default every live and stored session.
+    Sessions are read one at a time, and only reflections already computed
+    are included.
+    """
+    fmt = request.args.get('format', 'jsonl')
+    if fmt not in FORMATS:
+        return jsonify({"error": f"Unknown format; expected one of {sorted(FORMATS)}"}), 400
+    token = request.headers.get('X-Export-Token', '')
+    if EXPORT_TOKEN and hmac.compare_digest(token.encode(), EXPORT_TOKEN.encode()):
+        ids = request.args.get('session_ids')
+        ids = [session_id for session_id in ids.split(',') if session_id] if ids else None
+    elif token or request.args.get('session_ids'):
+        return jsonify({"error": "Exporting other sessions needs a valid X-Export-Token"}), 403
+    else:
+        ids = [current_session().id]
+
+    def games():
+        for session in sessions.iter_sessions(ids):
+            game = session.game
+            if game is not None and game.public_messages:
+                yield session.id, game, game.cached_reflections()
+    return _export_response(games(), fmt, 'math_discussions')
+
 
 @app.route('/reset', methods=['POST'])
 def reset_game():
-    global game, current_agent_index, game_data, agent_list
-    agent_list = agent_list[:]
-    game = None
-    current_agent_index = 0
-    game_data = []
+    session = current_session()
+    with session.lock:
+        session.reset()
+        sessions.save(session)
     return jsonify({"status": "reset"})
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus exposition of stage/LLM timings, tokens, cost, cache and rate-limit state."""
+    buckets = governor.snapshot()
+    routes = router.snapshot()
+    body = telemetry.registry.render_prometheus()
+    body += telemetry.gauge_lines("llm_queue_depth", "Requests waiting for rate-limit room.",
+                                  [({"bucket": key}, b["queue_depth"]) for key, b in buckets.items()])
+    body += telemetry.gauge_lines("llm_throttled_seconds", "Total time requests were held back.",
+                                  [({"bucket": key}, b["throttled_seconds"]) for key, b in buckets.items()])
+    body += telemetry.gauge_lines("llm_retries", "Retried LLM requests.",
+                                  [({"bucket": key}, b["retries"]) for key, b in buckets.items()])
+    body += telemetry.gauge_lines("llm_route_latency_seconds", "Rolling route latency.",
+                                  [({"route": key, "quantile": q}, r[f"p{q}"])
+                                   for key, r in routes.items() for q in (50, 95)])
+    body += telemetry.gauge_lines("llm_route_error_rate", "Rolling route error rate.",
+                                  [({"route": key}, r["error_rate"]) for key, r in routes.items()])
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+@app.route('/metrics/session')
+def session_metrics():
+    """Where the caller's session has spent its time, tokens and money so far."""
+    session = current_session()
+    return jsonify({"session_id": session.id,
+                    "timings": telemetry.registry.session(session.id) or {}})
+
+@app.route('/llm_metrics')
+def llm_metrics():
+    """Rate-limit queues, throttling and retries per model, router latency stats and cassette hits."""
+    return jsonify({"governor": governor.snapshot(), "router": router.snapshot(),
+                    "cassette": cassette.snapshot()})
+
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
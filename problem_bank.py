@@ -0,0 +1,176 @@
+"""
+The Eedi question bank (eedi_data/), loaded once and indexed.
+
+The CSVs are parsed into compact typed columns (int32 ids, categorical
+construct/subject names, int16 misconception ids with -1 for none) and
+converted to a cache, so later processes skip CSV parsing and type
+inference: uncompressed Feather files when pyarrow is installed, pickles
+otherwise. Either way the columns are loaded into pandas, i.e. copied
+into memory; the bank is small enough that this is cheaper than keeping
+an Arrow table and converting rows on every lookup. The cache is rebuilt
+whenever a CSV changes. Indexes map QuestionId to a row, and ConstructId,
+SubjectId and MisconceptionId to their questions.
+"""
+
+import hashlib
+import os
+import pickle
+import threading
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+EEDI_DIR = os.getenv("EEDI_DIR", os.path.join(ROOT, "eedi_data"))
+PROBLEM_BANK_CACHE = os.getenv("PROBLEM_BANK_CACHE", os.path.join(ROOT, ".cache", "problem_bank"))
+CACHE_VERSION = 1
+
+OPTIONS = "ABCD"
+QUESTION_DTYPES = {
+    "QuestionId": "int32",
+    "ConstructId": "int32",
+    "ConstructName": "category",
+    "SubjectId": "int32",
+    "SubjectName": "category",
+    "CorrectAnswer": "category",
+    "QuestionText": "string",
+    **{f"Answer{option}Text": "string" for option in OPTIONS},
+}
+MISCONCEPTION_COLUMNS = [f"Misconception{option}Id" for option in OPTIONS]
+
+
+def _read_questions(path):
+    frame = pd.read_csv(path, dtype=QUESTION_DTYPES)
+    for column in MISCONCEPTION_COLUMNS:
+        frame[column] = frame[column].fillna(-1).astype("int16")
+    return frame
+
+
+def _read_misconceptions(path):
+    frame = pd.read_csv(path, dtype={"MisconceptionId": "int16", "MisconceptionName": "string"})
+    frame["MisconceptionName"] = frame["MisconceptionName"].str.strip()
+    return frame
+
+
+def _fingerprint(path):
+    stat = os.stat(path)
+    return hashlib.sha256(f"{CACHE_VERSION}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+
+
+def _cached(path, read, cache_dir=PROBLEM_BANK_CACHE):
+    """`read(path)`, from the converted cache when it is current."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    cache = os.path.join(cache_dir, f"{name}-{_fingerprint(path)}.{'feather' if feather else 'pkl'}")
+    if os.path.exists(cache):
+        if feather:
+            return feather.read_table(cache, memory_map=True).to_pandas()
+        with open(cache, "rb") as f:
+            return pickle.load(f)
+    frame = read(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{cache}.tmp"
+    if feather:
+        feather.write_feather(frame, tmp, compression="uncompressed")
+    else:
+        with open(tmp, "wb") as f:
+            pickle.dump(frame, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, cache)
+    return frame
+
+
+class ProblemBank:
+    def __init__(self, questions, misconceptions):
+        self.questions = questions
+        self.misconceptions = dict(zip(misconceptions["MisconceptionId"].tolist(),
+                                       misconceptions["MisconceptionName"].tolist()))
+        self._rows = {question_id: row for row, question_id in
+                      enumerate(questions["QuestionId"].tolist())}
+        self._by_construct = self._group(questions["ConstructId"].to_numpy())
+        self._by_subject = self._group(questions["SubjectId"].to_numpy())
+        # A question belongs to every misconception behind one of its wrong answers
+        ids = questions[MISCONCEPTION_COLUMNS].to_numpy()
+        rows = np.repeat(np.arange(len(questions)), len(OPTIONS)).reshape(ids.shape)
+        tagged = ids >= 0
+        self._by_misconception = self._group(ids[tagged], rows[tagged])
+
+    def _group(self, keys, rows=None):
+        """{key: QuestionIds} for parallel arrays of keys and row positions."""
+        rows = np.arange(len(keys)) if rows is None else rows
+        question_ids = self.questions["QuestionId"].to_numpy()
+        order = np.argsort(keys, kind="stable")
+        keys, rows = keys[order], rows[order]
+        unique, starts = np.unique(keys, return_index=True)
+        return {int(key): np.unique(question_ids[group]).tolist()
+                for key, group in zip(unique, np.split(rows, starts[1:]))}
+
+    def __len__(self):
+        return len(self.questions)
+
+    def __contains__(self, question_id):
+        return question_id in self._rows
+
+    def ids(self):
+        return list(self._rows)
+
+    def question(self, question_id):
+        """One question as a dict, with each option's misconception resolved; KeyError if unknown."""
+        row = self.questions.iloc[self._rows[question_id]]
+        question = {
+            "question_id": int(row["QuestionId"]),
+            "construct_id": int(row["ConstructId"]),
+            "construct": row["ConstructName"],
+            "subject_id": int(row["SubjectId"]),
+            "subject": row["SubjectName"],
+            "correct_answer": row["CorrectAnswer"],
+            "text": row["QuestionText"],
+            "answers": {},
+        }
+        for option in OPTIONS:
+            misconception_id = int(row[f"Misconception{option}Id"])
+            text = row[f"Answer{option}Text"]
+            question["answers"][option] = {
+                "text": "" if pd.isna(text) else text,
+                "misconception_id": misconception_id if misconception_id >= 0 else None,
+                "misconception": self.misconceptions.get(misconception_id),
+            }
+        return question
+
+    def problem_text(self, question_id):
+        """The question and its options, as the math problem of a game."""
+        question = self.question(question_id)
+        options = "\n".join(f"{option}) {answer['text']}"
+                            for option, answer in question["answers"].items())
+        return f"{question['text']}\n\nOptions:\n{options}"
+
+    def by_construct(self, construct_id):
+        return self._by_construct.get(construct_id, [])
+
+    def by_subject(self, subject_id):
+        return self._by_subject.get(subject_id, [])
+
+    def by_misconception(self, misconception_id):
+        return self._by_misconception.get(misconception_id, [])
+
+
+def load_bank(directory=EEDI_DIR, cache_dir=PROBLEM_BANK_CACHE):
+    return ProblemBank(_cached(os.path.join(directory, "train.csv"), _read_questions, cache_dir),
+                       _cached(os.path.join(directory, "misconception_mapping.csv"),
+                               _read_misconceptions, cache_dir))
+
+
+_bank = None
+_bank_lock = threading.Lock()
+
+
+def bank():
+    """The process-wide problem bank, loaded on first use."""
+    global _bank
+    with _bank_lock:
+        if _bank is None:
+            _bank = load_bank()
+        return _bank
@@ -0,0 +1,276 @@
+"""
+Latency-aware routing of LLM calls across providers.
+
+Every call site names a tier, and a tier lists (provider, model) routes in
+order of preference. The router keeps rolling latency and error statistics
+per route, demotes routes that are failing, rate limited or much slower
+than the others, hedges a request that runs past its deadline by starting
+the next route, and falls back to the next route when one fails.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", "100"))
+ROUTER_STATS_TTL = float(os.getenv("ROUTER_STATS_TTL", "300"))
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "10"))
+ROUTER_MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", "0.5"))
+ROUTER_SLOW_FACTOR = float(os.getenv("ROUTER_SLOW_FACTOR", "2.0"))
+# Hedge after this long while a route has too few samples for its own p95;
+# 0 (the default) means no hedging until it has them, since a hedge doubles the cost
+ROUTER_HEDGE_AFTER = float(os.getenv("ROUTER_HEDGE_AFTER", "0"))
+ROUTER_HEDGE_MIN = float(os.getenv("ROUTER_HEDGE_MIN", "2"))
+ROUTER_COOLDOWN = float(os.getenv("ROUTER_COOLDOWN", "30"))
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class RouteStats:
+    """Rolling outcomes of one (provider, model) route; samples expire after `ttl` seconds."""
+
+    def __init__(self, window=ROUTER_WINDOW, ttl=ROUTER_STATS_TTL):
+        self.ttl = ttl
+        self._samples = {"call": deque(maxlen=window), "stream": deque(maxlen=window)}
+        self.cooldown_until = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, kind, latency, ok):
+        with self._lock:
+            self._samples[kind].append((time.monotonic(), latency, ok))
+
+    def _recent(self, kind=None):
+        cutoff = time.monotonic() - self.ttl
+        kinds = [kind] if kind else list(self._samples)
+        with self._lock:
+            return [s for k in kinds for s in self._samples[k] if s[0] >= cutoff]
+
+    def latency(self, q, kind="call"):
+        """q-th percentile latency of successful requests (first token for streams)."""
+        samples = self._recent(kind)
+        if len(samples) < ROUTER_MIN_SAMPLES:
+            return None
+        return _percentile([latency for _, latency, ok in samples if ok], q)
+
+    def error_rate(self):
+        samples = self._recent()
+        if len(samples) < ROUTER_MIN_SAMPLES:
+            return 0.0
+        return sum(1 for _, _, ok in samples if not ok) / len(samples)
+
+    def cooling_down(self):
+        return time.monotonic() < self.cooldown_until
+
+    def snapshot(self):
+        return {
+            "requests": len(self._recent()),
+            "p50": self.latency(50),
+            "p95": self.latency(95),
+            "first_token_p50": self.latency(50, "stream"),
+            "first_token_p95": self.latency(95, "stream"),
+            "error_rate": self.error_rate(),
+            "cooling_down": self.cooling_down(),
+        }
+
+
+class ModelRouter:
+    """
+    Routes calls for named call sites over `tiers` ({tier: [(provider, model), ...]}).
+
+    `sites` maps call sites to tiers. Only routes whose provider is in
+    `providers` are used. `should_fallback(error)` decides which errors move
+    on to the next route, and `retry_after(error)` returns the cooldown a
+    rate-limit error asks for (None if the error is not a rate limit).
+    """
+
+    def __init__(self, tiers, sites, providers=None, default_tier="standard",
+                 should_fallback=None, retry_after=None):
+        self.tiers = {tier: [tuple(route) for route in routes] for tier, routes in tiers.items()}
+        self.sites = dict(sites)
+        self.providers = set(providers) if providers else None
+        self.default_tier = default_tier
+        self.should_fallback = should_fallback or (lambda error: True)
+        self.retry_after = retry_after or (lambda error: None)
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._discarded = set()
+
+    def stats(self, route):
+        with self._stats_lock:
+            if route not in self._stats:
+                self._stats[route] = RouteStats()
+            return self._stats[route]
+
+    def routes(self, site):
+        """Configured routes for a call site, in preference order."""
+        routes = self.tiers.get(self.sites.get(site, self.default_tier), [])
+        return [route for route in routes if self.providers is None or route[0] in self.providers]
+
+    def primary_model(self, site):
+        routes = self.routes(site)
+        return routes[0][1] if routes else None
+
+    def order(self, site, kind="call"):
+        """Routes for `site`, healthy ones first, keeping the configured order otherwise."""
+        routes = self.routes(site)
+        latencies = {route: self.stats(route).latency(50, kind) for route in routes}
+        fastest = min((latency for latency in latencies.values() if latency), default=None)
+
+        def demotion(route):
+            stats = self.stats(route)
+            if stats.cooling_down():
+                return 2
+            if stats.error_rate() > ROUTER_MAX_ERROR_RATE:
+                return 1
+            if fastest and latencies[route] and latencies[route] > ROUTER_SLOW_FACTOR * fastest:
+                return 1
+            return 0
+        return sorted(routes, key=demotion)
+
+    def hedge_deadline(self, route, kind="call"):
+        """Seconds to wait for `route` before hedging, or None not to hedge."""
+        p95 = self.stats(route).latency(95, kind)
+        return max(ROUTER_HEDGE_MIN, p95) if p95 else (ROUTER_HEDGE_AFTER or None)
+
+    def _failed(self, site, route, error):
+        cooldown = self.retry_after(error)
+        if cooldown is not None:
+            self.stats(route).cooldown_until = time.monotonic() + (cooldown or ROUTER_COOLDOWN)
+        print(f"[router] {site}: {route[0]}/{route[1]} failed ({error})")
+
+    async def _timed(self, route, call):
+        start = time.monotonic()
+        try:
+            result = await call(*route)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.stats(route).record("call", time.monotonic() - start, False)
+            raise
+        self.stats(route).record("call", time.monotonic() - start, True)
+        return result
+
+    async def run(self, site, call, with_route=False):
+        """
+        Await call(provider, model) on the best route for `site`, hedging
+        and falling back to the other routes. Raises the last error if every
+        route fails. With `with_route`, returns (result, route that answered).
+        """
+        remaining = self.order(site)
+        if not remaining:
+            raise RuntimeError(f"no model route configured for {site!r}")
+        pending = {}
+        last_error = None
+
+        def launch():
+            route = remaining.pop(0)
+            pending[asyncio.ensure_future(self._timed(route, call))] = route
+            return route
+
+        hedged = launch()
+        try:
+            while pending:
+                timeout = self.hedge_deadline(hedged) if remaining else None
+                done, _ = await asyncio.wait(pending, timeout=timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    print(f"[router] {site}: {hedged[0]}/{hedged[1]} slower than {timeout:.1f}s, "
+                          f"hedging with {remaining[0][0]}/{remaining[0][1]}")
+                    hedged = launch()
+                    continue
+                for task in done:
+                    route = pending.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        return (task.result(), route) if with_route else task.result()
+                    if not self.should_fallback(error):
+                        raise error
+                    self._failed(site, route, error)
+                    last_error = error
+                if not pending and remaining:
+                    hedged = launch()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream(self, site, open_stream):
+        """
+        Yield from open_stream(provider, model) on the best route for `site`.
+        Hedging and fallback apply until the first chunk arrives; after that
+        the stream is committed to its route.
+        """
+        remaining = self.order(site, "stream")
+        if not remaining:
+            raise RuntimeError(f"no model route configured for {site!r}")
+        pending = {}
+        last_error = None
+
+        def launch():
+            route = remaining.pop(0)
+            stream = open_stream(*route)
+            pending[asyncio.ensure_future(stream.__anext__())] = (route, stream, time.monotonic())
+            return route
+
+        hedged = launch()
+        winner = None
+        try:
+            while pending and winner is None:
+                timeout = self.hedge_deadline(hedged, "stream") if remaining else None
+                done, _ = await asyncio.wait(pending, timeout=timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    print(f"[router] {site}: no tokens from {hedged[0]}/{hedged[1]} after "
+                          f"{timeout:.1f}s, hedging with {remaining[0][0]}/{remaining[0][1]}")
+                    hedged = launch()
+                    continue
+                for task in done:
+                    route, stream, started = pending.pop(task)
+                    error = task.exception()
+                    if error is None or isinstance(error, StopAsyncIteration):
+                        self.stats(route).record("stream", time.monotonic() - started, True)
+                        winner = (stream, None if error else task.result())
+                        break
+                    self.stats(route).record("stream", time.monotonic() - started, False)
+                    if not self.should_fallback(error):
+                        raise error
+                    self._failed(site, route, error)
+                    last_error = error
+                if winner is None and not pending and remaining:
+                    hedged = launch()
+        finally:
+            for task, (_, stream, _) in pending.items():
+                self._discard(task, stream)
+        if winner is None:
+            raise last_error
+        stream, first = winner
+        if first is None:
+            return
+        yield first
+        async for chunk in stream:
+            yield chunk
+
+    def _discard(self, task, stream):
+        """Cancel a losing stream and close it once its pending read has unwound."""
+        async def close():
+            task.cancel()
+            try:
+                await task
+            except BaseException:
+                pass
+            await stream.aclose()
+        closer = asyncio.ensure_future(close())
+        self._discarded.add(closer)
+        closer.add_done_callback(self._discarded.discard)
+
+    def snapshot(self):
+        with self._stats_lock:
+            routes = list(self._stats.items())
+        return {f"{provider}/{model}": stats.snapshot() for (provider, model), stats in routes}
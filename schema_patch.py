@@ -0,0 +1,108 @@
+import copy
+
+
+class PatchError(ValueError):
+    """A schema patch that cannot be applied."""
+
+
+def _parse_pointer(path):
+    """Split a JSON Pointer (RFC 6901) into its reference tokens."""
+    if not isinstance(path, str) or (path and not path.startswith("/")):
+        raise PatchError(f"invalid path: {path!r}")
+    if path == "":
+        return []
+    return [token.replace("~1", "/").replace("~0", "~") for token in path[1:].split("/")]
+
+
+def _resolve(document, tokens):
+    """The container holding the last token, and that token as a key or index."""
+    if not tokens:
+        raise PatchError("operations on the whole schema are not allowed")
+    parent = document
+    for token in tokens[:-1]:
+        if isinstance(parent, dict) and token in parent:
+            parent = parent[token]
+        elif isinstance(parent, list) and token.isdigit() and int(token) < len(parent):
+            parent = parent[int(token)]
+        else:
+            raise PatchError(f"path not found: /{'/'.join(tokens)}")
+    last = tokens[-1]
+    if isinstance(parent, list):
+        if last == "-":
+            return parent, len(parent)
+        if not last.isdigit():
+            raise PatchError(f"invalid list index: {last!r}")
+        return parent, int(last)
+    if not isinstance(parent, dict):
+        raise PatchError(f"cannot index into {type(parent).__name__}")
+    return parent, last
+
+
+def _get(document, tokens):
+    parent, key = _resolve(document, tokens)
+    try:
+        return parent[key]
+    except (KeyError, IndexError):
+        raise PatchError(f"path not found: /{'/'.join(tokens)}")
+
+
+def _add(document, tokens, value):
+    parent, key = _resolve(document, tokens)
+    if isinstance(parent, list):
+        if key > len(parent):
+            raise PatchError(f"list index out of range: {key}")
+        parent.insert(key, value)
+    else:
+        parent[key] = value
+
+
+def _remove(document, tokens):
+    parent, key = _resolve(document, tokens)
+    try:
+        return parent.pop(key)
+    except (KeyError, IndexError):
+        raise PatchError(f"path not found: /{'/'.join(tokens)}")
+
+
+def apply_patch(schema, operations):
+    """
+    Apply JSON-Patch (RFC 6902) style operations to a copy of `schema`.
+
+    Supports add, remove, replace, move, copy and test. The input schema is
+    never modified; any invalid operation raises PatchError, as does a result
+    that is no longer a non-empty dict of tasks.
+    """
+    if not isinstance(operations, list):
+        raise PatchError("patch must be a list of operations")
+    document = copy.deepcopy(schema)
+    for operation in operations:
+        if not isinstance(operation, dict) or "op" not in operation:
+            raise PatchError(f"invalid operation: {operation!r}")
+        op = operation["op"]
+        tokens = _parse_pointer(operation.get("path"))
+        if op in ("add", "replace", "test") and "value" not in operation:
+            raise PatchError(f"{op} needs a value")
+
+        if op == "add":
+            _add(document, tokens, copy.deepcopy(operation["value"]))
+        elif op == "remove":
+            _remove(document, tokens)
+        elif op == "replace":
+            _get(document, tokens)
+            parent, key = _resolve(document, tokens)
+            parent[key] = copy.deepcopy(operation["value"])
+        elif op in ("move", "copy"):
+            source = _parse_pointer(operation.get("from"))
+            value = _remove(document, source) if op == "move" else copy.deepcopy(_get(document, source))
+            _add(document, tokens, value)
+        elif op == "test":
+            if _get(document, tokens) != operation["value"]:
+                raise PatchError(f"test failed at {operation['path']}")
+        else:
+            raise PatchError(f"unsupported operation: {op!r}")
+
+    if not isinstance(document, dict) or not document:
+        raise PatchError("patched schema is empty")
+    if not all(isinstance(task, dict) for task in document.values()):
+        raise PatchError("patched schema has non-object tasks")
+    return document
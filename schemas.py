@@ -0,0 +1,181 @@
+"""
+Typed models for every structured LLM output in the pipeline.
+
+Each model doubles as the tool/function definition sent to the provider
+(see tool_spec), so responses arrive as arguments of a forced tool call
+rather than as prose to be parsed. validate_output() reports which
+top-level entries are invalid so only those need to be asked for again.
+"""
+
+import copy
+from typing import Any, Dict, List, Literal, Optional
+
+from pydantic import BaseModel, ConfigDict, Field, RootModel, ValidationError
+
+
+class Task(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    description: str
+    steps: List[str]
+    variables: Dict[str, Any] = {}
+
+
+class TaskSchema(RootModel[Dict[str, Task]]):
+    """Task name ("task 1", ...) to task."""
+
+
+class TaskMistakes(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    common_misunderstandings: List[str]
+    variable_or_calculation_mistakes: List[str]
+    reasoning_missteps: List[str]
+
+
+class PotentialMistakes(RootModel[Dict[str, TaskMistakes]]):
+    """Task name to the mistakes students are likely to make on it."""
+
+
+class CharacterTask(Task):
+    student_approach: str
+
+
+class CharacterSchema(RootModel[Dict[str, CharacterTask]]):
+    """A task schema personalised for one student."""
+
+
+class RosterSchemas(RootModel[Dict[str, CharacterSchema]]):
+    """Student name to that student's character schema."""
+
+
+class Reflection(BaseModel):
+    errors_made: List[str]
+    learning_progress: str
+    schema_updated: bool
+    update_reason: str = ""
+
+
+class SchemaChanges(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    modified_task: str = ""
+    old_value: Any = ""
+    new_value: Any = ""
+    update_reason: str = ""
+    mistakes_addressed: List[str] = []
+
+
+class PatchOperation(BaseModel):
+    op: Literal["add", "remove", "replace", "move", "copy", "test"]
+    path: str
+    value: Any = None
+    from_: Optional[str] = Field(None, alias="from")
+
+
+class FullRegeneration(BaseModel):
+    schema_: CharacterSchema = Field(alias="schema")
+    changes: SchemaChanges = SchemaChanges()
+
+
+class PatchRegeneration(BaseModel):
+    patch: List[PatchOperation]
+    changes: SchemaChanges = SchemaChanges()
+
+
+class FullSchemaUpdate(Reflection):
+    """Reflection plus, when schema_updated, the whole new schema."""
+
+    schema_: Optional[CharacterSchema] = Field(None, alias="schema")
+    changes: Optional[SchemaChanges] = None
+
+
+class PatchSchemaUpdate(Reflection):
+    """Reflection plus, when schema_updated, JSON-Patch edits to the schema."""
+
+    patch: Optional[List[PatchOperation]] = None
+    changes: Optional[SchemaChanges] = None
+
+
+def dump(output):
+    """
+    Plain JSON-compatible data for a validated model, using field aliases.
+    Optional parts the model left out (e.g. "schema" when it made no update)
+    are dropped, but nulls inside the data, like a patch "value" or a task
+    variable, are kept.
+    """
+    data = output.model_dump(mode="json", by_alias=True)
+    if isinstance(output, RootModel):
+        return data
+    for name, field in type(output).model_fields.items():
+        key = field.alias or name
+        if field.default is None and data.get(key) is None:
+            data.pop(key, None)
+    for operation in data.get("patch") or []:
+        if operation.get("from") is None:
+            operation.pop("from", None)
+    return data
+
+
+def _inline_refs(schema, defs=None):
+    """Resolve $ref/$defs so the schema is self-contained for every provider."""
+    if defs is None:
+        defs = schema.get("$defs", {})
+    if isinstance(schema, dict):
+        if "$ref" in schema:
+            return _inline_refs(copy.deepcopy(defs[schema["$ref"].split("/")[-1]]), defs)
+        return {key: _inline_refs(value, defs) for key, value in schema.items() if key != "$defs"}
+    if isinstance(schema, list):
+        return [_inline_refs(value, defs) for value in schema]
+    return schema
+
+
+def json_schema(output_model, keys=None):
+    """
+    JSON schema for `output_model`, optionally narrowed to the top-level `keys`
+    (the parts being asked for again after a failed validation).
+    """
+    schema = _inline_refs(output_model.model_json_schema(by_alias=True))
+    if keys is None:
+        return schema
+    if "properties" in schema:
+        properties = {key: schema["properties"][key] for key in keys if key in schema["properties"]}
+    else:
+        properties = {key: schema.get("additionalProperties", {}) for key in keys}
+    return {"type": "object", "properties": properties, "required": list(properties)}
+
+
+def tool_spec(output_model, keys=None):
+    """(name, description, parameters) of the tool the model is forced to call."""
+    name = "submit_" + "".join("_" + c.lower() if c.isupper() else c
+                               for c in output_model.__name__).lstrip("_")
+    description = (output_model.__doc__ or f"Submit the {output_model.__name__}.").strip()
+    return name, description, json_schema(output_model, keys)
+
+
+def validate_output(output_model, data, required_keys=None):
+    """
+    Validate tool-call arguments against `output_model`.
+
+    Returns (model, invalid) where `model` is None on failure and `invalid`
+    maps each failing top-level key to its error messages. `required_keys`
+    are top-level keys that must be present even where the model allows any
+    (e.g. every task of the task schema in a character schema).
+    """
+    invalid = {}
+    if not isinstance(data, dict):
+        return None, {None: ["expected a JSON object"]}
+    for key in required_keys or []:
+        if key not in data:
+            invalid[key] = ["missing"]
+    try:
+        output = output_model.model_validate(data)
+    except ValidationError as e:
+        for error in e.errors():
+            key = error["loc"][0] if error["loc"] else None
+            path = "/".join(str(part) for part in error["loc"])
+            invalid.setdefault(key, []).append(f"{path}: {error['msg']}")
+        return None, invalid
+    if invalid:
+        return None, invalid
+    return output, {}
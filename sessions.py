@@ -0,0 +1,299 @@
+import json
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from event_log import EVENT_LOG_DIR, EventLog, EventLogStore, write_atomic
+
+SESSION_MAX_LIVE = int(os.getenv("SESSION_MAX_LIVE", "50"))
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", "3600"))
+SESSION_DB = os.getenv("SESSION_DB", "")
+
+_VALID_ID = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+class Session:
+    """Everything one browser's simulation needs between requests."""
+
+    def __init__(self, session_id, roster=None):
+        self.id = session_id
+        self.roster = [dict(agent) for agent in (roster or [])]
+        self.game = None
+        self.current_agent_index = 0
+        self.game_data = []
+        self.round_job_id = None
+        self.round_job_round = None
+        self.version = 0
+        self.last_access = time.time()
+        self.lock = threading.RLock()
+        # Guards round_job_*, which must not wait on a round holding `lock`
+        self.job_lock = threading.Lock()
+
+    def reset(self):
+        if self.game is not None:
+            self.game.close()
+        self.game = None
+        self.current_agent_index = 0
+        self.game_data = []
+        self.round_job_id = None
+        self.round_job_round = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        del state["job_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        self.job_lock = threading.Lock()
+
+
+class SQLiteSessionBackend:
+    """
+    Pickled sessions in a local SQLite file, so a session can move between
+    worker processes (see SessionStore on running several). Rows untouched
+    for `ttl` seconds are pruned.
+    """
+
+    def __init__(self, path, ttl=24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " id TEXT PRIMARY KEY,"
+                " data BLOB NOT NULL,"
+                " version INTEGER NOT NULL,"
+                " updated REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def version(self, session_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT version FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def load(self, session_id, writable=True):
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def save(self, session):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, version, updated) VALUES (?, ?, ?, ?)",
+                (session.id, pickle.dumps(session), session.version, now),
+            )
+            conn.execute("DELETE FROM sessions WHERE updated < ?", (now - self.ttl,))
+
+    def release(self, session_id):
+        pass
+
+    def delete(self, session_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def ids(self):
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT id FROM sessions ORDER BY updated")]
+
+
+class EventLogSessionBackend:
+    """
+    Sessions as event logs (see event_log.py): the game appends its own
+    state changes as they happen, and save() only writes the session's small
+    bookkeeping to session.json. Loading restores the game from its latest
+    snapshot plus the events since, with `restore_game(state, events)`,
+    without any LLM calls. Only a writable load attaches the game to its log.
+    """
+
+    def __init__(self, root, restore_game):
+        self.store = EventLogStore(root)
+        self.restore_game = restore_game
+
+    def _meta_path(self, session_id):
+        return os.path.join(self.store.path(session_id), "session.json")
+
+    def _meta(self, session_id):
+        try:
+            with open(self._meta_path(session_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def version(self, session_id):
+        meta = self._meta(session_id)
+        return meta["version"] if meta else None
+
+    def load(self, session_id, writable=True):
+        meta = self._meta(session_id)
+        if meta is None:
+            return None
+        session = Session(session_id, meta["roster"])
+        session.current_agent_index = meta["current_agent_index"]
+        session.game_data = meta["game_data"]
+        session.version = meta["version"]
+        if meta["game"]:
+            log = self.store.open(session_id) if writable else EventLog(self.store.path(session_id))
+            state, events = log.load()
+            if state is not None:
+                session.game = self.restore_game(state, events)
+                if writable:
+                    session.game.attach_log(log, snapshot=False)
+        return session
+
+    def save(self, session):
+        game = session.game
+        if game is not None:
+            if game.events is None:
+                # A new game starts its log with a snapshot of its setup
+                game.attach_log(self.store.open(session.id))
+            game.events.sync()
+        write_atomic(self._meta_path(session.id), {
+            "roster": session.roster,
+            "current_agent_index": session.current_agent_index,
+            "game_data": session.game_data,
+            "version": session.version,
+            "game": game is not None,
+        })
+
+    def release(self, session_id):
+        self.store.release(session_id)
+
+    def delete(self, session_id):
+        self.store.delete(session_id)
+
+    def ids(self):
+        ids = [session_id for session_id in self.store.ids()
+               if os.path.exists(self._meta_path(session_id))]
+        return sorted(ids, key=lambda session_id: os.path.getmtime(self._meta_path(session_id)))
+
+
+class SessionStore:
+    """
+    Live sessions keyed by id.
+
+    At most `max_live` sessions (and so `Game` objects) are kept in memory;
+    the least recently used one is dropped beyond that, and sessions idle for
+    `idle_timeout` seconds are dropped as well. With a backend, dropped
+    sessions are reloaded from it on their next request.
+
+    An unknown id gets a fresh session under a new id, never one under the
+    id the client asked for, so clients cannot choose session ids.
+
+    Session locks are per process, and the backends have no compare-and-set:
+    two workers handling requests for the same session at once would both
+    load, change and save it, and the last save wins. Run a single worker
+    process, or route every request of a session to the same worker (sticky
+    sessions); a backend only lets a session move to another worker between
+    requests, e.g. after a restart.
+    """
+
+    def __init__(self, roster=None, max_live=SESSION_MAX_LIVE,
+                 idle_timeout=SESSION_IDLE_TIMEOUT, backend=None):
+        self.roster = roster or []
+        self.max_live = max_live
+        self.idle_timeout = idle_timeout
+        self.backend = backend
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id=None):
+        """The session for `session_id`, created if it does not exist."""
+        if not session_id or not _VALID_ID.match(session_id):
+            session_id = new_session_id()
+        with self._lock:
+            self._evict_idle()
+            session = self._sessions.get(session_id)
+            if self.backend is not None:
+                stored = self.backend.version(session_id)
+                if stored is not None and (session is None or stored > session.version):
+                    # Another worker has written a newer copy
+                    if session is not None:
+                        self._release(session)
+                    session = self.backend.load(session_id)
+            if session is None:
+                session = Session(new_session_id(), self.roster)
+            self._sessions[session.id] = session
+            self._sessions.move_to_end(session.id)
+            session.last_access = time.time()
+            self._evict_over_cap()
+        return session
+
+    def save(self, session):
+        """Persist a session after it changed (no-op without a backend)."""
+        session.version += 1
+        if self.backend is not None:
+            with session.lock:
+                self.backend.save(session)
+
+    def delete(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._release(session)
+        if self.backend is not None:
+            self.backend.delete(session_id)
+
+    def live(self):
+        with self._lock:
+            return list(self._sessions.values())
+
+    def iter_sessions(self, ids=None):
+        """
+        Sessions by id, by default every live and stored one. Stored sessions
+        are loaded one at a time and not kept, so any number can be walked.
+        """
+        live = {session.id: session for session in self.live()}
+        if ids is None:
+            stored = self.backend.ids() if self.backend is not None else []
+            ids = list(live) + [session_id for session_id in stored if session_id not in live]
+        for session_id in ids:
+            session = live.get(session_id)
+            if self.backend is not None:
+                stored = self.backend.version(session_id)
+                if stored is not None and (session is None or stored > session.version):
+                    session = self.backend.load(session_id, writable=False)
+            if session is not None:
+                yield session
+
+    def _evict_idle(self):
+        cutoff = time.time() - self.idle_timeout
+        for session_id in [sid for sid, s in self._sessions.items() if s.last_access < cutoff]:
+            self._release(self._sessions.pop(session_id))
+
+    def _evict_over_cap(self):
+        while len(self._sessions) > self.max_live:
+            _, session = self._sessions.popitem(last=False)
+            self._release(session)
+
+    def _release(self, session):
+        # Cancel background work of a game that is leaving memory, and close its log
+        if session.game is not None:
+            session.game.close()
+        if self.backend is not None:
+            self.backend.release(session.id)
+
+
+def default_backend(restore_game=None):
+    """EVENT_LOG_DIR selects event logs (given how to restore a game), SESSION_DB SQLite."""
+    if EVENT_LOG_DIR and restore_game is not None:
+        return EventLogSessionBackend(EVENT_LOG_DIR, restore_game)
+    return SQLiteSessionBackend(SESSION_DB) if SESSION_DB else None
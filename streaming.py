@@ -0,0 +1,68 @@
+import json
+
+
+class SectionStreamParser:
+    """
+    Incrementally split a streamed "Reasoning: ... Message: ..." response
+    into sections.
+
+    feed() takes raw deltas and returns (section, text) pairs that are safe to
+    show; text that might be the start of a section header is held back until
+    the next delta disambiguates it.
+    """
+
+    def __init__(self, sections=("Reasoning", "Message")):
+        self.markers = {f"{section}:": section.lower() for section in sections}
+        self.section = None
+        self.buffer = ""
+        self._section_start = False
+
+    def _held_back(self):
+        # Longest suffix of the buffer that could still grow into a marker
+        for length in range(min(len(self.buffer), max(map(len, self.markers))), 0, -1):
+            suffix = self.buffer[-length:]
+            if any(marker.startswith(suffix) for marker in self.markers):
+                return length
+        return 0
+
+    def _emit(self, text, events):
+        if self.section is None:
+            return
+        if self._section_start:
+            text = text.lstrip()
+            if not text:
+                return
+            self._section_start = False
+        text = text.replace("[", "").replace("]", "")
+        if text:
+            events.append((self.section, text))
+
+    def feed(self, delta):
+        events = []
+        self.buffer += delta
+        while True:
+            found = [(self.buffer.find(marker), marker) for marker in self.markers]
+            found = [(index, marker) for index, marker in found if index != -1]
+            if not found:
+                break
+            index, marker = min(found)
+            self._emit(self.buffer[:index], events)
+            self.section = self.markers[marker]
+            self._section_start = True
+            self.buffer = self.buffer[index + len(marker):]
+
+        keep = self._held_back()
+        ready, self.buffer = self.buffer[:len(self.buffer) - keep], self.buffer[len(self.buffer) - keep:]
+        self._emit(ready, events)
+        return events
+
+    def close(self):
+        events = []
+        self._emit(self.buffer.rstrip(), events)
+        self.buffer = ""
+        return events
+
+
+def sse_event(event, data):
+    """Format one server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,266 @@
+"""
+Lightweight tracing for pipeline stages and LLM calls.
+
+A span records wall time, outcome and whatever attributes the code inside
+it adds (model, token usage, cache hit/miss). Finished spans feed process
+wide aggregates, rendered for Prometheus by render_prometheus(), and a
+per-session breakdown for the session bound with bind_session().
+
+The current span and session live in contextvars. Work handed to another
+thread must go through submit() (or run in a copied context) to stay
+attributed to its session; coroutines scheduled on the LLM loop get the
+caller's context through run_sync/iter_sync.
+"""
+
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+# USD per million (prompt, completion) tokens; override with MODEL_PRICES (JSON)
+MODEL_PRICES = {
+    "gpt-4": (30.0, 60.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "claude-3-5-sonnet-20240620": (3.0, 15.0),
+    "claude-3-haiku-20240307": (0.25, 1.25),
+}
+MODEL_PRICES.update({model: tuple(price) for model, price in
+                     json.loads(os.getenv("MODEL_PRICES", "{}")).items()})
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TELEMETRY_SESSIONS = int(os.getenv("TELEMETRY_SESSIONS", "1000"))
+
+_current_span = contextvars.ContextVar("telemetry_span", default=None)
+_current_session = contextvars.ContextVar("telemetry_session", default=None)
+
+
+def cost(model, prompt_tokens, completion_tokens):
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+
+class Span:
+    __slots__ = ("name", "parent", "session", "start", "duration", "attributes")
+
+    def __init__(self, name, parent=None, session=None, attributes=None):
+        self.name = name
+        self.parent = parent
+        self.session = session
+        self.start = time.monotonic()
+        self.duration = None
+        self.attributes = dict(attributes or {})
+
+
+class _Totals:
+    __slots__ = ("count", "seconds", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+
+class _SessionTimings:
+    def __init__(self):
+        self.stages = defaultdict(_Totals)
+        self.tokens = defaultdict(int)
+        self.cost = 0.0
+        self.errors = 0
+        self.cache = defaultdict(int)
+
+    def to_dict(self):
+        return {
+            "stages": {name: {"count": totals.count, "seconds": round(totals.seconds, 3),
+                              "mean_seconds": round(totals.seconds / totals.count, 3)}
+                       for name, totals in sorted(self.stages.items())},
+            "tokens": dict(self.tokens),
+            "cost_usd": round(self.cost, 6),
+            "errors": self.errors,
+            "cache": dict(self.cache),
+        }
+
+
+class Registry:
+    """Aggregates of every finished span."""
+
+    def __init__(self, max_sessions=TELEMETRY_SESSIONS):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.spans = defaultdict(_Totals)   # (name, provider, model, outcome)
+            self.tokens = defaultdict(int)      # (provider, model, kind)
+            self.costs = defaultdict(float)     # (provider, model)
+            self.cache = defaultdict(int)       # (name, result)
+            self.sessions = OrderedDict()
+
+    def _session(self, session_id):
+        if session_id not in self.sessions:
+            self.sessions[session_id] = _SessionTimings()
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        self.sessions.move_to_end(session_id)
+        return self.sessions[session_id]
+
+    def record(self, span):
+        attributes = span.attributes
+        provider = attributes.get("provider", "")
+        model = attributes.get("model", "")
+        outcome = attributes.get("outcome", "ok")
+        prompt_tokens = attributes.get("prompt_tokens", 0)
+        completion_tokens = attributes.get("completion_tokens", 0)
+        call_cost = cost(model, prompt_tokens, completion_tokens) if model else 0.0
+        with self._lock:
+            self.spans[(span.name, provider, model, outcome)].add(span.duration)
+            if prompt_tokens or completion_tokens:
+                self.tokens[(provider, model, "prompt")] += prompt_tokens
+                self.tokens[(provider, model, "completion")] += completion_tokens
+                self.costs[(provider, model)] += call_cost
+            if "cache" in attributes:
+                self.cache[(span.name, attributes["cache"])] += 1
+            if span.session is not None:
+                timings = self._session(span.session)
+                timings.stages[span.name].add(span.duration)
+                timings.tokens["prompt"] += prompt_tokens
+                timings.tokens["completion"] += completion_tokens
+                timings.cost += call_cost
+                timings.errors += outcome != "ok"
+                if "cache" in attributes:
+                    timings.cache[f"{span.name}_{attributes['cache']}"] += 1
+
+    def session(self, session_id):
+        with self._lock:
+            timings = self.sessions.get(session_id)
+            return timings.to_dict() if timings else None
+
+    def render_prometheus(self, prefix="simteach"):
+        with self._lock:
+            spans = {key: (totals.count, totals.seconds, list(totals.buckets))
+                     for key, totals in self.spans.items()}
+            tokens = dict(self.tokens)
+            costs = dict(self.costs)
+            cache = dict(self.cache)
+        lines = [f"# HELP {prefix}_span_seconds Wall time of pipeline stages and LLM calls.",
+                 f"# TYPE {prefix}_span_seconds histogram"]
+        for (name, provider, model, outcome), (count, seconds, buckets) in sorted(spans.items()):
+            labels = _labels(span=name, provider=provider, model=model, outcome=outcome)
+            for bound, observed in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f'{prefix}_span_seconds_bucket{{{labels},le="{bound}"}} {observed}')
+            lines.append(f'{prefix}_span_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{prefix}_span_seconds_sum{{{labels}}} {seconds:.6f}")
+            lines.append(f"{prefix}_span_seconds_count{{{labels}}} {count}")
+        lines += [f"# HELP {prefix}_llm_tokens_total Tokens reported by provider usage.",
+                  f"# TYPE {prefix}_llm_tokens_total counter"]
+        lines += [f"{prefix}_llm_tokens_total{{{_labels(provider=p, model=m, kind=k)}}} {n}"
+                  for (p, m, k), n in sorted(tokens.items())]
+        lines += [f"# HELP {prefix}_llm_cost_usd_total Estimated spend from token usage.",
+                  f"# TYPE {prefix}_llm_cost_usd_total counter"]
+        lines += [f"{prefix}_llm_cost_usd_total{{{_labels(provider=p, model=m)}}} {c:.6f}"
+                  for (p, m), c in sorted(costs.items())]
+        lines += [f"# HELP {prefix}_cache_requests_total Cache lookups by stage and result.",
+                  f"# TYPE {prefix}_cache_requests_total counter"]
+        lines += [f"{prefix}_cache_requests_total{{{_labels(span=s, result=r)}}} {n}"
+                  for (s, r), n in sorted(cache.items())]
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+
+
+def gauge_lines(name, help_text, samples, prefix="simteach"):
+    """Prometheus gauge lines for [(labels dict, value)], skipping missing values."""
+    lines = [f"# HELP {prefix}_{name} {help_text}", f"# TYPE {prefix}_{name} gauge"]
+    lines += [f"{prefix}_{name}{{{_labels(**labels)}}} {value}"
+              for labels, value in samples if value is not None]
+    return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+@contextmanager
+def span(name, activate=True, **attributes):
+    """
+    Time the enclosed block as a span; exceptions mark its outcome as "error".
+    Inside async generators, whose steps may run in different contexts, pass
+    activate=False and set attributes on the yielded span directly.
+    """
+    current = Span(name, _current_span.get(), _current_session.get(), attributes)
+    token = _current_span.set(current) if activate else None
+    try:
+        yield current
+    except (GeneratorExit, KeyboardInterrupt):
+        current.attributes["outcome"] = "cancelled"
+        raise
+    except BaseException as e:
+        current.attributes["outcome"] = "cancelled" if type(e).__name__ == "CancelledError" else "error"
+        raise
+    finally:
+        if token is not None:
+            _current_span.reset(token)
+        current.duration = time.monotonic() - current.start
+        registry.record(current)
+
+
+def traced(name=None):
+    """Decorator running a function (sync or async) inside a span."""
+    def decorate(fn):
+        span_name = name or fn.__name__
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def annotate(**attributes):
+    """Add attributes to the current span, if any."""
+    current = _current_span.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def record_usage(provider, model, prompt_tokens, completion_tokens):
+    annotate(provider=provider, model=model,
+             prompt_tokens=prompt_tokens or 0, completion_tokens=completion_tokens or 0)
+
+
+def record_cache(hit):
+    annotate(cache="hit" if hit else "miss")
+
+
+def bind_session(session_id):
+    """Attribute spans in the current context to `session_id`."""
+    _current_session.set(session_id)
+
+
+def submit(executor, fn, *args, **kwargs):
+    """executor.submit that runs fn in a copy of the caller's context."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
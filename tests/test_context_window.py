@@ -0,0 +1,57 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_window import DiscussionContext, estimate_tokens  # noqa: E402
+from transcript import Transcript  # noqa: E402
+
+AGENTS = ["Alice", "Bob", "Charlie"]
+
+
+def play_round(transcript, number):
+    for name in AGENTS:
+        transcript.append(name, f"round {number} " + "x" * 80)
+
+
+def round_tokens(transcript):
+    return sum(estimate_tokens(line) + 1 for line in transcript.lines[-len(AGENTS):])
+
+
+def summarize(summary, lines):
+    return f"{summary} +{len(lines)}".strip()
+
+
+def test_no_message_is_left_out_between_folds():
+    transcript = Transcript("Problem\n")
+    context = DiscussionContext(transcript, summarize=summarize, budget=200, summary_budget=20)
+    for number in range(1, 6):
+        for name in AGENTS:
+            text, usage = context.render()
+            assert "omitted" not in text
+            # Every message that is not in the summary reaches the prompt
+            assert usage["recent_messages"] == len(transcript) - context.summarized_count
+            transcript.append(name, f"round {number} " + "x" * 80)
+        context.end_round(reserve=round_tokens(transcript))
+    assert context.summarized_count > 0
+
+
+def test_fold_leaves_room_for_the_next_round():
+    transcript = Transcript("Problem\n")
+    context = DiscussionContext(transcript, summarize=summarize, budget=200, summary_budget=20)
+    for number in range(1, 6):
+        play_round(transcript, number)
+        # A round as long as the last one still fits after the previous fold
+        _, usage = context.render()
+        assert usage["recent"] <= context.budget - context.summary_budget
+        context.end_round(reserve=round_tokens(transcript))
+
+
+def test_render_trims_to_budget_without_a_summarizer():
+    transcript = Transcript("Problem\n")
+    context = DiscussionContext(transcript, budget=100)
+    for number in range(1, 4):
+        play_round(transcript, number)
+    text, usage = context.render()
+    assert "earlier messages omitted" in text
+    assert usage["recent"] <= 100
@@ -0,0 +1,78 @@
+import threading
+from collections import defaultdict
+
+
+class Transcript:
+    """
+    Append-only discussion log.
+
+    Appends are O(1). The full rendering is extended incrementally, so it is
+    only ever joined once per new message. Windowed and per-agent renderings
+    are cached until the next append.
+    """
+
+    def __init__(self, header=""):
+        self.header = header
+        self.lines = []
+        self._speakers = []
+        self._by_agent = defaultdict(list)
+        self._rendered = header
+        self._rendered_count = 0
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.lines)
+
+    def append(self, agent_name, message):
+        with self._lock:
+            self._by_agent[agent_name].append(len(self.lines))
+            self._speakers.append(agent_name)
+            self.lines.append(f"{agent_name}: {message}")
+            self._views.clear()
+
+    def render(self):
+        """Header plus the whole discussion."""
+        with self._lock:
+            if self._rendered_count < len(self.lines):
+                new = "\n".join(self.lines[self._rendered_count:])
+                self._rendered += ("\n" if self._rendered_count else "") + new
+                self._rendered_count = len(self.lines)
+            return self._rendered
+
+    def _view(self, key, build):
+        with self._lock:
+            if key not in self._views:
+                self._views[key] = build()
+            return self._views[key]
+
+    def last(self, k):
+        """The last k messages, without the header."""
+        if k <= 0:
+            return ""
+        return self._view(("last", k), lambda: "\n".join(self.lines[-k:]))
+
+    def render_window(self, k):
+        """Header plus the last k messages."""
+        return self._view(("window", k), lambda: self.header + "\n".join(self.lines[-k:] if k > 0 else []))
+
+    def agent_view(self, agent_name, k=None):
+        """Messages sent by one agent, optionally only the last k of them."""
+        def build():
+            indices = self._by_agent.get(agent_name, [])
+            if k is not None:
+                indices = indices[-k:] if k > 0 else []
+            return "\n".join(self.lines[i] for i in indices)
+        return self._view(("agent", agent_name, k), build)
+
+    def speaker(self, index):
+        return self._speakers[index]